@@ -1,29 +1,47 @@
 import os
+import threading
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.generativeai import GenerativeModel
+import gemini_client
+
+MODEL_NAME = 'gemini-2.0-flash'
 
 model = None
-chat_session = None
-current_persona_and_situation_for_display = "（まだキャラクター設定なし）"
-current_persona_metadata = {}  # TTSの声種などで参照
+_init_lock = threading.Lock()
+# 会話ごとの状態（チャットセッション・ペルソナ・声）は session_manager で利用者ごとに管理する
+
+def create_model(system_instruction: str = None):
+    """
+    チャット用のGeminiモデルを作る関数。システム指示（ペルソナ設定）ごとにモデルを作る場合に使う。
+    ベンチマークではローカルの代替モデルに差し替えられる。
+    """
+    import google.generativeai as genai
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=system_instruction)
 
 def initialize_ai():
     """
     APIキーを読み込み、Geminiモデルを初期化する関数。
-    アプリ起動時に一度だけ呼び出すことを想定。
+    起動時のウォームアップ（warmup.py）でバックグラウンドから呼ばれるほか、AIを使う直前にも呼ばれる。
+    別のスレッドが初期化中であれば、その完了を待ってから結果を返す。
     """
+    with _init_lock:
+        return _initialize_ai_locked()
+
+def _initialize_ai_locked():
     global model
+    if model is not None:
+        return True  # プロセス内で初期化済みのモデルを、他のセッションでもそのまま使う
     load_dotenv() # .envファイルから環境変数を読み込む
     try:
+        import google.generativeai as genai  # SDKの読み込みは重いので、初期化するときまで遅らせる
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("APIキーが環境変数 'GEMINI_API_KEY' に見つかりません。")
         
-        genai.configure(api_key=api_key)
+        # chat/ペルソナ用とTTS用のクライアントを、ここで一度だけ設定して使い回す
+        gemini_client.configure(api_key)
         
         # 使用するGeminiモデルを準備 (例: 'gemini-2.0-flash')
-        model = genai.GenerativeModel('gemini-2.0-flash') 
+        model = genai.GenerativeModel(MODEL_NAME)
         print("Gemini AIモデルが正常に初期化されました。") # ターミナルでの確認用
         return True
 
@@ -1,26 +1,55 @@
 import streamlit as st
 from ai_init import initialize_ai
-from chat_manager import get_ai_response, get_current_persona_and_situation_description
-from tts_handler import synthesize_speech_with_gemini_to_wav
-from PIL import Image
-import io
+from chat_manager import (
+    PERSONA_STATUS_DESCRIPTIONS,
+    adopt_prepared_conversation,
+    get_ai_response,
+    get_character_choices,
+    get_current_persona_state,
+    switch_character,
+)
+from tts_handler import synthesize_speech_with_gemini
+from speech_pipeline import stream_reply_with_speech
+from audio_buffer import encode_playback_audio, pcm_duration_seconds
+from session_manager import PERSONA_STATUS_CHARACTER, SessionLimitError, get_session
+from message_store import load_message_audio, make_message
+import tracing
+from image_preprocessor import preprocess_image
+from prefetch import cancel_persona_prefetch, start_persona_prefetch, take_prefetched_greeting
+import hashlib
+import itertools
 import os
-import tempfile
-import whisper
-from audio_recorder_streamlit import audio_recorder
-import ast
-
-# --- AIの初期化 ---
-if "ai_initialized" not in st.session_state:
-    st.session_state.ai_initialized = False
-
-if not st.session_state.ai_initialized:
-    if initialize_ai():
-        st.session_state.ai_initialized = True
-    else:
+import time
+from transcriber import TranscriptionTimeoutError, transcribe_wav_bytes_with_timeout
+from warmup import start_warm_up
+
+# --- AIの初期化・定型フレーズの音声化・Whisperモデルの先読み ---
+# 最初の画面表示を待たせないよう、バックグラウンドでプロセス内に一度だけ行う。
+# AIが実際に必要になった時点（応答の生成や画像の先読み）で、initialize_ai() が完了を待つ。
+start_warm_up()
+
+def require_ai():
+    """AIの初期化が終わるまで待ち、失敗していればエラーを表示して処理を止める。"""
+    if not initialize_ai():
         st.error("AIの初期化に失敗しました。環境変数 'GEMINI_API_KEY' やAPIキーの有効性を確認してください。")
         st.stop()
 
+@st.cache_resource(show_spinner=False)
+def load_narration(file_name: str) -> bytes:
+    """ナレーションのWAVをプロセス内で一度だけ読み込む（セッションごとにファイルを読み直さない）。"""
+    with open(os.path.join("narration", file_name), "rb") as f:
+        return f.read()
+
+# --- この利用者専用の会話状態（チャット・ペルソナ・声）を取得 ---
+try:
+    conversation_session = get_session()
+except SessionLimitError as e:
+    st.error(f"ただいま混み合っています。しばらくしてからもう一度お試しください。（{e}）")
+    st.stop()
+
+# --- 計測結果（Prometheus形式）の公開。TRACING_METRICS_PORT が指定された場合のみ ---
+tracing.start_metrics_server()
+
 # --- StreamlitアプリのUI設定 ---
 st.title("絵本キャラクターAIチャット")
 st.caption("画像をアップロードすると、AIがその絵の「人間」のキャラクターになりきり、状況も理解してお話しします。")
@@ -29,9 +58,7 @@ if "intro_played" not in st.session_state:
     st.session_state.intro_played = False
 
 if not st.session_state.intro_played:
-    with open("narration/intro_narration.wav", "rb") as f:
-        audio_bytes = f.read()
-    st.audio(audio_bytes, format="audio/wav", autoplay=True)
+    st.audio(load_narration("intro_narration.wav"), format="audio/wav", autoplay=True)
     st.session_state.intro_played = True
 
 # --- 会話履歴の管理 ---
@@ -41,6 +68,8 @@ if "messages" not in st.session_state:
 # --- 送信待ちの画像（Pillow Imageオブジェクト）の状態管理 ---
 if "image_to_process_on_send" not in st.session_state:
     st.session_state.image_to_process_on_send = None 
+if "selected_preprocessed_image" not in st.session_state:
+    st.session_state.selected_preprocessed_image = None
 if "uploaded_file_name" not in st.session_state:
     st.session_state.uploaded_file_name = None
 if "uploader_key_suffix" not in st.session_state:
@@ -48,6 +77,18 @@ if "uploader_key_suffix" not in st.session_state:
 if "camera_key_suffix" not in st.session_state:
     st.session_state.camera_key_suffix = 0
 
+def load_preprocessed_image(image_bytes: bytes):
+    """
+    画像を前処理する（縮小・再圧縮・サムネイル作成）。
+    再実行のたびに同じ画像を処理し直さないよう、直前の結果をセッションに保持する。
+    """
+    image_key = hashlib.sha1(image_bytes).hexdigest()
+    cached = st.session_state.get("preprocessed_image")
+    if cached is None or cached[0] != image_key:
+        cached = (image_key, preprocess_image(image_bytes))
+        st.session_state.preprocessed_image = cached
+    return cached[1]
+
 # --- 画像アップロードとプレビューエリア ---
 # --- 画像アップロード or カメラ撮影エリア ---
 with st.container():
@@ -64,13 +105,12 @@ with st.container():
     if uploaded_file_obj is not None:
         try:
             image_bytes = uploaded_file_obj.getvalue()
-            pil_image = Image.open(io.BytesIO(image_bytes))
+            preprocessed_image = load_preprocessed_image(image_bytes)
+            pil_image = preprocessed_image.image
             file_name = uploaded_file_obj.name
             
             if "mic_guide_played" not in st.session_state:
-                with open("narration/mic_guide_narration.wav", "rb") as f:
-                    audio_bytes = f.read()
-                st.audio(audio_bytes, format="audio/wav", autoplay=True)
+                st.audio(load_narration("mic_guide_narration.wav"), format="audio/wav", autoplay=True)
                 st.session_state.mic_guide_played = True
                 
         except Exception as e:
@@ -79,28 +119,42 @@ with st.container():
     elif camera_image_obj is not None:
         try:
             image_bytes = camera_image_obj.getvalue()
-            pil_image = Image.open(io.BytesIO(image_bytes))
+            preprocessed_image = load_preprocessed_image(image_bytes)
+            pil_image = preprocessed_image.image
             file_name = "captured_from_camera.jpg"
             
             if "mic_guide_played" not in st.session_state:
-                with open("narration/mic_guide_narration.wav", "rb") as f:
-                    audio_bytes = f.read()
-                st.audio(audio_bytes, format="audio/wav", autoplay=True)
+                st.audio(load_narration("mic_guide_narration.wav"), format="audio/wav", autoplay=True)
                 st.session_state.mic_guide_played = True
         except Exception as e:
             st.error(f"カメラ画像の読み込みに失敗しました: {e}")
 
+    if pil_image is None and st.session_state.get("selected_image_key"):
+        # アップローダーの × などで画像が外された。先読みを取り消し、送信待ちの画像も外す
+        cancel_persona_prefetch(conversation_session)
+        st.session_state.image_to_process_on_send = None
+        st.session_state.selected_preprocessed_image = None
+        st.session_state.selected_image_key = None
+        st.session_state.uploaded_file_name = None
+
     if pil_image:
         st.session_state.image_to_process_on_send = pil_image
+        st.session_state.selected_preprocessed_image = preprocessed_image
         st.session_state.uploaded_file_name = file_name
+        # 子供が話しかける前に、ペルソナ生成と最初の挨拶（音声つき）をバックグラウンドで済ませておく
+        st.session_state.selected_image_key = st.session_state.preprocessed_image[0]
+        start_persona_prefetch(conversation_session, st.session_state.selected_image_key, pil_image)
         st.success(f"画像「{file_name}」が選択されました。下のチャット欄から話しかけてみましょう！")
 
         col1_img, col2_btn = st.columns([0.8, 0.2])
         with col1_img:
-            st.image(pil_image, caption=f"選択中の画像: {file_name}", width=200)
+            st.image(preprocessed_image.thumbnail, caption=f"選択中の画像: {file_name}", width=200)
         with col2_btn:
             if st.button("この画像をクリア", key="clear_image_button_main"):
+                cancel_persona_prefetch(conversation_session)
                 st.session_state.image_to_process_on_send = None
+                st.session_state.selected_preprocessed_image = None
+                st.session_state.selected_image_key = None
                 st.session_state.uploaded_file_name = None
                 st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1
                 st.session_state.camera_key_suffix = st.session_state.camera_key_suffix + 1
@@ -109,118 +163,186 @@ with st.container():
 st.divider()
 
 # --- 現在のAIキャラクター・状況表示 ---
-current_persona_info_for_ui = get_current_persona_and_situation_description()
-if current_persona_info_for_ui:
-    lines = current_persona_info_for_ui.splitlines()
-    display_text = lines[0] 
-    situation_summary = ""
-    for line in lines:
-        if "場所：" in line or "雰囲気：" in line: 
-            situation_summary += f" ({line.split('：', 1)[1].strip()})" if '：' in line else f" ({line.strip()})"
-            break 
-    
-    if "エラー：" in display_text or "（" in display_text: 
-        st.info(f"AIの現在の状態: {display_text}")
-    else:
-        char_name_part = display_text.split("名前：",1)[-1].splitlines()[0].strip() if "名前：" in display_text else display_text.strip()
-        st.info(f"AIは現在「{char_name_part}」として応答しようとしています。{situation_summary}")
+persona_status, current_persona = get_current_persona_state(conversation_session)
+if persona_status == PERSONA_STATUS_CHARACTER:
+    situation_summary = current_persona.place or current_persona.mood
+    situation_summary = f" ({situation_summary})" if situation_summary else ""
+    st.info(f"AIは現在「{current_persona.name}」として応答しようとしています。{situation_summary}")
+else:
+    st.info(f"AIの現在の状態: {PERSONA_STATUS_DESCRIPTIONS[persona_status]}")
+
+# --- 同じページに複数のキャラクターがいれば、話し相手を選べるようにする（画像の解析はやり直さない） ---
+character_names, active_character_index = get_character_choices(conversation_session)
+if persona_status == PERSONA_STATUS_CHARACTER and len(character_names) > 1:
+    selected_character_index = st.radio("お話しするキャラクター", range(len(character_names)),
+                                        index=active_character_index, format_func=lambda index: character_names[index],
+                                        horizontal=True)
+    if selected_character_index != active_character_index:
+        switch_character(selected_character_index, conversation_session)
+        st.rerun()
 
 
 # --- ★修正点②: これまでの会話履歴を画面に表示（音声も含む） ---
+# 'incremental'（既定）: 音声を画面に置くのは最新の応答だけにし、古い応答の音声はボタンが押されたときに読み込む。
+#   再実行のたびに全ての音声をブラウザへ送り直さないので、会話が長くなっても再実行の時間と転送量が増えない。
+# 'full': 従来どおり、全ての応答の音声を毎回画面に置く（ベンチマークでの比較用）
+CHAT_RENDER_MODE = os.getenv("CHAT_RENDER_MODE", "incremental")
+
+def render_message_audio(message: dict, autoplay: bool):
+    audio_data = load_message_audio(conversation_session.session_id, message)
+    if audio_data:
+        st.audio(audio_data, format=message.get("audio_format", "audio/wav"), autoplay=autoplay)
+    else:
+        st.caption("（古い音声は保存期間を過ぎたため再生できません）")
+
+# 古い音声の読み込み（「もう一度きく」）では、会話履歴の部分だけを再実行する
+@st.fragment
+def render_chat_history():
+    messages = st.session_state.messages
+    latest_audio_index = max((index for index, message in enumerate(messages) if message.get("audio_blob_id")),
+                             default=None)
+    for index, message in enumerate(messages):
+        with st.chat_message(message["role"]):
+            if message.get("image_thumbnail"): 
+                st.image(message["image_thumbnail"], width=200, caption="あなたが送信した画像")
+            if message.get("text_content"):
+                st.markdown(message["text_content"])
+            # ★追加: メッセージに音声データがあれば再生ボタンを表示
+            if not message.get("audio_blob_id"):
+                continue
+            if CHAT_RENDER_MODE == "full":
+                # ストリーミング再生済みの応答は、再実行時に頭から再生し直さない
+                render_message_audio(message, autoplay=not message.get("audio_played", False))
+            elif index == latest_audio_index:
+                # 自動再生は最初に表示したときの1回だけ
+                render_message_audio(message, autoplay=not message.get("audio_played", False))
+                message["audio_played"] = True
+            elif st.button("🔊 もう一度きく", key=f"load_audio_{index}"):
+                # 押された回の再実行でだけ音声を置く。次の再実行ではボタンに戻り、音声を送り直さない
+                render_message_audio(message, autoplay=True)
+
 st.subheader("ステップ2: 会話してみよう！")
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        if message.get("image_data_for_ui"): 
-            st.image(message["image_data_for_ui"], width=200, caption="あなたが送信した画像")
-        if message.get("text_content"):
-            st.markdown(message["text_content"])
-        # ★追加: メッセージに音声データがあれば再生ボタンを表示
-        if message.get("audio_data"):
-            st.audio(message["audio_data"], format="audio/wav", autoplay=True)
+render_chat_history()
 st.markdown("---")
 
 
+def respond_with_streaming_speech(user_text: str, image_to_send_to_ai, prefetched_greeting=None):
+    """
+    応答を文ごとにストリーミング表示し、音声合成が終わった文から順番に再生する。
+    先読みした挨拶があれば、応答の前にそれを表示・再生する。
+    戻り値はAIのメッセージデータ（全文テキストと、全文をつないだ音声）。
+    """
+    sentences = []
+    pcm_chunks = []
+    play_until = 0.0
+    with st.chat_message("assistant"):
+        text_placeholder = st.empty()
+        audio_placeholder = st.empty()
+        replies = stream_reply_with_speech(user_text, image_to_send_to_ai, session=conversation_session)
+        if prefetched_greeting is not None:
+            replies = itertools.chain([(prefetched_greeting.greeting_text + "\n\n", prefetched_greeting.greeting_pcm)], replies)
+        for sentence, pcm_bytes in replies:
+            sentences.append(sentence)
+            text_placeholder.markdown("".join(sentences))
+            if pcm_bytes:
+                # 前の文の再生が終わるまで待ってから、次の文の音声に差し替える
+                time.sleep(max(0.0, play_until - time.monotonic()))
+                chunk_audio, chunk_format = encode_playback_audio(pcm_bytes)
+                audio_placeholder.audio(chunk_audio, format=chunk_format, autoplay=True)
+                play_until = time.monotonic() + pcm_duration_seconds(pcm_bytes)
+                pcm_chunks.append(pcm_bytes)
+        time.sleep(max(0.0, play_until - time.monotonic()))
+
+    audio_bytes, audio_format = encode_playback_audio(b"".join(pcm_chunks)) if pcm_chunks else (None, None)
+    return make_message(conversation_session.session_id, "assistant", "".join(sentences),
+                        audio_bytes=audio_bytes, audio_format=audio_format, audio_played=True)
+
+
+def handle_user_turn(user_text: str):
+    """テキスト入力・音声入力に共通の1ターン分の処理（応答生成・音声化・履歴追加）。"""
+    require_ai()
+    # このターンの各ステージ（Whisper・ペルソナ・チャット・TTS）を同じターンIDで計測する
+    with tracing.turn():
+        # ユーザーのメッセージを履歴に追加
+        # 履歴にはサムネイルだけを残す（音声はディスク上のBlobStoreに預け、IDだけを持たせる）
+        image_to_send_to_ai = st.session_state.get("image_to_process_on_send", None)
+        selected_image = st.session_state.get("selected_preprocessed_image") if image_to_send_to_ai else None
+        user_message_data_for_ui = make_message(
+            conversation_session.session_id, "user", user_text,
+            thumbnail_bytes=selected_image.thumbnail_bytes if selected_image else None,
+        )
+        st.session_state.messages.append(user_message_data_for_ui)
+
+        # 画像選択時に始めた先読みが終わっていれば（実行中なら待って）、そのペルソナと挨拶をそのまま使う
+        prefetched_greeting = None
+        if image_to_send_to_ai:
+            prefetched_greeting = take_prefetched_greeting(conversation_session, st.session_state.get("selected_image_key"))
+        image_for_reply = image_to_send_to_ai
+        if prefetched_greeting is not None:
+            adopt_prepared_conversation(conversation_session, prefetched_greeting.prepared_session)
+            image_for_reply = None
+
+        if os.getenv("STREAMING_REPLY", "0") == "1":
+            # 応答の生成と文ごとの音声合成を重ねて、最初の音声が出るまでの時間を短くする
+            assistant_message_data = respond_with_streaming_speech(user_text, image_for_reply, prefetched_greeting)
+        else:
+            # AIの応答を取得
+            ai_response_text = get_ai_response(user_prompt=user_text, image_data=image_for_reply, session=conversation_session)
+
+            # 音声をメモリ上で生成し、再生用の形式（WAV または Ogg）にエンコード
+            pcm_bytes = synthesize_speech_with_gemini(ai_response_text, voice_name=conversation_session.voice_name)
+            if prefetched_greeting is not None:
+                # 挨拶と応答を1つのメッセージにまとめ、音声も続けて再生されるようにつなぐ
+                ai_response_text = f"{prefetched_greeting.greeting_text}\n\n{ai_response_text}"
+                if prefetched_greeting.greeting_pcm and pcm_bytes:
+                    pcm_bytes = prefetched_greeting.greeting_pcm + pcm_bytes
+            audio_bytes, audio_format = encode_playback_audio(pcm_bytes) if pcm_bytes else (None, None)
+
+            # --- ★修正点①: AIの応答と音声を履歴に追加 ---
+            assistant_message_data = make_message(conversation_session.session_id, "assistant", ai_response_text,
+                                                  audio_bytes=audio_bytes, audio_format=audio_format)
+
+        # テキストと音声データを含むAIのメッセージを履歴に追加
+        st.session_state.messages.append(assistant_message_data)
+    
+        # このターンでペルソナ設定に画像を使った場合、次のターンでは画像なしで会話を続けられるようにクリア
+        if image_to_send_to_ai:
+            st.session_state.image_to_process_on_send = None
+            st.session_state.selected_preprocessed_image = None
+            st.session_state.selected_image_key = None
+            st.session_state.uploaded_file_name = None
+            st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1
+            st.session_state.camera_key_suffix = st.session_state.camera_key_suffix + 1
+    st.rerun()
+
+
 # --- ユーザーからの新しいメッセージ入力を受け付け ---
 user_input_text = st.chat_input("キャラクターに話しかけてみよう...", key="chat_input_main_text")
 
 if user_input_text:
-    # ユーザーのメッセージを履歴に追加
-    user_message_data_for_ui = {"role": "user", "text_content": user_input_text}
-    image_to_send_to_ai = st.session_state.get("image_to_process_on_send", None)
-    
-    if image_to_send_to_ai:
-        user_message_data_for_ui["image_data_for_ui"] = image_to_send_to_ai
-    
-    st.session_state.messages.append(user_message_data_for_ui)
-    
-    # AIの応答を取得
-    ai_response_text = get_ai_response(user_prompt=user_input_text, image_data=image_to_send_to_ai)
-
-    # --- ★修正点①: AIの応答と音声を履歴に追加 ---
-    assistant_message_data = {"role": "assistant", "text_content": ai_response_text}
-  
-    # 音声生成してファイルに保存
-    wav_path = synthesize_speech_with_gemini_to_wav(ai_response_text, filename="latest_output.wav")
-    
-    # 音声ファイルが正常に生成されたら、その中身を読み込んでメッセージデータに追加
-    if wav_path and os.path.exists(wav_path):
-        with open(wav_path, "rb") as f:
-            audio_bytes = f.read()
-        assistant_message_data["audio_data"] = audio_bytes
-
-    # テキストと音声データを含むAIのメッセージを履歴に追加
-    st.session_state.messages.append(assistant_message_data)
-    
-    # このターンでペルソナ設定に画像を使った場合、次のターンでは画像なしで会話を続けられるようにクリア
-    if image_to_send_to_ai:
-        st.session_state.image_to_process_on_send = None
-        st.session_state.uploaded_file_name = None
-        st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1
-        st.session_state.camera_key_suffix = st.session_state.camera_key_suffix + 1
-    st.rerun()
+    handle_user_turn(user_input_text)
 
 
 # --- 🎤 音声入力で会話するエリア ---
 # --- 🎤 マイクで話しかけるエリア ---
 st.markdown("#### 🎤 マイクで話しかける")
 # マイク録音ボタン（WAVデータが返る）
+from audio_recorder_streamlit import audio_recorder  # マイクのエリアを描画する時点で読み込む
 audio_bytes = audio_recorder()
 if st.button("Save Recording"):
     if audio_bytes is None:
         st.error("まだ録音されていません。")
-    else:
-        with open("recorded_audio.wav", "wb") as f:
-            f.write(audio_bytes)
-        st.success("Recording saved!")
-    model = whisper.load_model("small")
-    result = model.transcribe("recorded_audio.wav")
-    voice_input_text=(result["text"])
-
-    # 👇 ここからはテキスト入力と同じ処理
-    user_message_data_for_ui = {"role": "user", "text_content": voice_input_text}
-    image_to_send_to_ai = st.session_state.get("image_to_process_on_send", None)
-
-    if image_to_send_to_ai:
-        user_message_data_for_ui["image_data_for_ui"] = image_to_send_to_ai
-
-    st.session_state.messages.append(user_message_data_for_ui)
-
-    ai_response_text = get_ai_response(user_prompt=voice_input_text, image_data=image_to_send_to_ai)
-
-    assistant_message_data = {"role": "assistant", "text_content": ai_response_text}
-
-    wav_path = synthesize_speech_with_gemini_to_wav(ai_response_text, filename="latest_output.wav")
-    if wav_path and os.path.exists(wav_path):
-        with open(wav_path, "rb") as f:
-            audio_bytes = f.read()
-        assistant_message_data["audio_data"] = audio_bytes
-        
-
-    st.session_state.messages.append(assistant_message_data)
-
-    if image_to_send_to_ai:
-        st.session_state.image_to_process_on_send = None
-        st.session_state.uploaded_file_name = None
-        st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1
-        st.session_state.camera_key_suffix = st.session_state.camera_key_suffix + 1
-    st.rerun()
+        st.stop()
+    with tracing.turn():
+        # 録音データをファイルに書き出さず、共有Whisperモデルでそのまま文字起こし（ワーカースレッドで、制限時間つき）
+        try:
+            voice_input_text = transcribe_wav_bytes_with_timeout(audio_bytes)
+        except TranscriptionTimeoutError as e:
+            st.warning(f"{e} もう一度、短めに話しかけてみてね。")
+            st.stop()
+        if not voice_input_text.strip():
+            st.warning("うまく聞き取れなかったよ。もう一度話しかけてね！")
+            st.stop()
+
+        # 👇 ここからはテキスト入力と同じ処理
+        handle_user_turn(voice_input_text)
@@ -0,0 +1,108 @@
+import io
+import math
+import os
+import wave
+import numpy as np
+import soundfile as sf
+
+TTS_SAMPLE_RATE = 24000  # Gemini TTSの出力: 24000Hz, 16bit, モノラル
+PCM_BYTES_PER_SECOND = TTS_SAMPLE_RATE * 2
+
+# PLAYBACK_AUDIO_FORMAT の値 -> (soundfileのformat, subtype, MIMEタイプ)
+PLAYBACK_FORMATS = {
+    "ogg-opus": ("OGG", "OPUS", "audio/ogg"),
+    "ogg-vorbis": ("OGG", "VORBIS", "audio/ogg"),
+}
+WAV_MIME_TYPE = "audio/wav"
+
+# リサンプリングの低域通過フィルタ（カイザー窓つきsinc）の設定
+RESAMPLE_ROLLOFF = 0.95        # 通過域の上限（変換前後で低い方のナイキスト周波数に対する割合）
+RESAMPLE_ZERO_CROSSINGS = 16   # sinc関数を片側で何周期ぶん使うか（長いほど急峻で、計算は重い）
+RESAMPLE_KAISER_BETA = 8.6     # 阻止域の減衰（約 -80dB）
+RESAMPLE_CHUNK_SAMPLES = 16384 # 一度に計算する出力サンプル数（メモリ使用量の上限）
+
+
+def pcm_duration_seconds(pcm_bytes: bytes) -> float:
+    """PCMバイト列の再生時間（秒）を返す。"""
+    return len(pcm_bytes) / PCM_BYTES_PER_SECOND
+
+
+def pcm_to_wav_bytes(pcm_bytes: bytes) -> bytes:
+    """PCM（24000Hz, 16bit, モノラル）をWAV形式のバイト列に包む関数。"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)  # 16bit = 2bytes
+        wf.setframerate(TTS_SAMPLE_RATE)
+        wf.writeframes(pcm_bytes)
+    return buffer.getvalue()
+
+
+def pcm_to_float32(pcm_bytes: bytes) -> np.ndarray:
+    """16bit PCMのバイト列を、-1.0〜1.0のfloat32配列に変換する。"""
+    return np.frombuffer(pcm_bytes, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def encode_playback_audio(pcm_bytes: bytes, playback_format: str = None):
+    """
+    ブラウザで再生するための音声データを作る関数。(音声バイト列, MIMEタイプ) を返す。
+    環境変数 'PLAYBACK_AUDIO_FORMAT' に ogg-opus / ogg-vorbis を指定すると、
+    非圧縮のWAVより大幅に小さいOggで送る。エンコードに失敗した場合はWAVにする。
+    """
+    playback_format = (playback_format or os.getenv("PLAYBACK_AUDIO_FORMAT", "wav")).lower()
+    if playback_format in PLAYBACK_FORMATS:
+        container, subtype, mime_type = PLAYBACK_FORMATS[playback_format]
+        try:
+            buffer = io.BytesIO()
+            sf.write(buffer, pcm_to_float32(pcm_bytes), TTS_SAMPLE_RATE, format=container, subtype=subtype)
+            return buffer.getvalue(), mime_type
+        except Exception as e:
+            print(f"音声の {playback_format} エンコードに失敗したため、WAVで送ります: {e}")
+    return pcm_to_wav_bytes(pcm_bytes), WAV_MIME_TYPE
+
+
+def decode_to_mono_float32(audio_bytes: bytes, target_sample_rate: int) -> np.ndarray:
+    """
+    WAVなどの音声バイト列を、指定サンプリングレートのモノラルfloat32配列に変換する関数。
+    一時ファイルやffmpegを経由しない。
+    """
+    samples, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype="float32", always_2d=True)
+    audio = samples.mean(axis=1)  # ステレオ録音の場合はモノラルにまとめる
+
+    if sample_rate != target_sample_rate and len(audio) > 0:
+        audio = resample(audio, sample_rate, target_sample_rate)
+
+    return audio.astype(np.float32)
+
+
+def resample(audio: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+    """
+    帯域制限つきのリサンプリング（カイザー窓つきsincによるポリフェーズ補間）。
+    低い方のナイキスト周波数の RESAMPLE_ROLLOFF 倍より上を落としてから標本化し直すので、
+    録音（44.1kHz / 48kHz）を16kHzにするときに、8kHzより上の音が音声の帯域に折り返さない。
+    """
+    ratio_gcd = math.gcd(source_rate, target_rate)
+    up, down = target_rate // ratio_gcd, source_rate // ratio_gcd
+    cutoff = 0.5 * min(source_rate, target_rate) * RESAMPLE_ROLLOFF  # Hz
+    half_width = int(np.ceil(RESAMPLE_ZERO_CROSSINGS * source_rate / (2.0 * cutoff)))  # 片側のタップ数（入力サンプル）
+    taps = _polyphase_taps(up, half_width, cutoff / source_rate)
+    offsets = np.arange(-half_width + 1, half_width + 1)
+    padded = np.pad(audio.astype(np.float64), (half_width, half_width + 1))
+
+    target_length = int(round(len(audio) * target_rate / source_rate))
+    output = np.empty(target_length, dtype=np.float64)
+    for start in range(0, target_length, RESAMPLE_CHUNK_SAMPLES):
+        numerators = np.arange(start, min(start + RESAMPLE_CHUNK_SAMPLES, target_length), dtype=np.int64) * down
+        centers, phases = np.divmod(numerators, up)                  # 出力サンプルの位置 = centers + phases / up
+        indices = centers[:, None] + offsets[None, :] + half_width   # 各出力サンプルが参照する入力サンプル
+        output[start:start + len(centers)] = np.einsum("ij,ij->i", padded[indices], taps[phases])
+    return output
+
+
+def _polyphase_taps(up: int, half_width: int, normalized_cutoff: float) -> np.ndarray:
+    """位相（0〜up-1）ごとのフィルタ係数の表を作る。形は (up, 2 * half_width)。"""
+    offsets = np.arange(-half_width + 1, half_width + 1)
+    distances = (np.arange(up) / up)[:, None] - offsets[None, :]  # 入力サンプル単位の距離
+    window_position = np.clip(distances / half_width, -1.0, 1.0)
+    window = np.i0(RESAMPLE_KAISER_BETA * np.sqrt(1.0 - window_position ** 2)) / np.i0(RESAMPLE_KAISER_BETA)
+    return 2.0 * normalized_cutoff * np.sinc(2.0 * normalized_cutoff * distances) * window
@@ -0,0 +1,138 @@
+# 会話履歴の表示にかかる、Streamlitの再実行1回あたりのコストを会話の長さごとに計測するベンチマーク。
+#   rerun      : 履歴が入った状態で app.py を再実行したときの時間（Streamlit の AppTest）
+#   media_bytes: その再実行で画面に置かれた音声・画像のバイト数（ブラウザに送られるデータ）
+#   audio      : 画面に置かれた音声の数
+# --replays N を指定すると、計測の前に古い応答 N 件の「もう一度きく」を押しておく（押した後の再実行で音声を送り直さないかを見る）。
+# CHAT_RENDER_MODE の 'full'（全ての音声を毎回置く）と 'incremental'（最新の応答だけ）を比べる。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m benchmarks.bench_rerun --turns 1 10 30 --output benchmarks/results/rerun.json
+#   python -m benchmarks.bench_rerun --turns 30 --replays 0 5 10
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+RENDER_MODES = ["full", "incremental"]
+
+RERUN_PROBE = """
+import json, sys, time
+import session_manager
+# 履歴の音声を事前に用意できるよう、AppTest のセッションIDを固定する
+session_manager.get_current_session_id = lambda: "bench-rerun"
+from audio_buffer import encode_playback_audio
+from message_store import make_message
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.testing.v1 import AppTest
+
+media = {{"bytes": 0}}
+original_add = MediaFileManager.add
+
+def counting_add(self, path_or_data, *args, **kwargs):
+    if isinstance(path_or_data, bytes):
+        media["bytes"] += len(path_or_data)
+    return original_add(self, path_or_data, *args, **kwargs)
+
+MediaFileManager.add = counting_add
+
+audio_bytes, audio_format = encode_playback_audio(bytes(int({reply_seconds} * 24000) * 2))
+messages = []
+for turn in range({turns}):
+    messages.append(make_message("bench-rerun", "user", "このおはなしのつづきをおしえて"))
+    messages.append(make_message("bench-rerun", "assistant", "わあ、すてきだね！" * 3, audio_bytes=audio_bytes,
+                                 audio_format=audio_format, audio_played=True))
+
+app = AppTest.from_file("app.py", default_timeout={timeout})
+app.session_state["messages"] = messages
+app.session_state["intro_played"] = True
+app.run()  # 1回目はモジュールの読み込みを含むので計測しない
+replay_keys = [f"load_audio_{{2 * turn + 1}}" for turn in range({turns} - 1)][:{replays}]
+for key in replay_keys:
+    app.button(key=key).click().run()
+
+samples = []
+for _ in range({repeats}):
+    media["bytes"] = 0
+    started = time.perf_counter()
+    app.run()
+    samples.append(time.perf_counter() - started)
+print(json.dumps({{
+    "seconds": samples,
+    "media_bytes": media["bytes"],
+    "audio": len(app.get("audio")),
+    "exceptions": [str(exception.value) for exception in app.exception],
+}}))
+"""
+
+
+def run_probe(turns: int, mode: str, replays: int, args) -> dict:
+    env = dict(os.environ)
+    env["CHAT_RENDER_MODE"] = mode
+    # 計測中に実際のモデルの読み込みやAPI呼び出しが走らないようにする
+    env.setdefault("WHISPER_PRELOAD", "0")
+    env.setdefault("TTS_PHRASE_BANK_PRERENDER", "0")
+    code = RERUN_PROBE.format(turns=turns, replays=replays, reply_seconds=args.reply_seconds, repeats=args.repeats,
+                              timeout=args.render_timeout)
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True)
+    # アプリのログに混ざらないよう、最後の行だけを結果として読む
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(args) -> dict:
+    results = []
+    for turns in args.turns:
+        for replays in args.replays:
+            for mode in RENDER_MODES:
+                if mode == "full" and replays:
+                    continue  # 'full' には「もう一度きく」ボタンがない
+                probe = run_probe(turns, mode, replays, args)
+                values = np.array(probe["seconds"]) * 1000.0
+                results.append({
+                    "turns": turns,
+                    "replays": replays,
+                    "mode": mode,
+                    "p50_ms": float(np.percentile(values, 50)),
+                    "max_ms": float(values.max()),
+                    "media_bytes": probe["media_bytes"],
+                    "audio": probe["audio"],
+                    "exceptions": probe["exceptions"],
+                })
+    return {"results": results, "config": vars(args)}
+
+
+def print_report(result: dict):
+    print(f"{'ターン数':<8}{'再生済み':<8}{'表示':<14}{'p50(ms)':>10}{'最大(ms)':>10}{'転送量(KB)':>12}{'音声の数':>8}")
+    for row in result["results"]:
+        print(f"{row['turns']:<8}{row.get('replays', 0):<8}{row['mode']:<14}{row['p50_ms']:>10.1f}{row['max_ms']:>10.1f}"
+              f"{row['media_bytes'] / 1024:>12.1f}{row['audio']:>8}")
+        if row["exceptions"]:
+            print(f"{'':<8}実行時の例外: {row['exceptions']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="絵本キャラクターAIチャットの、会話の長さごとの再実行コストのベンチマーク")
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 5, 10, 20, 40], help="履歴に入れる会話のターン数")
+    parser.add_argument("--replays", type=int, nargs="+", default=[0],
+                        help="計測の前に「もう一度きく」を押しておく古い応答の数")
+    parser.add_argument("--reply-seconds", type=float, default=6.0, help="応答1件あたりの音声の長さ（秒）")
+    parser.add_argument("--repeats", type=int, default=5, help="1つの条件あたりの再実行の回数")
+    parser.add_argument("--render-timeout", type=float, default=60.0, help="app.py の1回の実行の制限時間（秒）")
+    parser.add_argument("--output", help="結果を保存するJSONのパス")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    print_report(result)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# アプリの起動の速さを計測するベンチマーク。
+#   import      : app.py が読み込むモジュールを、新しいPythonプロセスでimportするまでの時間と、
+#                 その時点で読み込まれてしまっている重いモジュール（torch・whisper・Gemini SDK）
+#   first_render: 新しいプロセスで app.py を1回実行し（Streamlit の AppTest）、最初の画面ができるまでの時間
+# どちらも毎回新しいプロセスで計測するので、キャッシュの効いていないワーカーの初回表示に近い値になる。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m benchmarks.bench_startup --output benchmarks/results/startup.json
+#   python -m benchmarks.bench_startup --baseline benchmarks/results/startup.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+# app.py が先頭で読み込むモジュール
+APP_MODULES = [
+    "ai_init", "chat_manager", "tts_handler", "speech_pipeline", "audio_buffer", "session_manager",
+    "message_store", "tracing", "image_preprocessor", "prefetch", "transcriber", "warmup",
+]
+# 最初の画面の表示までに読み込まれてほしくない重いモジュール
+HEAVY_MODULES = ["torch", "whisper", "google.generativeai", "google.genai"]
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+FIRST_RENDER_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file("app.py", default_timeout={timeout})
+app.run()
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "seconds": elapsed,
+    "exceptions": [str(exception.value) for exception in app.exception],
+}}))
+"""
+
+
+def run_probe(code: str, env: dict) -> dict:
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True)
+    # アプリのログに混ざらないよう、最後の行だけを結果として読む
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples: list) -> dict:
+    values = np.array(samples) * 1000.0
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "min_ms": float(values.min()),
+        "max_ms": float(values.max()),
+    }
+
+
+def run_benchmark(args) -> dict:
+    env = dict(os.environ)
+    # 計測中に実際のモデルの読み込みやAPI呼び出しが走らないようにする
+    env.setdefault("WHISPER_PRELOAD", "0")
+    env.setdefault("TTS_PHRASE_BANK_PRERENDER", "0")
+
+    results = {}
+    import_runs = [run_probe(IMPORT_PROBE.format(modules=APP_MODULES, heavy=HEAVY_MODULES), env)
+                   for _ in range(args.repeats)]
+    results["import"] = {**summarize([run["seconds"] for run in import_runs]), "loaded": import_runs[-1]["loaded"]}
+
+    if not args.skip_render:
+        render_runs = [run_probe(FIRST_RENDER_PROBE.format(timeout=args.render_timeout), env)
+                       for _ in range(args.repeats)]
+        results["first_render"] = {
+            **summarize([run["seconds"] for run in render_runs]),
+            "exceptions": render_runs[-1]["exceptions"],
+        }
+    return {"stages": results, "config": vars(args)}
+
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"{'計測':<14}{'回数':>6}{'p50(ms)':>12}{'最小(ms)':>12}{'最大(ms)':>12}")
+    for stage, stats in result["stages"].items():
+        line = f"{stage:<14}{stats['count']:>6}{stats['p50_ms']:>12.1f}{stats['min_ms']:>12.1f}{stats['max_ms']:>12.1f}"
+        base_stats = (baseline or {}).get("stages", {}).get(stage)
+        if base_stats and base_stats.get("p50_ms"):
+            change = (stats["p50_ms"] / base_stats["p50_ms"] - 1.0) * 100.0
+            line += f"   （ベースライン比 p50 {change:+.1f}%）"
+        print(line)
+        if "loaded" in stats:
+            print(f"{'':<14}読み込み済みの重いモジュール: {', '.join(stats['loaded']) or 'なし'}")
+        if stats.get("exceptions"):
+            print(f"{'':<14}実行時の例外: {stats['exceptions']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="絵本キャラクターAIチャットの起動時間（import・最初の画面表示）のベンチマーク")
+    parser.add_argument("--repeats", type=int, default=5, help="計測回数（毎回新しいプロセスで実行）")
+    parser.add_argument("--skip-render", action="store_true", help="最初の画面表示の計測を省略する")
+    parser.add_argument("--render-timeout", type=float, default=60.0, help="app.py の1回の実行の制限時間（秒）")
+    parser.add_argument("--output", help="結果を保存するJSONのパス")
+    parser.add_argument("--baseline", help="比較するベースライン結果のJSONのパス")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
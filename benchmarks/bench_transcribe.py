@@ -0,0 +1,153 @@
+# 音声入力の文字起こしの実時間比（処理時間 ÷ 録音の長さ）を、従来の設定と高速化した設定とで比べるベンチマーク。
+#   baseline  : 録音全体を、言語自動判定・温度フォールバックありでそのまま文字起こし（従来の設定）
+#   fast      : 前後の無音を除去し、日本語固定・貪欲デコード
+#   fast_int8 : fast に加えて、int8の動的量子化モデルを使う（CPUのみ）
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m benchmarks.bench_transcribe --audio recordings/*.wav --output benchmarks/results/transcribe.json
+#   python -m benchmarks.bench_transcribe --fake   # Whisperを代替実装にして、無音除去の効果だけを見る
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+from benchmarks.fake_backends import FakeBackendConfig, FakeWhisperModel, install_fake_backends, make_speech_wav_bytes
+import transcriber
+
+# 従来の transcribe() の既定に戻すための設定（fast_decoding_options を上書きする）
+BASELINE_OPTIONS = {
+    "language": None,
+    "temperature": (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+    "condition_on_previous_text": True,
+    "without_timestamps": False,
+}
+
+CONFIGURATIONS = {
+    "baseline": {"trim": False, "quantize": False, "options": BASELINE_OPTIONS},
+    "fast": {"trim": True, "quantize": False, "options": {}},
+    "fast_int8": {"trim": True, "quantize": True, "options": {}},
+}
+
+
+def make_recording(speech_seconds: float, lead_silence: float, tail_silence: float, noise_level: float) -> np.ndarray:
+    """前後に無音（小さなノイズ）がついた、録音ボタンで録ったような16kHzの音声を作る。"""
+    speech = transcriber.wav_bytes_to_whisper_array(make_speech_wav_bytes(speech_seconds))
+    rate = transcriber.WHISPER_SAMPLE_RATE
+    lead = np.random.normal(0.0, noise_level, int(lead_silence * rate)).astype(np.float32)
+    tail = np.random.normal(0.0, noise_level, int(tail_silence * rate)).astype(np.float32)
+    return np.concatenate([lead, speech, tail])
+
+
+def load_recordings(args) -> list:
+    if args.audio:
+        recordings = []
+        for path in args.audio:
+            with open(path, "rb") as f:
+                recordings.append((os.path.basename(path), transcriber.wav_bytes_to_whisper_array(f.read())))
+        return recordings
+    audio = make_recording(args.speech_seconds, args.lead_silence, args.tail_silence, args.noise_level)
+    return [("synthetic", audio)]
+
+
+def run_configuration(name: str, recordings: list, repeats: int, model_size: str) -> dict:
+    settings = CONFIGURATIONS[name]
+    # 初回のモデルロードは計測に含めない
+    transcriber.get_whisper_model(model_size, settings["quantize"])
+    rtfs, latencies, transcripts = [], [], {}
+    for label, audio in recordings:
+        audio_seconds = len(audio) / transcriber.WHISPER_SAMPLE_RATE
+        for repeat in range(repeats + 1):
+            started = time.perf_counter()
+            text = transcriber.transcribe_audio_array(audio, model_size=model_size, quantize=settings["quantize"],
+                                                      trim=settings["trim"], **settings["options"])
+            elapsed = time.perf_counter() - started
+            if repeat == 0:
+                # 1回目はウォームアップとして捨て、結果のテキストだけ残す
+                transcripts[label] = text
+                continue
+            latencies.append(elapsed)
+            rtfs.append(elapsed / audio_seconds)
+    latencies_ms = np.array(latencies) * 1000.0
+    return {
+        "rtf_mean": float(np.mean(rtfs)),
+        "rtf_p50": float(np.percentile(rtfs, 50)),
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        "runs": len(latencies),
+        "transcripts": transcripts,
+    }
+
+
+def run_benchmark(args) -> dict:
+    recordings = load_recordings(args)
+    model_size = args.model_size or transcriber.get_whisper_model_size()
+    names = args.configs or list(CONFIGURATIONS)
+    results = {}
+    log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    config = FakeBackendConfig(whisper_realtime_factor=args.whisper_rtf, jitter=0.0)
+    with install_fake_backends(config, use_real_whisper=not args.fake), log_sink:
+        if args.fake:
+            # 量子化の有無にかかわらず代替モデルを使う
+            for quantize in (False, True):
+                key = transcriber._model_key(model_size, quantize)
+                transcriber._models[key] = FakeWhisperModel(config)
+                transcriber._model_locks[key] = threading.Lock()
+        for name in names:
+            results[name] = run_configuration(name, recordings, args.repeats, model_size)
+    return {
+        "model_size": model_size,
+        "recordings": [{"label": label, "seconds": len(audio) / transcriber.WHISPER_SAMPLE_RATE} for label, audio in recordings],
+        "configurations": results,
+        "config": vars(args),
+    }
+
+
+def print_report(result: dict):
+    print(f"モデル: {result['model_size']}  録音: " +
+          ", ".join(f"{rec['label']}（{rec['seconds']:.1f}秒）" for rec in result["recordings"]))
+    print(f"{'設定':<12}{'実時間比':>10}{'p50(ms)':>12}{'p95(ms)':>12}")
+    baseline = result["configurations"].get("baseline")
+    for name, stats in result["configurations"].items():
+        line = f"{name:<12}{stats['rtf_mean']:>10.3f}{stats['latency_p50_ms']:>12.1f}{stats['latency_p95_ms']:>12.1f}"
+        if baseline and name != "baseline" and baseline["latency_p50_ms"]:
+            line += f"   （baseline比 {baseline['latency_p50_ms'] / stats['latency_p50_ms']:.2f}倍速）"
+        print(line)
+    for name, stats in result["configurations"].items():
+        for label, text in stats["transcripts"].items():
+            print(f"  [{name}] {label}: {text}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="音声入力の文字起こしの実時間比を、設定ごとに比べるベンチマーク")
+    parser.add_argument("--audio", nargs="*", help="文字起こしするWAVファイル（省略時は合成音声）")
+    parser.add_argument("--configs", nargs="*", choices=list(CONFIGURATIONS), help="比べる設定（省略時はすべて）")
+    parser.add_argument("--model-size", help="Whisperのモデルサイズ（省略時は環境変数の設定）")
+    parser.add_argument("--repeats", type=int, default=3, help="1つの録音あたりの計測回数（ウォームアップを除く）")
+    parser.add_argument("--speech-seconds", type=float, default=3.0, help="合成音声の、声の部分の長さ（秒）")
+    parser.add_argument("--lead-silence", type=float, default=1.0, help="合成音声の前につける無音の長さ（秒）")
+    parser.add_argument("--tail-silence", type=float, default=1.5, help="合成音声の後につける無音の長さ（秒）")
+    parser.add_argument("--noise-level", type=float, default=0.002, help="無音部分に加えるノイズの大きさ")
+    parser.add_argument("--fake", action="store_true", help="実際のWhisperではなく代替実装を使う")
+    parser.add_argument("--whisper-rtf", type=float, default=0.3, help="代替Whisperの実時間比")
+    parser.add_argument("--output", help="結果を保存するJSONのパス")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログを表示する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    print_report(result)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
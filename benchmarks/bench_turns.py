@@ -0,0 +1,239 @@
+# 会話ターンのレイテンシをオフラインで計測するベンチマーク。
+# Gemini・Whisperはローカルの代替実装に差し替え、台本どおりの会話を1セッションまたは複数セッション同時に流す。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m benchmarks.bench_turns --sessions 1 --output benchmarks/results/baseline.json
+#   python -m benchmarks.bench_turns --sessions 8 --baseline benchmarks/results/baseline.json
+#   python -m benchmarks.bench_turns --tail-rate 0.05 --error-rate 0.05   # 遅い応答・一時的なエラーを混ぜる
+#   python -m benchmarks.bench_turns --sessions 8 --async   # 非同期API（get_ai_response_async）で1つのイベントループから流す
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from benchmarks.fake_backends import FakeBackendConfig, install_fake_backends, make_speech_wav_bytes
+from call_policy import call_policy_stats
+from chat_manager import get_ai_response, get_ai_response_async
+from session_manager import SessionManager
+from transcriber import transcribe_wav_bytes
+from tts_handler import synthesize_pcm_with_gemini_async, synthesize_speech_with_gemini
+import tracing
+
+DEFAULT_SCRIPT = [
+    "こんにちは！あなたはだれ？",
+    "なにをしているの？",
+    "うさぎさんはなんていうなまえ？",
+    "いっしょにあそぼう！",
+    "このあとどこにいくの？",
+    "またね！",
+]
+
+STAGES = ["whisper", "chat", "tts", "turn"]
+
+
+class StageRecorder:
+    """ステージごとの所要時間（秒）を、複数スレッドから安全に記録する。"""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.samples[stage].append(elapsed)
+
+
+def make_page_image(size: str) -> Image.Image:
+    """ペルソナ生成に渡す、指定サイズのノイズ画像を作る。"""
+    width, height = (int(value) for value in size.lower().split("x"))
+    pixels = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+
+def run_conversation(session, script, page_image, speech_wav, recorder: StageRecorder):
+    """1セッション分の台本を流す。最初のターンだけ画像を送る。"""
+    for turn_index, utterance in enumerate(script):
+        with recorder.measure("turn"), tracing.turn():
+            if speech_wav is not None:
+                with recorder.measure("whisper"):
+                    transcribe_wav_bytes(speech_wav)
+            with recorder.measure("chat"):
+                reply = get_ai_response(utterance, page_image if turn_index == 0 else None, session=session)
+            with recorder.measure("tts"):
+                synthesize_speech_with_gemini(reply, voice_name=session.voice_name)
+
+
+async def run_conversation_async(session, script, page_image, speech_wav, recorder: StageRecorder):
+    """run_conversation の非同期API版。Whisperには非同期APIがないのでスレッドで実行する。"""
+    for turn_index, utterance in enumerate(script):
+        with recorder.measure("turn"), tracing.turn():
+            if speech_wav is not None:
+                with recorder.measure("whisper"):
+                    await asyncio.to_thread(transcribe_wav_bytes, speech_wav)
+            with recorder.measure("chat"):
+                reply = await get_ai_response_async(utterance, page_image if turn_index == 0 else None,
+                                                    session=session)
+            with recorder.measure("tts"):
+                try:
+                    await synthesize_pcm_with_gemini_async(reply, session.voice_name)
+                except Exception as e:
+                    # 同期版（synthesize_speech_with_gemini）と同じく、音声の失敗ではターンを止めない
+                    print(f"❌ 音声生成エラー: {e}")
+
+
+async def run_sessions_async(sessions, script, page_image, speech_wav, recorder: StageRecorder):
+    await asyncio.gather(*(
+        run_conversation_async(session, script, page_image, speech_wav, recorder) for session in sessions
+    ))
+
+
+def summarize(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    values = np.array(samples) * 1000.0
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+
+def peak_rss_mb() -> float:
+    # Linuxでは ru_maxrss はKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_benchmark(args) -> dict:
+    config = FakeBackendConfig(
+        chat_latency=args.chat_latency,
+        vision_latency=args.vision_latency,
+        tts_latency=args.tts_latency,
+        tts_seconds_per_char=args.tts_seconds_per_char,
+        whisper_realtime_factor=args.whisper_rtf,
+        reply_sentences=args.reply_sentences,
+        jitter=args.jitter,
+        tail_rate=args.tail_rate,
+        tail_factor=args.tail_factor,
+        error_rate=args.error_rate,
+    )
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+    page_image = make_page_image(args.image_size)
+    speech_wav = None if args.text_only else make_speech_wav_bytes(args.speech_seconds)
+    recorder = StageRecorder()
+    manager = SessionManager(max_sessions=args.sessions + 1)
+    sessions = [manager.get(f"bench-{index}") for index in range(args.sessions)]
+
+    log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with install_fake_backends(config, use_real_whisper=args.real_whisper, enable_tts_cache=args.tts_cache), log_sink:
+        started = time.perf_counter()
+        if args.use_async:
+            asyncio.run(run_sessions_async(sessions, script, page_image, speech_wav, recorder))
+        else:
+            with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+                futures = [
+                    executor.submit(run_conversation, session, script, page_image, speech_wav, recorder)
+                    for session in sessions
+                ]
+                for future in futures:
+                    future.result()
+        wall_seconds = time.perf_counter() - started
+
+    turns = len(recorder.samples["turn"])
+    return {
+        "sessions": args.sessions,
+        "mode": "async" if args.use_async else "threads",
+        "turns": turns,
+        "wall_seconds": wall_seconds,
+        "throughput_turns_per_second": turns / wall_seconds if wall_seconds else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {stage: summarize(samples) for stage, samples in recorder.samples.items()},
+        "call_policies": call_policy_stats(),
+        "config": vars(args),
+    }
+
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"セッション数: {result['sessions']}（{result.get('mode', 'threads')}）  ターン数: {result['turns']}  "
+          f"経過時間: {result['wall_seconds']:.2f}秒  スループット: {result['throughput_turns_per_second']:.2f} ターン/秒  "
+          f"ピークRSS: {result['peak_rss_mb']:.1f}MB")
+    print(f"{'ステージ':<10}{'件数':>6}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}")
+    for stage, stats in result["stages"].items():
+        if not stats["count"]:
+            continue
+        line = f"{stage:<10}{stats['count']:>6}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}{stats['p99_ms']:>12.1f}"
+        base_stats = (baseline or {}).get("stages", {}).get(stage)
+        if base_stats and base_stats.get("count"):
+            change = (stats["p50_ms"] / base_stats["p50_ms"] - 1.0) * 100.0 if base_stats["p50_ms"] else 0.0
+            line += f"   （ベースライン比 p50 {change:+.1f}%）"
+        print(line)
+    for name, stats in result.get("call_policies", {}).items():
+        counters = "  ".join(f"{key}={value}" for key, value in stats.items() if not key.endswith("_ms"))
+        print(f"呼び出し「{name}」: {counters}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="絵本キャラクターAIチャットの会話ターンのオフラインベンチマーク")
+    parser.add_argument("--sessions", type=int, default=1, help="同時に流すセッション数")
+    parser.add_argument("--script", help="台本（発話の文字列のJSON配列）のパス")
+    parser.add_argument("--image-size", default="3024x4032", help="1ターン目に送る画像のサイズ（幅x高さ）")
+    parser.add_argument("--speech-seconds", type=float, default=3.0, help="音声入力1回あたりの長さ（秒）")
+    parser.add_argument("--text-only", action="store_true", help="音声入力（Whisper）を使わない")
+    parser.add_argument("--real-whisper", action="store_true", help="代替ではなく実際のWhisperモデルを使う")
+    parser.add_argument("--tts-cache", action="store_true", help="TTSキャッシュを有効にする")
+    parser.add_argument("--chat-latency", type=float, default=0.6)
+    parser.add_argument("--vision-latency", type=float, default=2.0)
+    parser.add_argument("--tts-latency", type=float, default=1.2)
+    parser.add_argument("--tts-seconds-per-char", type=float, default=0.15)
+    parser.add_argument("--whisper-rtf", type=float, default=0.3, help="代替Whisperの実時間比")
+    parser.add_argument("--reply-sentences", type=int, default=2)
+    parser.add_argument("--jitter", type=float, default=0.2, help="待ち時間のばらつき（割合）")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="待ち時間が --tail-factor 倍になる呼び出しの割合")
+    parser.add_argument("--tail-factor", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="一時的なエラー（503）を返す呼び出しの割合")
+    parser.add_argument("--output", help="結果を保存するJSONのパス")
+    parser.add_argument("--baseline", help="比較するベースライン結果のJSONのパス")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="スレッドの代わりに非同期API（get_ai_response_async など）で全セッションを流す")
+    parser.add_argument("--trace", action="store_true", help="ステージ計測（tracing）を有効にして実行する")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログを表示する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.trace:
+        tracing.set_enabled(True)
+    result = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+# ベンチマーク用の、Gemini（チャット・画像・TTS）とWhisperのローカル代替実装。
+# 実際のAPIを呼ばず、設定した待ち時間とデータ量だけを再現する。
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+import numpy as np
+import soundfile as sf
+import ai_init
+import persona_cache
+import transcriber
+import tts_cache
+import tts_handler
+
+# 構造化出力（JSONモード）での、ページの全キャラクターと共通の場面の応答
+FAKE_CHARACTER_SET_JSON = json.dumps({
+    "characters": [
+        {
+            "name": "はなこ",
+            "gender": "女性",
+            "appearance": "赤いワンピースを着た元気な女の子",
+            "personality": "明るくて好奇心いっぱい",
+            "speech_style": "「～だよ！」",
+            "role": "一緒に遊ぶ友達",
+            "action": "お花を摘んでいる",
+        },
+        {
+            "name": "たろう",
+            "gender": "男性",
+            "appearance": "麦わら帽子をかぶった男の子",
+            "personality": "のんびりやさしい",
+            "speech_style": "「～だね」",
+            "role": "物語の案内役",
+            "action": "うさぎをなでている",
+        },
+    ],
+    "place": "お花畑",
+    "others": "白いうさぎ",
+    "mood": "明るく楽しい",
+}, ensure_ascii=False)
+
+FAKE_REPLY_SENTENCE = "わあ、すてきだね！"
+
+
+class FakeBackendConfig:
+    """代替バックエンドの待ち時間（秒）とデータ量の設定。"""
+
+    def __init__(self, chat_latency=0.6, vision_latency=2.0, tts_latency=1.2, tts_seconds_per_char=0.15,
+                 whisper_realtime_factor=0.3, reply_sentences=2, jitter=0.2, tail_rate=0.0, tail_factor=5.0,
+                 error_rate=0.0):
+        self.chat_latency = chat_latency
+        self.vision_latency = vision_latency
+        self.tts_latency = tts_latency
+        self.tts_seconds_per_char = tts_seconds_per_char
+        self.whisper_realtime_factor = whisper_realtime_factor
+        self.reply_sentences = reply_sentences
+        self.jitter = jitter
+        self.tail_rate = tail_rate  # 待ち時間が tail_factor 倍になる（遅い応答の裾）割合
+        self.tail_factor = tail_factor
+        self.error_rate = error_rate  # 一時的なエラー（503）を返す割合
+
+    def sleep_time(self, base: float) -> float:
+        """基準の待ち時間に、±jitter の割合でばらつきを加える。tail_rate の割合で tail_factor 倍にする。"""
+        if random.random() < self.tail_rate:
+            base *= self.tail_factor
+        return max(0.0, base * (1.0 + random.uniform(-self.jitter, self.jitter)))
+
+    def maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise FakeServiceUnavailable("代替バックエンドの一時的なエラー")
+
+
+class FakeServiceUnavailable(Exception):
+    """APIの一時的なエラー（HTTP 503）の代替。"""
+    code = 503
+
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Content:
+    def __init__(self, role, text):
+        self.role = role
+        self.parts = [_Part(text)]
+
+
+class _UsageMetadata:
+    def __init__(self, prompt_token_count):
+        self.prompt_token_count = prompt_token_count
+
+
+class _TextResponse:
+    def __init__(self, text, prompt_token_count=0):
+        self.text = text
+        self.usage_metadata = _UsageMetadata(prompt_token_count)
+
+    def __iter__(self):
+        # ストリーミング時は、文ごとの断片として返す
+        for sentence in self.text.split("！"):
+            if sentence:
+                yield _TextResponse(sentence + "！")
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text)
+
+
+class FakeChatSession:
+    """google.generativeai の ChatSession の代替。"""
+
+    def __init__(self, config: FakeBackendConfig, system_instruction: str, history=None):
+        self.config = config
+        self.system_instruction = system_instruction or ""
+        self.history = list(history or [])
+
+    def _reply(self, message: str) -> _TextResponse:
+        prompt_tokens = _estimate_tokens(self.system_instruction) + _estimate_tokens(message) + sum(
+            _estimate_tokens(part.text) for content in self.history for part in content.parts
+        )
+        text = FAKE_REPLY_SENTENCE * self.config.reply_sentences
+        self.history.append(_Content("user", message))
+        self.history.append(_Content("model", text))
+        return _TextResponse(text, prompt_tokens)
+
+    def send_message(self, message, stream=False, request_options=None):
+        time.sleep(self.config.sleep_time(self.config.chat_latency))
+        self.config.maybe_fail()
+        return self._reply(message)
+
+    async def send_message_async(self, message, request_options=None):
+        await asyncio.sleep(self.config.sleep_time(self.config.chat_latency))
+        self.config.maybe_fail()
+        return self._reply(message)
+
+
+class FakeGenerativeModel:
+    """google.generativeai の GenerativeModel の代替（画像からのペルソナ生成と要約）。"""
+
+    def __init__(self, config: FakeBackendConfig, system_instruction: str = None):
+        self.config = config
+        self.system_instruction = system_instruction
+
+    def _generate(self, contents) -> _TextResponse:
+        is_vision_call = isinstance(contents, list) and len(contents) > 1
+        return _TextResponse(FAKE_CHARACTER_SET_JSON if is_vision_call else "これまでの会話の要約です。")
+
+    def _latency(self, contents) -> float:
+        is_vision_call = isinstance(contents, list) and len(contents) > 1
+        return self.config.sleep_time(self.config.vision_latency if is_vision_call else self.config.chat_latency)
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self._latency(contents))
+        self.config.maybe_fail()
+        return self._generate(contents)
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(self._latency(contents))
+        self.config.maybe_fail()
+        return self._generate(contents)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self.config, self.system_instruction, history)
+
+
+class _InlineData:
+    def __init__(self, data):
+        self.data = data
+
+
+class _AudioResponse:
+    def __init__(self, pcm_bytes):
+        part = type("Part", (), {"inline_data": _InlineData(base64.b64encode(pcm_bytes))})()
+        content = type("Content", (), {"parts": [part]})()
+        self.candidates = [type("Candidate", (), {"content": content})()]
+
+
+class _FakeModels:
+    def __init__(self, config: FakeBackendConfig):
+        self.config = config
+
+    def _pcm_for(self, contents: str) -> bytes:
+        seconds = len(contents) * self.config.tts_seconds_per_char
+        return bytes(int(seconds * 24000) * 2)
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.config.sleep_time(self.config.tts_latency))
+        self.config.maybe_fail()
+        return _AudioResponse(self._pcm_for(contents))
+
+
+class _FakeAsyncModels(_FakeModels):
+    async def generate_content(self, model, contents, config=None):
+        await asyncio.sleep(self.config.sleep_time(self.config.tts_latency))
+        self.config.maybe_fail()
+        return _AudioResponse(self._pcm_for(contents))
+
+
+class FakeGenaiClient:
+    """google.genai の Client の代替（TTS）。"""
+
+    def __init__(self, config: FakeBackendConfig):
+        self.models = _FakeModels(config)
+        self.aio = type("Aio", (), {"models": _FakeAsyncModels(config)})()
+
+
+class FakeWhisperModel:
+    """Whisperモデルの代替。音声の長さ × 実時間比だけ待って固定の文を返す。"""
+
+    def __init__(self, config: FakeBackendConfig):
+        self.config = config
+        self.device = type("Device", (), {"type": "cpu"})()
+
+    def transcribe(self, audio, **options):
+        duration = len(audio) / transcriber.WHISPER_SAMPLE_RATE
+        time.sleep(self.config.sleep_time(duration * self.config.whisper_realtime_factor))
+        return {"text": "このおはなしのつづきをおしえて"}
+
+
+def make_speech_wav_bytes(seconds: float, sample_rate: int = 44100) -> bytes:
+    """Whisperに渡すための、指定秒数の合成音声（WAV）を作る。"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.2 * np.sin(2 * np.pi * 220 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t))
+    buffer = io.BytesIO()
+    sf.write(buffer, samples.astype(np.float32), sample_rate, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def install_fake_backends(config: FakeBackendConfig, use_real_whisper: bool = False, enable_tts_cache: bool = False):
+    """
+    ai_init.model・チャットセッション・TTS用Client・Whisperモデルを代替実装に差し替えるコンテキストマネージャー。
+    キャッシュは一時ディレクトリに作り、終了時に元に戻す。
+    """
+    saved = {
+        "model": ai_init.model,
+        "create_model": ai_init.create_model,
+        "get_genai_client": tts_handler.get_genai_client,
+        "persona_cache": persona_cache._default_cache,
+        "tts_cache": tts_cache._default_cache,
+        "whisper_models": dict(transcriber._models),
+        "whisper_locks": dict(transcriber._model_locks),
+    }
+    fake_client = FakeGenaiClient(config)
+    with tempfile.TemporaryDirectory(prefix="storybook-bench-") as tmp_dir:
+        ai_init.model = FakeGenerativeModel(config)
+        ai_init.create_model = lambda system_instruction=None: FakeGenerativeModel(config, system_instruction)
+        tts_handler.get_genai_client = lambda: fake_client
+        persona_cache._default_cache = persona_cache.PersonaCache(path=f"{tmp_dir}/persona.sqlite3")
+        if enable_tts_cache:
+            tts_cache._default_cache = tts_cache.TTSCache(cache_dir=f"{tmp_dir}/tts")
+        else:
+            tts_cache._default_cache = tts_cache.TTSCache(cache_dir=f"{tmp_dir}/tts", memory_max_bytes=0,
+                                                          disk_max_bytes=0)
+        if not use_real_whisper:
+            key = transcriber._model_key(transcriber.get_whisper_model_size(), transcriber.use_int8_quantization())
+            transcriber._models[key] = FakeWhisperModel(config)
+            transcriber._model_locks[key] = threading.Lock()
+        try:
+            yield
+        finally:
+            ai_init.model = saved["model"]
+            ai_init.create_model = saved["create_model"]
+            tts_handler.get_genai_client = saved["get_genai_client"]
+            persona_cache._default_cache = saved["persona_cache"]
+            tts_cache._default_cache = saved["tts_cache"]
+            transcriber._models.clear()
+            transcriber._models.update(saved["whisper_models"])
+            transcriber._model_locks.clear()
+            transcriber._model_locks.update(saved["whisper_locks"])
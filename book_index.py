@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from PIL import Image
+from persona_cache import DEFAULT_MAX_HASH_DISTANCE, compute_image_hash, hash_distance
+from persona_schema import CharacterSet
+
+DEFAULT_INDEX_PATH = os.path.join("cache", "book_index.sqlite3")
+DEFAULT_AUDIO_DIR = os.path.join("cache", "book_audio")
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def format_image_hash(image_data: Image.Image) -> str:
+    """インデックスのキーにする、画像の知覚ハッシュ（16進16桁）を返す。"""
+    return format(compute_image_hash(image_data), "016x")
+
+
+class BookIndex:
+    """
+    絵本のページごとに前処理した結果（全キャラクターのペルソナ・最初の挨拶・その音声）を保存する永続インデックス。
+    キーは画像の知覚ハッシュで、アプリでは撮影ブレなどがあっても同じページとして引ける。
+    挨拶の音声（PCM）は audio_dir にファイルとして置き、SQLiteにはパスだけを記録する。
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH, audio_dir: str = DEFAULT_AUDIO_DIR,
+                 max_distance: int = DEFAULT_MAX_HASH_DISTANCE):
+        self.path = path
+        self.audio_dir = audio_dir
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        os.makedirs(audio_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                   image_hash TEXT PRIMARY KEY,
+                   book TEXT NOT NULL,
+                   page TEXT NOT NULL,
+                   status TEXT NOT NULL,
+                   persona_json TEXT,  -- キャラクターセット（CharacterSet.to_dict()）のJSON
+                   greeting_text TEXT,
+                   voice_name TEXT,
+                   audio_path TEXT,
+                   error TEXT,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   updated_at REAL NOT NULL
+               )"""
+        )
+        self._conn.commit()
+
+    def is_done(self, image_hash: str) -> bool:
+        """そのページの前処理が完了済みかどうかを返す（中断後の再開で使う）。"""
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM pages WHERE image_hash = ?", (image_hash,)).fetchone()
+        return row is not None and row[0] == STATUS_DONE
+
+    def get(self, image_data: Image.Image):
+        """
+        画像に近いページの前処理結果を辞書で返す。なければ None を返す。
+        辞書のキーは character_set（CharacterSet）, greeting_text, voice_name, greeting_pcm（音声がなければ None）, book, page。
+        """
+        image_hash = compute_image_hash(image_data)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT image_hash, book, page, persona_json, greeting_text, voice_name, audio_path FROM pages WHERE status = ?",
+                (STATUS_DONE,),
+            ).fetchall()
+
+        best_row, best_distance = None, None
+        for row in rows:
+            distance = hash_distance(image_hash, int(row[0], 16))
+            if distance <= self.max_distance and (best_distance is None or distance < best_distance):
+                best_row, best_distance = row, distance
+                if distance == 0:
+                    break
+        if best_row is None:
+            return None
+
+        _, book, page, persona_json, greeting_text, voice_name, audio_path = best_row
+        try:
+            character_set = CharacterSet.from_dict(json.loads(persona_json))
+        except ValueError as e:
+            print(f"前処理済みのページ（{book} / {page}）のキャラクターを読み込めません。前処理をやり直してください: {e}")
+            return None
+        greeting_pcm = None
+        if audio_path and os.path.exists(audio_path):
+            with open(audio_path, "rb") as f:
+                greeting_pcm = f.read()
+        print(f"前処理済みの絵本のページが見つかりました: {book} / {page}（ハッシュ距離: {best_distance}）")
+        return {
+            "character_set": character_set,
+            "greeting_text": greeting_text,
+            "voice_name": voice_name,
+            "greeting_pcm": greeting_pcm,
+            "book": book,
+            "page": page,
+        }
+
+    def put(self, image_hash: str, book: str, page: str, character_set: CharacterSet, greeting_text: str,
+            voice_name: str, greeting_pcm: bytes, attempts: int = 1):
+        """ページの前処理結果を保存する。音声は先にファイルへ書き出してから記録する。"""
+        audio_path = None
+        if greeting_pcm:
+            audio_path = os.path.join(self.audio_dir, f"{image_hash}.pcm")
+            tmp_path = f"{audio_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(greeting_pcm)
+            os.replace(tmp_path, audio_path)
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO pages
+                   (image_hash, book, page, status, persona_json, greeting_text, voice_name, audio_path, error, attempts, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)""",
+                (image_hash, book, page, STATUS_DONE, json.dumps(character_set.to_dict(), ensure_ascii=False), greeting_text,
+                 voice_name, audio_path, attempts, time.time()),
+            )
+            self._conn.commit()
+
+    def mark_failed(self, image_hash: str, book: str, page: str, error: str, attempts: int):
+        """前処理に失敗したページを記録する（次回の実行で再試行される）。"""
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO pages (image_hash, book, page, status, error, attempts, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (image_hash, book, page, STATUS_FAILED, error, attempts, time.time()),
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """状態ごとのページ数を返す。"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM pages GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_book_index() -> BookIndex:
+    """環境変数の設定で作られた、プロセス内共有の絵本インデックスを返す。"""
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = BookIndex(
+                path=os.getenv("BOOK_INDEX_PATH", DEFAULT_INDEX_PATH),
+                audio_dir=os.getenv("BOOK_INDEX_AUDIO_DIR", DEFAULT_AUDIO_DIR),
+                max_distance=int(os.getenv("BOOK_INDEX_MAX_DISTANCE", DEFAULT_MAX_HASH_DISTANCE)),
+            )
+        return _default_index
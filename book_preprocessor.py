@@ -0,0 +1,210 @@
+# 絵本1冊ぶんのページ画像を、読み聞かせの前にまとめて前処理するコマンド。
+# ページごとに全キャラクターのペルソナ生成・最初の挨拶・その音声化を行い、結果を画像のハッシュをキーにした
+# インデックス（book_index.py）に保存する。アプリはページが選ばれた時点でここから即座に読み込む。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python book_preprocessor.py books/momotaro --workers 4 --requests-per-minute 30
+# 途中で中断しても、もう一度同じコマンドを実行すれば完了済みのページを飛ばして続きから処理する。
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ai_init import initialize_ai
+from book_index import get_book_index, format_image_hash
+from call_policy import get_call_policy
+from chat_manager import get_ai_response
+from image_preprocessor import preprocess_image
+from persona_cache import get_persona_cache
+from persona_extractor import generate_character_set_from_image
+from session_manager import ConversationSession
+from tts_handler import synthesize_pcm_with_gemini
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+DEFAULT_WORKERS = 4
+DEFAULT_REQUESTS_PER_MINUTE = 30
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_SECONDS = 2.0
+CALL_POLICY_NAMES = ["vision", "chat", "tts"]
+
+
+class PagePreprocessError(RuntimeError):
+    """ページの前処理（ペルソナ生成・挨拶・音声化）のいずれかに失敗したときに送出される例外。"""
+
+
+class RateLimiter:
+    """
+    APIの呼び出し回数を1分あたりの上限に収めるためのレートリミッター。
+    全ワーカーで共有し、呼び出しの間隔が 60 / requests_per_minute 秒以上空くように待たせる。
+    """
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._next_time - now)
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait:
+            time.sleep(wait)
+
+
+def use_single_request_policies():
+    """
+    前処理で使う呼び出し（ペルソナ生成・挨拶・音声化）の、CallPolicy による再試行とヘッジを止める。
+    再試行は with_retries が RateLimiter を通して行うので、1回の試行でAPIへ送る要求を1つにして、
+    --requests-per-minute が実際の要求の数の上限になるようにする。
+    """
+    for name in CALL_POLICY_NAMES:
+        policy = get_call_policy(name)
+        policy.max_attempts = 1
+        policy.hedge_percentile = 0
+
+
+def find_page_images(directory: str) -> list:
+    """ディレクトリ内のページ画像を、ファイル名順に返す。"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(directory, name) for name in names]
+
+
+def with_retries(step: str, function, max_attempts: int, retry_base_seconds: float):
+    """
+    function を呼び、例外が出たら指数バックオフで再試行する。
+    (戻り値, 試行回数) を返し、最後まで失敗した場合は PagePreprocessError を送出する。
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return function(), attempt
+        except Exception as e:
+            if attempt == max_attempts:
+                raise PagePreprocessError(f"{step}に{max_attempts}回失敗しました: {e}") from e
+            wait = retry_base_seconds * (2 ** (attempt - 1))
+            print(f"{step}に失敗したため、{wait:.0f}秒後に再試行します（{attempt}/{max_attempts}）: {e}")
+            time.sleep(wait)
+
+
+def preprocess_page(image, limiter: RateLimiter, max_attempts: int, retry_base_seconds: float):
+    """
+    1ページ分の前処理。(キャラクターセット, 挨拶のテキスト, 声, 挨拶のPCM, 試行回数の合計) を返す。
+    挨拶は先頭のキャラクターのもの。他のキャラクターへの切り替えはアプリ側でモデルを呼ばずに行う。
+    """
+    def extract_characters():
+        limiter.acquire()
+        return generate_character_set_from_image(image)
+
+    character_set, persona_attempts = with_retries("ペルソナ生成", extract_characters, max_attempts, retry_base_seconds)
+    # ライブの経路（画像をそのまま送った場合）でも同じ結果を使えるよう、ペルソナキャッシュにも入れておく
+    get_persona_cache().put(image, character_set.to_dict())
+
+    def generate_greeting():
+        limiter.acquire()
+        session = ConversationSession("book-preprocessor")
+        greeting = get_ai_response(user_prompt="", image_data=image, session=session,
+                                   character_set=character_set)
+        if session.chat_session is None or not session.chat_session.history:
+            raise PagePreprocessError(greeting)
+        return greeting, session.voice_name
+
+    (greeting_text, voice_name), greeting_attempts = with_retries("挨拶の生成", generate_greeting, max_attempts,
+                                                                  retry_base_seconds)
+
+    def synthesize_greeting():
+        limiter.acquire()
+        return synthesize_pcm_with_gemini(greeting_text, voice_name)
+
+    greeting_pcm, tts_attempts = with_retries("挨拶の音声化", synthesize_greeting, max_attempts, retry_base_seconds)
+    return character_set, greeting_text, voice_name, greeting_pcm, persona_attempts + greeting_attempts + tts_attempts
+
+
+def process_page(path: str, book: str, limiter: RateLimiter, args) -> str:
+    """ページ画像を1枚処理してインデックスに保存する。'done'・'skipped'・'failed' のいずれかを返す。"""
+    index = get_book_index()
+    page = os.path.basename(path)
+    with open(path, "rb") as f:
+        image = preprocess_image(f.read()).image
+    image_hash = format_image_hash(image)
+    if not args.force and index.is_done(image_hash):
+        return "skipped"
+    try:
+        character_set, greeting_text, voice_name, greeting_pcm, attempts = preprocess_page(
+            image, limiter, args.max_attempts, args.retry_base_seconds
+        )
+    except PagePreprocessError as e:
+        index.mark_failed(image_hash, book, page, str(e), args.max_attempts)
+        print(f"ページ「{page}」の前処理に失敗しました: {e}")
+        return "failed"
+    index.put(image_hash, book, page, character_set, greeting_text, voice_name, greeting_pcm, attempts)
+    return "done"
+
+
+def run(args) -> dict:
+    pages = find_page_images(args.directory)
+    book = args.book or os.path.basename(os.path.normpath(args.directory))
+    limiter = RateLimiter(args.requests_per_minute)
+    use_single_request_policies()
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    print(f"絵本「{book}」の {len(pages)} ページを前処理します（ワーカー数: {args.workers}、"
+          f"1分あたり最大 {args.requests_per_minute} リクエスト）。")
+
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(process_page, path, book, limiter, args): path for path in pages}
+        for finished, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f"ページ「{os.path.basename(path)}」の処理中に予期しないエラーが発生しました: {e}")
+                status = "failed"
+            counts[status] += 1
+            elapsed_minutes = (time.perf_counter() - started) / 60.0
+            pages_per_minute = counts["done"] / elapsed_minutes if elapsed_minutes else 0.0
+            print(f"[{finished}/{len(pages)}] {os.path.basename(path)}: {status}"
+                  f"（{pages_per_minute:.1f} ページ/分）")
+    except KeyboardInterrupt:
+        print("中断しました。完了したページは保存済みなので、同じコマンドで続きから再開できます。")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    elapsed_minutes = (time.perf_counter() - started) / 60.0
+    pages_per_minute = counts["done"] / elapsed_minutes if elapsed_minutes else 0.0
+    print(f"完了: {counts['done']} ページ、スキップ（処理済み）: {counts['skipped']} ページ、失敗: {counts['failed']} ページ")
+    print(f"経過時間: {elapsed_minutes:.1f}分  処理速度: {pages_per_minute:.1f} ページ/分")
+    print(f"インデックスの状況: {get_book_index().stats()}")
+    return {**counts, "elapsed_minutes": elapsed_minutes, "pages_per_minute": pages_per_minute}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="絵本のページ画像をまとめて前処理し、ペルソナと挨拶の音声を用意する")
+    parser.add_argument("directory", help="ページ画像（jpg/png/webp）が入ったディレクトリ")
+    parser.add_argument("--book", help="絵本の名前（省略時はディレクトリ名）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同時に処理するページ数")
+    parser.add_argument("--requests-per-minute", type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help="Gemini APIを呼ぶ回数の上限（1分あたり、0で無制限）")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="各ステップの最大試行回数")
+    parser.add_argument("--retry-base-seconds", type=float, default=DEFAULT_RETRY_BASE_SECONDS,
+                        help="再試行までの待ち時間の基準（試行ごとに2倍）")
+    parser.add_argument("--force", action="store_true", help="処理済みのページもやり直す")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.directory):
+        print(f"ディレクトリが見つかりません: {args.directory}")
+        return 1
+    if not initialize_ai():
+        print("AIの初期化に失敗しました。環境変数 'GEMINI_API_KEY' を確認してください。")
+        return 1
+    result = run(args)
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
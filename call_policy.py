@@ -0,0 +1,390 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import tracing
+
+# 再試行してよい一時的なエラー（HTTPステータス / SDKの例外クラス名）
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = {
+    "DeadlineExceeded", "ServiceUnavailable", "ResourceExhausted", "InternalServerError", "TooManyRequests",
+    "ServerError", "Aborted",
+}
+
+DEFAULT_WORKERS = 16
+LATENCY_WINDOW = 200  # ヘッジの判定に使う、直近の成功した呼び出しの件数
+
+# 呼び出しの種類ごとの既定値。環境変数 'CALL_POLICY_<種類>_<項目>' で変更できる（例: CALL_POLICY_TTS_DEADLINE_SECONDS）
+DEFAULT_POLICIES = {
+    # チャットは送信のたびに履歴が変わるので、ヘッジ（同じ要求の二重送信）はせず、SDKのタイムアウトで打ち切る
+    "chat": {"deadline_seconds": 25.0, "attempt_timeout_seconds": 12.0, "max_attempts": 3, "hedge_percentile": 0,
+             "idempotent": False, "circuit_breaker": False},
+    "vision": {"deadline_seconds": 40.0, "attempt_timeout_seconds": 20.0, "max_attempts": 3, "hedge_percentile": 95,
+               "idempotent": True, "circuit_breaker": False},
+    "tts": {"deadline_seconds": 30.0, "attempt_timeout_seconds": 15.0, "max_attempts": 2, "hedge_percentile": 95,
+            "idempotent": True, "circuit_breaker": True},
+}
+DEFAULT_BACKOFF_BASE_SECONDS = 0.5
+DEFAULT_BACKOFF_MAX_SECONDS = 4.0
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET_SECONDS = 30.0
+
+_executor = None
+_policies = {}
+_registry_lock = threading.Lock()
+
+
+class CallTimeoutError(TimeoutError):
+    """呼び出しが期限内に終わらなかったときに送出される例外。"""
+
+
+class CircuitOpenError(RuntimeError):
+    """失敗が続いているため、呼び出しを行わずに打ち切ったときに送出される例外。"""
+
+
+def _percentile(samples, percentile: float) -> float:
+    """線形補間によるパーセンタイル（numpy.percentile の既定と同じ方法）。"""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * percentile / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """時間をおいて再試行すれば成功する見込みのあるエラーかどうかを返す。"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if callable(code):  # grpc の例外は code() がメソッド
+        code = None
+    if isinstance(code, int) and code in TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ in TRANSIENT_ERROR_NAMES
+
+
+class CircuitBreaker:
+    """
+    連続して failure_threshold 回失敗したら「開」にし、reset_seconds の間は呼び出しを止める。
+    時間が経ったら1回だけ試し（半開）、成功すれば元に戻す。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_BREAKER_FAILURES,
+                 reset_seconds: float = DEFAULT_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_progress:
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"「{self.name}」の呼び出しが回復しました。")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"「{self.name}」の呼び出しが{self._failures}回続けて失敗したため、"
+                          f"{self.reset_seconds:.0f}秒間呼び出しを止めます。")
+                    tracing.count("storybook_circuit_open_total", self.name)
+                self._opened_at = time.monotonic()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _registry_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("CALL_POLICY_WORKERS", DEFAULT_WORKERS)),
+                thread_name_prefix="gemini-call",
+            )
+        return _executor
+
+
+class CallPolicy:
+    """
+    Gemini APIの呼び出しに、期限・一時的なエラーの再試行（ジッターつき指数バックオフ）・ヘッジ・サーキットブレーカーをかける。
+    call() には「1回の試行に使える秒数」を受け取って呼び出しを行う関数を渡す。
+
+    idempotent な呼び出し（画像からのペルソナ生成・TTS）はワーカースレッドで実行し、期限を過ぎたら結果を待たずに打ち切る。
+    直近の所要時間の hedge_percentile パーセンタイルを過ぎても終わらなければ、同じ要求をもう1つ送り、先に返った方を使う。
+    idempotent でない呼び出し（チャット）は呼び出し元のスレッドで実行し、期限は関数に渡す秒数（SDKのタイムアウト）で守る。
+    """
+
+    def __init__(self, name: str, deadline_seconds: float, attempt_timeout_seconds: float = None,
+                 max_attempts: int = 3, hedge_percentile: float = 0, idempotent: bool = True,
+                 circuit_breaker: CircuitBreaker = None, backoff_base_seconds: float = DEFAULT_BACKOFF_BASE_SECONDS,
+                 backoff_max_seconds: float = DEFAULT_BACKOFF_MAX_SECONDS,
+                 hedge_min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES):
+        self.name = name
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout_seconds = attempt_timeout_seconds or deadline_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_percentile = hedge_percentile
+        self.idempotent = idempotent
+        self.circuit_breaker = circuit_breaker
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0, "failures": 0,
+                          "rejected": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str, metric: str):
+        with self._lock:
+            self._counters[counter] += 1
+        tracing.count(metric, self.name)
+
+    def _record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def latency_percentile(self, percentile: float):
+        """直近の成功した呼び出しの所要時間のパーセンタイル（秒）。件数が足りなければ None。"""
+        with self._lock:
+            samples = list(self._latencies)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return _percentile(samples, percentile)
+
+    def _hedge_delay(self):
+        if not self.idempotent or not self.hedge_percentile:
+            return None
+        return self.latency_percentile(self.hedge_percentile)
+
+    def _backoff_seconds(self, attempt: int) -> float:
+        # 上限つきの指数バックオフに、同時に再試行が集中しないようジッター（半分〜全体）を加える
+        cap = min(self.backoff_max_seconds, self.backoff_base_seconds * (2 ** (attempt - 1)))
+        return random.uniform(cap / 2, cap)
+
+    def _begin(self) -> float:
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            self._count("rejected", "storybook_call_rejected_total")
+            raise CircuitOpenError(f"「{self.name}」は失敗が続いているため、一時的に呼び出しを止めています。")
+        self._count("calls", "storybook_calls_total")
+        return time.monotonic() + self.deadline_seconds
+
+    def _on_failure(self, error: Exception, attempt: int, deadline: float):
+        """失敗を記録し、再試行するなら待つ秒数を、しないなら None を返す。"""
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_failure()
+        if isinstance(error, CallTimeoutError):
+            self._count("timeouts", "storybook_call_timeouts_total")
+        if not is_transient_error(error) or attempt >= self.max_attempts:
+            self._count("failures", "storybook_call_failures_total")
+            return None
+        delay = self._backoff_seconds(attempt)
+        if time.monotonic() + delay >= deadline:
+            self._count("failures", "storybook_call_failures_total")
+            return None
+        self._count("retries", "storybook_call_retries_total")
+        print(f"「{self.name}」の呼び出しに失敗したため、{delay:.1f}秒後に再試行します（{attempt}/{self.max_attempts}）: {error}")
+        return delay
+
+    def _on_success(self, started: float):
+        self._record_latency(time.monotonic() - started)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+
+    def call(self, function):
+        """function(timeout) を期限・再試行・ヘッジつきで呼び出し、その戻り値を返す。"""
+        deadline = self._begin()
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = min(self.attempt_timeout_seconds, deadline - time.monotonic())
+            started = time.monotonic()
+            try:
+                if timeout <= 0:
+                    raise CallTimeoutError(f"「{self.name}」の呼び出しが期限（{self.deadline_seconds:.0f}秒）を過ぎました。")
+                result = self._attempt(function, timeout) if self.idempotent else function(timeout)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._on_success(started)
+            return result
+
+    def _attempt(self, function, timeout: float):
+        """ワーカースレッドで1回試行する。必要ならヘッジの要求を追加し、先に成功した結果を返す。"""
+        executor = _get_executor()
+        attempt_deadline = time.monotonic() + timeout
+        run = tracing.run_in_current_turn(function)
+        first_future = executor.submit(run, timeout)
+        pending = {first_future}
+        hedge_delay = self._hedge_delay()
+        hedged = False
+        last_error = None
+        while pending:
+            remaining = attempt_deadline - time.monotonic()
+            wait_seconds = remaining
+            if not hedged and hedge_delay is not None:
+                wait_seconds = min(remaining, hedge_delay)
+            done, pending = wait(pending, timeout=max(0.0, wait_seconds), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first_future:
+                        self._count("hedge_wins", "storybook_call_hedge_wins_total")
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                last_error = future.exception()
+            if done:
+                if not pending and not hedged:
+                    break
+                continue
+            if time.monotonic() >= attempt_deadline:
+                break
+            if not hedged and hedge_delay is not None:
+                # 遅い側を待ちながら、同じ要求をもう1つ送る
+                hedged = True
+                self._count("hedges", "storybook_call_hedges_total")
+                pending.add(executor.submit(run, max(0.0, attempt_deadline - time.monotonic())))
+        for future in pending:
+            future.cancel()
+        if last_error is not None and not pending:
+            raise last_error
+        raise CallTimeoutError(f"「{self.name}」の呼び出しが{timeout:.1f}秒以内に終わりませんでした。")
+
+    async def call_async(self, function):
+        """call の非同期版。function(timeout) はコルーチンを返す関数。"""
+        deadline = self._begin()
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = min(self.attempt_timeout_seconds, deadline - time.monotonic())
+            started = time.monotonic()
+            try:
+                if timeout <= 0:
+                    raise CallTimeoutError(f"「{self.name}」の呼び出しが期限（{self.deadline_seconds:.0f}秒）を過ぎました。")
+                result = await self._attempt_async(function, timeout)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._on_success(started)
+            return result
+
+    async def _attempt_async(self, function, timeout: float):
+        attempt_deadline = time.monotonic() + timeout
+        first_task = asyncio.ensure_future(function(timeout))
+        pending = {first_task}
+        hedge_delay = self._hedge_delay()
+        hedged = False
+        last_error = None
+        try:
+            while pending:
+                remaining = attempt_deadline - time.monotonic()
+                wait_seconds = remaining
+                if not hedged and hedge_delay is not None:
+                    wait_seconds = min(remaining, hedge_delay)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, wait_seconds),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first_task:
+                            self._count("hedge_wins", "storybook_call_hedge_wins_total")
+                        return task.result()
+                    last_error = task.exception()
+                if done:
+                    if not pending and not hedged:
+                        break
+                    continue
+                if time.monotonic() >= attempt_deadline:
+                    break
+                if not hedged and hedge_delay is not None:
+                    hedged = True
+                    self._count("hedges", "storybook_call_hedges_total")
+                    pending.add(asyncio.ensure_future(function(max(0.0, attempt_deadline - time.monotonic()))))
+        finally:
+            for task in pending:
+                task.cancel()
+        if last_error is not None and not pending:
+            raise last_error
+        raise CallTimeoutError(f"「{self.name}」の呼び出しが{timeout:.1f}秒以内に終わりませんでした。")
+
+    def stats(self) -> dict:
+        """呼び出し回数・再試行・ヘッジ・打ち切りの件数と、直近の所要時間のパーセンタイル（ミリ秒）を返す。"""
+        with self._lock:
+            stats = dict(self._counters)
+            samples = list(self._latencies)
+        if samples:
+            for percentile in (50, 95, 99):
+                stats[f"p{percentile}_ms"] = _percentile(samples, percentile) * 1000.0
+        if self.circuit_breaker is not None:
+            stats["circuit"] = self.circuit_breaker.state
+        return stats
+
+
+def _env(name: str, key: str, default):
+    value = os.getenv(f"CALL_POLICY_{name.upper()}_{key.upper()}")
+    if value is None:
+        return default
+    return type(default)(value) if not isinstance(default, bool) else value == "1"
+
+
+def get_call_policy(name: str) -> CallPolicy:
+    """呼び出しの種類（chat・vision・tts）ごとに、プロセス内で共有される CallPolicy を返す。"""
+    with _registry_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            defaults = DEFAULT_POLICIES[name]
+            breaker = None
+            if _env(name, "circuit_breaker", defaults["circuit_breaker"]):
+                breaker = CircuitBreaker(
+                    name,
+                    failure_threshold=int(os.getenv("CIRCUIT_BREAKER_FAILURES", DEFAULT_BREAKER_FAILURES)),
+                    reset_seconds=float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", DEFAULT_BREAKER_RESET_SECONDS)),
+                )
+            policy = CallPolicy(
+                name,
+                deadline_seconds=_env(name, "deadline_seconds", defaults["deadline_seconds"]),
+                attempt_timeout_seconds=_env(name, "attempt_timeout_seconds", defaults["attempt_timeout_seconds"]),
+                max_attempts=_env(name, "max_attempts", defaults["max_attempts"]),
+                hedge_percentile=_env(name, "hedge_percentile", float(defaults["hedge_percentile"])),
+                idempotent=defaults["idempotent"],
+                circuit_breaker=breaker,
+            )
+            _policies[name] = policy
+        return policy
+
+
+def call_policy_stats() -> dict:
+    """全ての CallPolicy の統計を返す。"""
+    with _registry_lock:
+        policies = dict(_policies)
+    return {name: policy.stats() for name, policy in policies.items()}
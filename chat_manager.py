@@ -1,108 +1,370 @@
+import asyncio
 from PIL import Image
-import google.generativeai as genai
-from persona_extractor import generate_persona_and_situation_from_image
-from utils import format_persona_dict_for_display
+from persona_extractor import (
+    PersonaExtractionError,
+    generate_character_set_from_image,
+    generate_character_set_from_image_async,
+)
+from persona_schema import CharacterSet, Persona
+from persona_cache import get_persona_cache
+from session_manager import (
+    PERSONA_STATUS_CHARACTER,
+    PERSONA_STATUS_DEFAULT,
+    PERSONA_STATUS_ERROR,
+    PERSONA_STATUS_NO_HUMAN,
+    PERSONA_STATUS_NONE,
+    ConversationSession,
+    get_session,
+)
+from tts_handler import select_voice_name_for_persona
+from gemini_client import async_gemini_call_slot, gemini_call_slot
+from call_policy import get_call_policy
+from history_manager import (
+    compact_history_if_needed,
+    record_turn_usage,
+    restore_chat_history,
+    start_chat_with_system_instruction,
+)
 import ai_init
+import tracing
 
-def get_ai_response(user_prompt: str, image_data: Image.Image = None):
+# UIに表示する、キャラクター設定の状態の説明
+PERSONA_STATUS_DESCRIPTIONS = {
+    PERSONA_STATUS_NONE: "（まだキャラクター設定なし）",
+    PERSONA_STATUS_NO_HUMAN: "（この絵には人間がいません。状況のみ説明可能）",
+    PERSONA_STATUS_DEFAULT: "フレンドリーなAIアシスタント（特定のキャラクターや状況設定なし）",
+    PERSONA_STATUS_ERROR: "キャラクター情報と状況を画像から取得できませんでした。",
+}
+
+# 応答を取得できなかったときの返事。エラーの詳細は読み上げず、定型フレーズとして事前に音声化しておく
+CHAT_FALLBACK_REPLY = "ごめんね、いまちょっとお返事できないみたい。もう一度お話ししてね！"
+# 画像からキャラクターを読み取れなかったときの返事。会話は以前のキャラクター（またはデフォルト）のまま続ける
+PERSONA_FALLBACK_REPLY = "ごめんね、この絵のことがよくわからなかったみたい。このままお話ししようね！"
+
+def _get_cached_character_set(persona_cache, image_data: Image.Image):
+    cached = persona_cache.get(image_data)
+    if cached is None:
+        return None
+    try:
+        return CharacterSet.from_dict(cached)
+    except ValueError as e:
+        # 以前の形式（キャラクター1人分のペルソナ）で保存されたエントリは使わずに生成し直す
+        print(f"ペルソナキャッシュのエントリを使えないため、生成し直します: {e}")
+        return None
+
+def _resolve_character_set(image_data: Image.Image) -> CharacterSet:
     """
-    ユーザーのプロンプトと任意で画像データを受け取り、AIからの応答を返す関数。
-    画像が提供された場合、新しいペルソナと状況を設定してチャットを開始する。
+    画像のキャラクターセットをキャッシュから引き、なければAIに生成させてキャッシュに保存する。
+    生成に失敗した場合は PersonaExtractionError を送出する。
     """
-    
-    if ai_init.model is None:
-        return "AIモデルが初期化されていません。まずAIを初期化してください。"
+    persona_cache = get_persona_cache()
+    character_set = _get_cached_character_set(persona_cache, image_data)
+    if character_set is None:
+        # キャッシュにない場合だけモデルを呼び出す
+        character_set = generate_character_set_from_image(image_data)
+        persona_cache.put(image_data, character_set.to_dict())
+    print(f"ペルソナキャッシュの状況: {persona_cache.stats()}")
+    return character_set
 
-    new_persona_set_this_turn = False 
+async def _resolve_character_set_async(image_data: Image.Image) -> CharacterSet:
+    """_resolve_character_set の非同期版。キャッシュ（SQLite）の読み書きはイベントループを止めないようスレッドで行う。"""
+    persona_cache = await asyncio.to_thread(get_persona_cache)
+    character_set = await asyncio.to_thread(_get_cached_character_set, persona_cache, image_data)
+    if character_set is None:
+        character_set = await generate_character_set_from_image_async(image_data)
+        await asyncio.to_thread(persona_cache.put, image_data, character_set.to_dict())
+    print(f"ペルソナキャッシュの状況: {await asyncio.to_thread(persona_cache.stats)}")
+    return character_set
 
-    if image_data:
-        print(f"新しい画像 ({type(image_data)}) が提供されました。ペルソナと状況を評価します。")
-        persona_dict = generate_persona_and_situation_from_image(image_data)  # dictを受け取る
-        generated_persona_and_situation_text = format_persona_dict_for_display(persona_dict)  # 表示用文字列
-        
-        if "エラー：" in generated_persona_and_situation_text:
-            ai_init.current_persona_and_situation_for_display = "キャラクター情報と状況を画像から取得できませんでした。"
-            return f"画像からキャラクター情報や状況を取得できませんでした。AIは以前のキャラクター（またはデフォルト）として応答します。\n詳細: {generated_persona_and_situation_text}"
-        
-        elif "人間のキャラクターなし" in generated_persona_and_situation_text or "見当たらないみたいだね" in generated_persona_and_situation_text: 
-            ai_init.current_persona_and_situation_for_display = "（この絵には人間がいません。状況のみ説明可能）" 
-            print("画像から特定の人間キャラクターが見つからなかったため、デフォルトの応答モード（または状況説明モード）になります。")
-            default_system_prompt = "あなたは親切でフレンドリーなAIアシスタントです。子供からのメッセージに、絵本のキャラクターになったつもりで楽しく応答してください。もしキャラクターがいなくても、絵の状況について話すことができます。常に優しく、子供の想像力を広げるような会話を心がけてください。"
-            ai_init.chat_session = ai_init.model.start_chat(history=[
-                {'role': 'user', 'parts': [default_system_prompt]},
-                {'role': 'model', 'parts': ["はい、こんにちは！この絵にはお話しできる人間のキャラクターはいないみたいだけど、絵の中の様子について何かお話ししようか！"]}
-            ])
-            new_persona_set_this_turn = True
-        
-        else: 
-            ai_init.current_persona_and_situation_for_display = generated_persona_and_situation_text
-            
-            # ★追加：AIが理解した「現在の状況」部分をターミナルに具体的に表示
-            situation_text_start_keyword = "--- 現在の状況 ---"
-            situation_info_for_log = "（状況情報は抽出されませんでした）" 
-            if situation_text_start_keyword in generated_persona_and_situation_text:
-                situation_info_for_log = generated_persona_and_situation_text.split(situation_text_start_keyword, 1)[1].strip()
-            
-            print("\n----------------------------------------------------")
-            print("AIが現在の状況を以下のように理解（または設定）しました：")
-            print(situation_info_for_log)
-            print("----------------------------------------------------\n")
-
-            system_instruction_for_chat = f"""あなたは、以下の情報に基づいて設定された絵本の「人間のキャラクター」です。
+def _persona_error_response(session: ConversationSession, error: Exception) -> str:
+    session.persona_status = PERSONA_STATUS_ERROR
+    print(f"画像からキャラクター情報や状況を取得できませんでした。以前のキャラクター（またはデフォルト）として応答します: {error}")
+    return PERSONA_FALLBACK_REPLY
+
+def _start_persona_chat(session: ConversationSession, persona: Persona) -> str:
+    """
+    ペルソナ（人間がいない場合は場面だけ）からシステム指示とTTSの声を決めて、新しいチャットを開始する関数。
+    モデルは呼ばない。ペルソナ設定直後の挨拶用プロンプトを返す。
+    """
+    session.persona = persona
+    session.voice_name = select_voice_name_for_persona(persona)
+
+    if not persona.has_human:
+        session.persona_status = PERSONA_STATUS_NO_HUMAN
+        print("画像から特定の人間キャラクターが見つからなかったため、デフォルトの応答モード（または状況説明モード）になります。")
+        default_system_prompt = "あなたは親切でフレンドリーなAIアシスタントです。子供からのメッセージに、絵本のキャラクターになったつもりで楽しく応答してください。もしキャラクターがいなくても、絵の状況について話すことができます。常に優しく、子供の想像力を広げるような会話を心がけてください。"
+        situation_text = persona.situation_text()
+        if situation_text:
+            default_system_prompt += f"\n\n--- 絵の状況 ---\n{situation_text}"
+        start_chat_with_system_instruction(session, default_system_prompt)
+        greeting_prompt = "この絵について何かお話ししようか？"
+
+    else:
+        session.persona_status = PERSONA_STATUS_CHARACTER
+        persona_text = persona.to_prompt_text()
+
+        # ★追加：AIが理解した「現在の状況」部分をターミナルに具体的に表示
+        print("\n----------------------------------------------------")
+        print("AIが現在の状況を以下のように理解（または設定）しました：")
+        print(persona.situation_text() or "（状況情報は抽出されませんでした）")
+        print("----------------------------------------------------\n")
+
+        system_instruction_for_chat = f"""あなたは、以下の情報に基づいて設定された絵本の「人間のキャラクター」です。
 あなたは現在、記述されている「現在の状況」の中にいます。
 子供からのメッセージに対して、このキャラクターになりきり、かつ現在の状況も踏まえて応答してください。
 返答は1~3文程度に抑え、テンポよく会話してください。一貫性を保ち、子供が楽しめるような会話を心がけてください。常にポジティブで、優しく、子供の想像力を刺激するような言葉遣いをしてください。
 例えば、もし周囲に他のキャラクター（人間以外も含む）がいるなら、そのキャラクターについて触れたり、一緒に行動していることを話したりできます。絵の中の場所や雰囲気も会話に取り入れてください。
 
 --- あなたのキャラクター設定と現在の状況 ---
-{generated_persona_and_situation_text} 
+{persona_text}
 --- 設定と状況ここまで ---
 
 それでは、子供からのメッセージに応答の準備をしてください。
 子供が話しかけてきたら、このキャラクターとして、現在の状況も意識しながら自然に会話を始めてください。
 """
-            ai_init.chat_session = ai_init.model.start_chat(history=[
-                {'role': 'user', 'parts': [system_instruction_for_chat]},
-                {'role': 'model', 'parts': ["はい、わかりました！このキャラクターになりきって、今の状況も考えながらお話しする準備ができました！"]}
-            ])
-            new_persona_set_this_turn = True
-            # ★変更点：ターミナルログに表示する情報を増やす（状況も含むペルソナ全体）
-            print(f"新しい「人間」ペルソナと状況でチャットセッションを開始しました。設定内容:\n{ai_init.current_persona_and_situation_for_display}\n---")
-
-        if new_persona_set_this_turn and not user_prompt:
-             first_greeting_prompt_after_setting = ""
-             if "人間のキャラクターなし" not in ai_init.current_persona_and_situation_for_display and "エラー：" not in ai_init.current_persona_and_situation_for_display:
-                 first_greeting_prompt_after_setting = f"（システム：{ai_init.current_persona_and_situation_for_display.splitlines()[0]} として挨拶してください）こんにちは！"
-             else:
-                 first_greeting_prompt_after_setting = "この絵について何かお話ししようか？"
-             try:
-                 print(f"ペルソナ/状況設定後の最初の挨拶を生成します: {first_greeting_prompt_after_setting}")
-                 response = ai_init.chat_session.send_message(first_greeting_prompt_after_setting)
-                 return response.text
-             except Exception as e:
-                 print(f"AIのペルソナ/状況設定後の挨拶生成中にエラー: {e}")
-                 return f"AIの挨拶生成中にエラーが発生しました: {e}"
+        # ペルソナは疑似的なユーザー発言ではなく、システム指示として渡す
+        start_chat_with_system_instruction(session, system_instruction_for_chat)
+        # ★変更点：ターミナルログに表示する情報を増やす（状況も含むペルソナ全体）
+        print(f"新しい「人間」ペルソナと状況でチャットセッションを開始しました。設定内容:\n{persona_text}\n---")
+        greeting_prompt = f"（システム：{persona.name} として挨拶してください）こんにちは！"
+    return greeting_prompt
+
+def _prepare_chat_session(session: ConversationSession, user_prompt: str, image_data: Image.Image = None,
+                          character_set: CharacterSet = None):
+    """
+    画像があればペルソナと状況を設定し、セッションのチャットを用意する関数。
+    (確定した応答, 送信するメッセージ) を返す。エラーなどで送信前に応答が確定した場合は前者のみ、
+    そうでなければ後者（ユーザーのメッセージ、またはペルソナ設定直後の挨拶用プロンプト）のみが入る。
+    character_set を渡した場合は、画像からのキャラクター生成を省略してそれを使う。
+    話し相手は、ページのキャラクターのうち先頭（指を指されている、または最も目立つ）のキャラクターになる。
+    """
+    
+    if ai_init.model is None:
+        return "AIモデルが初期化されていません。まずAIを初期化してください。", None
+
+    if image_data:
+        print(f"新しい画像 ({type(image_data)}) が提供されました。ペルソナと状況を評価します。")
+        if character_set is None:
+            try:
+                character_set = _resolve_character_set(image_data)
+            except PersonaExtractionError as e:
+                return _persona_error_response(session, e), None
+        session.character_set = character_set
+        session.active_character_index = 0
+        session.character_chats = {}
+        greeting_prompt = _start_persona_chat(session, character_set.persona(0))
+
+        if not user_prompt:
+             print(f"ペルソナ/状況設定後の最初の挨拶を生成します: {greeting_prompt}")
+             return None, greeting_prompt
                  
-    if ai_init.chat_session is None:
+    if session.chat_session is None:
         print("チャットセッションが存在しないため、デフォルトのセッションを開始します。")
         default_system_prompt = "あなたは親切でフレンドリーなAIアシスタントです。子供からのメッセージに、絵本のキャラクターになったつもりで楽しく応答してください。特定のキャラクター設定はありませんが、常に優しく、子供の想像力を広げるような会話を心がけてください。"
-        ai_init.chat_session = ai_init.model.start_chat(history=[
-            {'role': 'user', 'parts': [default_system_prompt]},
-            {'role': 'model', 'parts': ["はい、こんにちは！何でも聞いてね！一緒にお話しできるのを楽しみにしているよ。"]}
-        ])
-        ai_init.current_persona_and_situation_for_display = "フレンドリーなAIアシスタント（特定のキャラクターや状況設定なし）"
+        start_chat_with_system_instruction(session, default_system_prompt)
+        session.persona_status = PERSONA_STATUS_DEFAULT
         print("デフォルトのチャットセッションを開始しました。")
 
+    if not user_prompt:
+        return "何かお話ししたいことを入力してね！", None
+    return None, user_prompt
+
+def get_ai_response(user_prompt: str, image_data: Image.Image = None, session: ConversationSession = None,
+                    character_set: CharacterSet = None):
+    """
+    ユーザーのプロンプトと任意で画像データを受け取り、AIからの応答を返す関数。
+    画像が提供された場合、新しいペルソナと状況を設定してチャットを開始する。
+    character_set を渡した場合は、画像からのキャラクター生成を省略してそれを使う。
+    session を省略した場合は、現在のStreamlitセッションの会話状態を使う。
+    """
+    session = get_session(session)
+    with session.lock:
+        prepared_response, message_to_send = _prepare_chat_session(session, user_prompt, image_data, character_set)
+        if prepared_response is not None:
+            return prepared_response
+
+        try:
+            print(f"現在のチャットセッションにメッセージを送信します: '{message_to_send[:50]}...'")
+            def request(timeout):
+                with gemini_call_slot(timeout):
+                    return session.chat_session.send_message(message_to_send, request_options={"timeout": timeout})
+
+            with tracing.span("chat"):
+                response = get_call_policy("chat").call(request)
+            record_turn_usage(session, response)
+            compact_history_if_needed(session)
+            return response.text
+        except Exception as e:
+            print(f"AIからの応答取得中にエラーが発生しました: {e}")
+            return CHAT_FALLBACK_REPLY
+
+def _discard_broken_turn(session: ConversationSession) -> bool:
+    """
+    ストリーミングが途中で切れた、または安全性などの理由で止まった応答を、チャットの履歴から取り除く関数。
+    google.generativeai のチャットは、壊れた応答が残っていると以降の history の参照と送信が全て失敗するため。
+    取り除いた場合は True を返す。
+    """
+    chat_session = session.chat_session
+    if chat_session is None or getattr(chat_session, "last", None) is None:
+        return False
     try:
-        if not user_prompt:
-            return "何かお話ししたいことを入力してね！"
-        print(f"現在のチャットセッションにメッセージを送信します: '{user_prompt[:50]}...'")
-        response = ai_init.chat_session.send_message(user_prompt)
-        return response.text
+        chat_session.history  # 正常に終わった応答は、ここで履歴に確定する
+        return False
     except Exception as e:
-        print(f"AIからの応答取得中にエラーが発生しました: {e}")
-        return f"AIからの応答取得中にエラーが発生しました: {e}"
-    
-def get_current_persona_and_situation_description():
-    """UI表示用に現在のペルソナ・状況説明を返す関数"""
-    return ai_init.current_persona_and_situation_for_display    
+        print(f"途中で止まった応答を会話の履歴から取り除きます: {e}")
+        chat_session.rewind()
+        return True
+
+def get_ai_response_stream(user_prompt: str, image_data: Image.Image = None, session: ConversationSession = None):
+    """
+    get_ai_response のストリーミング版。応答テキストを生成された順に断片ごとに yield する。
+    """
+    session = get_session(session)
+    with session.lock:
+        prepared_response, message_to_send = _prepare_chat_session(session, user_prompt, image_data)
+        if prepared_response is not None:
+            yield prepared_response
+            return
+
+        try:
+            print(f"現在のチャットセッションにメッセージを送信します（ストリーミング）: '{message_to_send[:50]}...'")
+            policy = get_call_policy("chat")
+            yielded = False
+            # 断片を受け取り終わるまで枠を持ち続けるので、枠の空き待ちも呼び出しの期限までにする
+            with tracing.span("chat", streaming=True), gemini_call_slot(policy.deadline_seconds):
+                # 再試行できるのは最初の断片が届く前まで（届いた断片はもう表示・音声化されている）
+                response = policy.call(
+                    lambda timeout: session.chat_session.send_message(message_to_send, stream=True,
+                                                                      request_options={"timeout": timeout})
+                )
+                for chunk in response:
+                    if chunk.text:
+                        yielded = True
+                        yield chunk.text
+            if _discard_broken_turn(session):
+                # 安全性などの理由で途中で止まった応答。壊れた履歴は要約しない
+                if not yielded:
+                    yield CHAT_FALLBACK_REPLY
+                return
+            record_turn_usage(session, response)
+            compact_history_if_needed(session)
+        except GeneratorExit:
+            # 呼び出し元が読み終える前にやめた場合も、読みかけの応答を履歴に残さない
+            _discard_broken_turn(session)
+            raise
+        except Exception as e:
+            print(f"AIからの応答取得中にエラーが発生しました: {e}")
+            _discard_broken_turn(session)
+            yield CHAT_FALLBACK_REPLY
+
+async def get_ai_response_async(user_prompt: str, image_data: Image.Image = None, session: ConversationSession = None):
+    """
+    get_ai_response の非同期版。ペルソナ生成とメッセージ送信を非同期APIで行うので、
+    複数セッションからの独立したリクエストをスレッドを占有せずに並行して処理できる。
+    同期APIと同じ session.lock を取るので、同じセッションへの同期の呼び出しや履歴の要約とは重ならない。
+    """
+    session = get_session(session)
+    async with session.lock:
+        character_set = None
+        if image_data and ai_init.model is not None:
+            try:
+                character_set = await _resolve_character_set_async(image_data)
+            except PersonaExtractionError as e:
+                return _persona_error_response(session, e)
+        prepared_response, message_to_send = _prepare_chat_session(session, user_prompt, image_data, character_set)
+        if prepared_response is not None:
+            return prepared_response
+
+        try:
+            print(f"現在のチャットセッションにメッセージを非同期で送信します: '{message_to_send[:50]}...'")
+            async def request(timeout):
+                async with async_gemini_call_slot(timeout):
+                    return await session.chat_session.send_message_async(message_to_send,
+                                                                         request_options={"timeout": timeout})
+
+            with tracing.span("chat"):
+                response = await get_call_policy("chat").call_async(request)
+            record_turn_usage(session, response)
+            compact_history_if_needed(session)
+            return response.text
+        except Exception as e:
+            print(f"AIからの応答取得中にエラーが発生しました: {e}")
+            return CHAT_FALLBACK_REPLY
+
+def restore_greeting_conversation(image_data: Image.Image, character_set: CharacterSet, greeting_text: str,
+                                  session: ConversationSession = None) -> bool:
+    """
+    前処理済みのキャラクターセットと最初の挨拶から、挨拶まで済んだチャットをモデルを呼ばずに用意する関数。
+    ペルソナを設定できなかった場合は False を返す。
+    """
+    session = get_session(session)
+    with session.lock:
+        prepared_response, greeting_prompt = _prepare_chat_session(session, "", image_data, character_set)
+        if prepared_response is not None:
+            return False
+        restore_chat_history(session, [("user", greeting_prompt), ("model", greeting_text)])
+    return True
+
+def adopt_prepared_conversation(session: ConversationSession, prepared_session: ConversationSession):
+    """
+    別の会話状態で用意しておいたペルソナ・チャット（挨拶まで済んだもの）を、セッションの会話状態として採用する関数。
+    画像選択時の先読み（prefetch.py）の結果を、最初のターンで取り込むのに使う。
+    """
+    session = get_session(session)
+    with session.lock:
+        session.chat_session = prepared_session.chat_session
+        session.persona = prepared_session.persona
+        session.character_set = prepared_session.character_set
+        session.active_character_index = prepared_session.active_character_index
+        session.character_chats = prepared_session.character_chats
+        session.persona_status = prepared_session.persona_status
+        session.voice_name = prepared_session.voice_name
+        session.system_instruction = prepared_session.system_instruction
+        session.history_summary = prepared_session.history_summary
+        session.last_prompt_tokens = prepared_session.last_prompt_tokens
+        session.tokens_sent_per_turn.extend(prepared_session.tokens_sent_per_turn)
+    print(f"先読みしておいたペルソナと状況を採用しました（声: {session.voice_name}）。")
+
+def switch_character(character_index: int, session: ConversationSession = None) -> Persona:
+    """
+    同じページの別のキャラクターに話し相手を切り替える関数。
+    画像の解析結果（キャラクターセット）からペルソナ・システム指示・TTSの声（性別から）を作り直すだけで、モデルは呼ばない。
+    以前そのキャラクターと話していた場合は、その会話の続きから再開する。
+    切り替え先のキャラクターがいない場合は ValueError を送出する。
+    """
+    session = get_session(session)
+    with session.lock:
+        character_set = session.character_set
+        if character_set is None or not 0 <= character_index < len(character_set.characters):
+            raise ValueError(f"切り替え先のキャラクターが見つかりません: {character_index}")
+        if character_index == session.active_character_index:
+            return session.persona
+
+        # いまのキャラクターとの会話を取っておき、戻ってきたときに続きから話せるようにする
+        session.character_chats[session.active_character_index] = (
+            session.chat_session, session.system_instruction, session.history_summary, session.last_prompt_tokens
+        )
+        session.active_character_index = character_index
+        persona = character_set.persona(character_index)
+        saved_chat = session.character_chats.pop(character_index, None)
+        if saved_chat is None:
+            _start_persona_chat(session, persona)
+        else:
+            session.chat_session, session.system_instruction, session.history_summary, session.last_prompt_tokens = saved_chat
+            session.persona = persona
+            session.persona_status = PERSONA_STATUS_CHARACTER
+            session.voice_name = select_voice_name_for_persona(persona)
+    print(f"話し相手を「{persona.name}」に切り替えました（声: {session.voice_name}）。")
+    return persona
+
+def get_character_choices(session: ConversationSession = None):
+    """UIのキャラクター選択用に、ページのキャラクターの名前の一覧と、いま話しているキャラクターの番号を返す関数"""
+    session = get_session(session)
+    if session.character_set is None:
+        return [], 0
+    return session.character_set.names(), session.active_character_index
+
+def get_current_persona_state(session: ConversationSession = None):
+    """UI表示用に、現在のキャラクター設定の状態と Persona（なければ None）を返す関数"""
+    session = get_session(session)
+    return session.persona_status, session.persona
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from call_policy import CallTimeoutError
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+_client = None
+_configured_api_key = None
+_client_lock = threading.Lock()
+_sync_slots = None
+# イベントループごとに同時実行数を制限するセマフォ
+_async_slots = weakref.WeakKeyDictionary()
+
+
+def get_max_concurrency() -> int:
+    """環境変数 'GEMINI_MAX_CONCURRENCY' から、Gemini APIへの同時リクエスト数の上限を返す。"""
+    return int(os.getenv("GEMINI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+
+
+def _get_api_key() -> str:
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("APIキーが見つかりません。.envファイルに 'GEMINI_API_KEY' を設定してください。")
+    return api_key
+
+
+def configure(api_key: str = None):
+    """
+    両方のGemini SDK（google.generativeai と google.genai）をプロセス内で一度だけ設定する関数。
+    2回目以降の呼び出しでは、同じAPIキーであれば何もしない。
+    SDKの読み込みは重いので、アプリの起動時ではなく最初に設定するときに行う。
+    """
+    import google.generativeai as generativeai
+    from google import genai
+
+    global _client, _configured_api_key
+    api_key = api_key or _get_api_key()
+    with _client_lock:
+        if _configured_api_key == api_key and _client is not None:
+            return
+        generativeai.configure(api_key=api_key)
+        # Clientは内部のHTTP接続プールを持つので、使い回すことで接続のキープアライブが効く
+        _client = genai.Client(api_key=api_key)
+        _configured_api_key = api_key
+
+
+def get_genai_client():
+    """プロセス内で共有される google.genai のClientを返す。未設定なら環境変数のAPIキーで設定する。"""
+    if _client is None:
+        configure()
+    return _client
+
+
+def _get_sync_slots() -> threading.BoundedSemaphore:
+    global _sync_slots
+    with _client_lock:
+        if _sync_slots is None:
+            _sync_slots = threading.BoundedSemaphore(get_max_concurrency())
+        return _sync_slots
+
+
+@contextmanager
+def gemini_call_slot(timeout: float = None):
+    """
+    同期呼び出し用。同時リクエスト数の上限を超えないよう、空きが出るまで待ってから実行する。
+    timeout 秒以内に空きが出なければ CallTimeoutError を送出する（None なら空くまで待つ）。
+    """
+    slots = _get_sync_slots()
+    if not slots.acquire(timeout=timeout):
+        raise CallTimeoutError(f"Gemini APIの同時リクエスト数の空きを{timeout:.1f}秒待ちましたが、空きませんでした。")
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+@asynccontextmanager
+async def async_gemini_call_slot(timeout: float = None):
+    """非同期呼び出し用の gemini_call_slot。実行中のイベントループごとに上限を管理する。"""
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        slots = _async_slots.get(loop)
+        if slots is None:
+            slots = asyncio.Semaphore(get_max_concurrency())
+            _async_slots[loop] = slots
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise CallTimeoutError(f"Gemini APIの同時リクエスト数の空きを{timeout:.1f}秒待ちましたが、空きませんでした。") from None
+    try:
+        yield
+    finally:
+        slots.release()
@@ -0,0 +1,156 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import ai_init
+from call_policy import get_call_policy
+from gemini_client import gemini_call_slot
+from session_manager import ConversationSession
+import tracing
+
+DEFAULT_TOKEN_BUDGET = 4000   # 1ターンで送るプロンプトのトークン数の上限の目安
+DEFAULT_KEEP_TURNS = 4        # 要約せずにそのまま残す直近の往復数
+DEFAULT_SUMMARY_WORKERS = 2   # 同時に要約を作るスレッド数（全セッション共通）
+
+_executor = None
+_executor_lock = threading.Lock()
+
+SUMMARY_SECTION_HEADER = "--- これまでの会話の要約 ---"
+
+SUMMARY_PROMPT = """以下は、絵本のキャラクターと子供との会話の記録です。
+この先の会話を続けるのに必要なこと（子供の名前や好きなもの、約束したこと、話題の流れなど）だけを残して、
+日本語で5文以内の短い要約にしてください。要約だけを出力してください。
+
+{previous_summary}
+--- 会話の記録 ---
+{transcript}
+"""
+
+
+def get_token_budget() -> int:
+    return int(os.getenv("HISTORY_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+
+
+def get_keep_turns() -> int:
+    return int(os.getenv("HISTORY_KEEP_TURNS", DEFAULT_KEEP_TURNS))
+
+
+def _build_model(session: ConversationSession):
+    """ペルソナ（と会話の要約）をシステム指示として持つモデルを作る。"""
+    system_instruction = session.system_instruction
+    if session.history_summary:
+        system_instruction = f"{system_instruction}\n\n{SUMMARY_SECTION_HEADER}\n{session.history_summary}"
+    return ai_init.create_model(system_instruction)
+
+
+def start_chat_with_system_instruction(session: ConversationSession, system_instruction: str):
+    """
+    ペルソナの設定文を（疑似的なユーザー発言ではなく）システム指示として渡し、新しいチャットを開始する。
+    それまでの要約やトークン数の記録はリセットする。
+    """
+    session.system_instruction = system_instruction
+    session.history_summary = ""
+    session.last_prompt_tokens = 0
+    session.chat_session = _build_model(session).start_chat(history=[])
+
+
+def restore_chat_history(session: ConversationSession, turns):
+    """
+    システム指示を設定済みのセッションで、(役割, テキスト) の並びを履歴としてチャットを作り直す。
+    前処理しておいた挨拶など、モデルを呼ばずに会話の途中から始めたい場合に使う。
+    """
+    import google.generativeai as genai
+    history = [genai.protos.Content(role=role, parts=[genai.protos.Part(text=text)]) for role, text in turns]
+    session.chat_session = _build_model(session).start_chat(history=history)
+
+
+def record_turn_usage(session: ConversationSession, response):
+    """応答のusage_metadataから、このターンで送信したトークン数を記録してログに出す。"""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    session.last_prompt_tokens = prompt_tokens
+    session.tokens_sent_per_turn.append(prompt_tokens)
+    tracing.count("storybook_prompt_tokens_total", "chat", prompt_tokens)
+    print(f"このターンで送信したトークン数: {prompt_tokens}（上限の目安: {get_token_budget()}）")
+
+
+def _split_history(session: ConversationSession):
+    """
+    要約の対象にする古い履歴と、そのまま残す直近の履歴に分ける。
+    予算内であれば (None, None) を返す。
+    """
+    if session.chat_session is None or session.last_prompt_tokens <= get_token_budget():
+        return None, None
+    history = list(session.chat_session.history)
+    keep_count = get_keep_turns() * 2  # 1往復 = ユーザー + モデル
+    if len(history) <= keep_count:
+        return None, None
+    return history[:-keep_count], history[-keep_count:]
+
+
+def _build_summary_prompt(session: ConversationSession, old_history) -> str:
+    transcript_lines = []
+    for content in old_history:
+        speaker = "子供" if content.role == "user" else "キャラクター"
+        text = "".join(part.text for part in content.parts if getattr(part, "text", None))
+        transcript_lines.append(f"{speaker}：{text}")
+    previous_summary = f"{SUMMARY_SECTION_HEADER}\n{session.history_summary}\n" if session.history_summary else ""
+    return SUMMARY_PROMPT.format(previous_summary=previous_summary, transcript="\n".join(transcript_lines))
+
+
+def _rebuild_chat(session: ConversationSession, summary: str, kept_history):
+    session.history_summary = summary.strip()
+    session.chat_session = _build_model(session).start_chat(history=kept_history)
+    print(f"古い会話を要約し、直近 {len(kept_history) // 2} 往復だけを残しました。要約:\n{session.history_summary}")
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("HISTORY_SUMMARY_WORKERS", DEFAULT_SUMMARY_WORKERS)),
+                thread_name_prefix="history-summary",
+            )
+        return _executor
+
+
+def _summarize_and_compact(session: ConversationSession, chat_session, summary_prompt: str, summarized_count: int):
+    """
+    要約を作り、その間に会話が進んでいればその分も残したまま、チャットを作り直す。
+    要約の間に画像やキャラクターが変わってチャットが別物になっていた場合は、要約を捨てる。
+    """
+    def request(timeout):
+        with gemini_call_slot(timeout):
+            return ai_init.model.generate_content(summary_prompt, request_options={"timeout": timeout})
+
+    try:
+        with tracing.span("history_summary"):
+            response = get_call_policy("chat").call(request)
+        summary = response.text
+    except Exception as e:
+        print(f"会話履歴の要約中にエラーが発生しました（履歴はそのまま使います）: {e}")
+        return
+    with session.lock:
+        if session.chat_session is not chat_session:
+            print("要約中に会話が切り替わったため、要約は使いません。")
+            return
+        _rebuild_chat(session, summary, list(chat_session.history)[summarized_count:])
+
+
+def compact_history_if_needed(session: ConversationSession):
+    """
+    直前のターンで送ったトークン数が予算を超えていたら、古い履歴を短い要約にまとめる処理をバックグラウンドで始める。
+    直近 HISTORY_KEEP_TURNS 往復はそのまま残し、要約はシステム指示の末尾に載せる。
+    要約のためのモデルの呼び出しは待たないので、その間も応答の表示や音声化、次のターンの送信は進められる。
+    """
+    with session.lock:
+        if session.history_compaction is not None and not session.history_compaction.done():
+            return
+        old_history, _ = _split_history(session)
+        if old_history is None:
+            return
+        summary_prompt = _build_summary_prompt(session, old_history)
+        session.history_compaction = _get_executor().submit(
+            tracing.run_in_current_turn(_summarize_and_compact),
+            session, session.chat_session, summary_prompt, len(old_history),
+        )
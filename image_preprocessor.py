@@ -0,0 +1,89 @@
+import io
+import os
+import time
+from PIL import Image, ImageOps
+
+DEFAULT_MAX_DIMENSION = 1536        # AIに送る画像の長辺の上限（px）
+DEFAULT_TARGET_BYTES = 400 * 1024   # AIに送る画像のバイト数の目安
+DEFAULT_FORMAT = "JPEG"             # JPEG または WEBP
+DEFAULT_THUMBNAIL_DIMENSION = 320   # 画面表示用サムネイルの長辺（px）
+DEFAULT_UPLOAD_BYTES_PER_SECOND = 1024 * 1024  # 短縮できた時間の見積もりに使う回線速度
+
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+INITIAL_QUALITY = 85
+
+
+class PreprocessedImage:
+    """前処理済みの画像。AIに送る画像と、画面表示用のサムネイルを持つ。"""
+
+    def __init__(self, image: Image.Image, thumbnail: Image.Image, encoded_bytes: bytes, thumbnail_bytes: bytes,
+                 original_size: int):
+        self.image = image
+        self.thumbnail = thumbnail
+        self.encoded_bytes = encoded_bytes
+        self.thumbnail_bytes = thumbnail_bytes
+        self.original_size = original_size
+
+
+def _get_settings() -> dict:
+    return {
+        "max_dimension": int(os.getenv("IMAGE_MAX_DIMENSION", DEFAULT_MAX_DIMENSION)),
+        "target_bytes": int(os.getenv("IMAGE_TARGET_BYTES", DEFAULT_TARGET_BYTES)),
+        "format": os.getenv("IMAGE_FORMAT", DEFAULT_FORMAT).upper(),
+        "thumbnail_dimension": int(os.getenv("IMAGE_THUMBNAIL_DIMENSION", DEFAULT_THUMBNAIL_DIMENSION)),
+        "upload_bytes_per_second": float(os.getenv("IMAGE_UPLOAD_BYTES_PER_SECOND", DEFAULT_UPLOAD_BYTES_PER_SECOND)),
+    }
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _encode_within_budget(image: Image.Image, image_format: str, target_bytes: int) -> bytes:
+    """画質を下げ、それでも足りなければ縮小して、目標バイト数以下に収める。"""
+    while True:
+        quality = INITIAL_QUALITY
+        encoded = _encode(image, image_format, quality)
+        while len(encoded) > target_bytes and quality > MIN_QUALITY:
+            quality -= QUALITY_STEP
+            encoded = _encode(image, image_format, quality)
+        if len(encoded) <= target_bytes or min(image.size) <= 256:
+            return encoded
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+
+
+def preprocess_image(image_bytes: bytes) -> PreprocessedImage:
+    """
+    アップロード・撮影された画像のバイト列を、AIに送る前に軽くする関数。
+    EXIFの向きを反映し、長辺を縮小して、JPEG/WebPで目標バイト数まで再圧縮する。
+    あわせて画面表示用の小さなサムネイルを作る。
+    """
+    settings = _get_settings()
+    started = time.perf_counter()
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image)  # スマホ写真の回転情報を画素に反映
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    image.thumbnail((settings["max_dimension"], settings["max_dimension"]), Image.LANCZOS)
+    encoded_bytes = _encode_within_budget(image, settings["format"], settings["target_bytes"])
+    processed_image = Image.open(io.BytesIO(encoded_bytes))
+    processed_image.load()
+
+    thumbnail = processed_image.copy()
+    thumbnail.thumbnail((settings["thumbnail_dimension"], settings["thumbnail_dimension"]), Image.LANCZOS)
+    thumbnail_bytes = _encode(thumbnail, settings["format"], INITIAL_QUALITY)
+
+    elapsed = time.perf_counter() - started
+    saved_bytes = len(image_bytes) - len(encoded_bytes)
+    # 送信時間の短縮分から前処理にかかった時間を差し引いた、正味の短縮時間の見積もり
+    saved_seconds = saved_bytes / settings["upload_bytes_per_second"] - elapsed
+    print(
+        f"画像を前処理しました: {len(image_bytes):,} → {len(encoded_bytes):,} バイト"
+        f"（{saved_bytes:,} バイト削減、前処理 {elapsed * 1000:.0f}ms、正味 約{saved_seconds:.2f}秒短縮の見込み）"
+    )
+    return PreprocessedImage(processed_image, thumbnail, encoded_bytes, thumbnail_bytes, len(image_bytes))
@@ -0,0 +1,170 @@
+import atexit
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from session_manager import get_session_manager
+
+DEFAULT_BLOB_ROOT = os.path.join("cache", "blobs")
+DEFAULT_MAX_BYTES_PER_SESSION = 32 * 1024 * 1024  # 1セッションあたり32MBまで
+DEFAULT_MAX_BLOBS_PER_SESSION = 200
+
+
+class BlobStore:
+    """
+    会話履歴の音声をセッションごとのディレクトリに保存するディスクストア。
+    st.session_state にはIDだけを持たせ、実データはここに置く。
+    セッションごとにバイト数と件数の上限があり、超えたら古いものから削除する。
+    """
+
+    def __init__(self, root: str = DEFAULT_BLOB_ROOT, max_bytes_per_session: int = DEFAULT_MAX_BYTES_PER_SESSION,
+                 max_blobs_per_session: int = DEFAULT_MAX_BLOBS_PER_SESSION):
+        self.root = root
+        self.max_bytes_per_session = max_bytes_per_session
+        self.max_blobs_per_session = max_blobs_per_session
+        # セッションID -> (blob_id -> バイト数) の保存順の一覧
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def _session_dir(self, session_id: str) -> str:
+        safe_session_id = re.sub(r"[^0-9A-Za-z_-]", "_", session_id)
+        return os.path.join(self.root, safe_session_id)
+
+    def put(self, session_id: str, data: bytes) -> str:
+        """データを保存して blob_id を返す。"""
+        blob_id = uuid.uuid4().hex
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        with open(os.path.join(session_dir, blob_id), "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            blobs = self._index.setdefault(session_id, OrderedDict())
+            blobs[blob_id] = len(data)
+            evicted = []
+            while len(blobs) > 1 and (len(blobs) > self.max_blobs_per_session
+                                      or sum(blobs.values()) > self.max_bytes_per_session):
+                old_blob_id, _ = blobs.popitem(last=False)
+                evicted.append(old_blob_id)
+        for old_blob_id in evicted:
+            try:
+                os.remove(os.path.join(session_dir, old_blob_id))
+            except FileNotFoundError:
+                pass
+        return blob_id
+
+    def get(self, session_id: str, blob_id: str):
+        """保存済みのデータを返す。削除済みの場合は None を返す。"""
+        if not blob_id:
+            return None
+        try:
+            with open(os.path.join(self._session_dir(session_id), blob_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete_session(self, session_id: str):
+        """セッションの終了時に、そのセッションのデータをすべて削除する。"""
+        with self._lock:
+            self._index.pop(session_id, None)
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def session_bytes(self, session_id: str) -> int:
+        with self._lock:
+            return sum(self._index.get(session_id, {}).values())
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def _is_process_alive(pid: int) -> bool:
+    """プロセスIDのプロセスが動いているかどうかを返す。"""
+    if os.name == "nt":
+        # Windows の os.kill はプロセスを終了させてしまうので、OpenProcess で確かめる
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # 別のユーザーのプロセスとして動いている
+        return True
+    return True
+
+
+def remove_stale_process_dirs(base: str):
+    """
+    終了した（クラッシュや再起動で片付けられなかった）プロセスの保存先を削除する。
+    保存先の名前はプロセスIDなので、そのIDのプロセスがもう動いていなければ削除してよい。
+    """
+    try:
+        names = os.listdir(base)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        if not _is_process_alive(int(name)):
+            print(f"終了したプロセスの会話データを削除します: {os.path.join(base, name)}")
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+
+def get_blob_store() -> BlobStore:
+    """
+    プロセス内共有のBlobStoreを返す。
+    同じ作業ディレクトリで複数のStreamlitプロセスが動いても互いのデータを消さないよう、保存先はプロセスごとに分ける。
+    セッションはプロセスをまたいで残らないので、初回作成時に自分のプロセスIDの保存先と、終了したプロセスの保存先を片付け、
+    正常に終了するときにも自分の保存先を削除する。
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            base = os.getenv("MESSAGE_BLOB_ROOT", DEFAULT_BLOB_ROOT)
+            root = os.path.join(base, str(os.getpid()))
+            shutil.rmtree(root, ignore_errors=True)
+            remove_stale_process_dirs(base)
+            _default_store = BlobStore(
+                root=root,
+                max_bytes_per_session=int(os.getenv("MESSAGE_BLOB_MAX_BYTES_PER_SESSION", DEFAULT_MAX_BYTES_PER_SESSION)),
+                max_blobs_per_session=int(os.getenv("MESSAGE_BLOB_MAX_PER_SESSION", DEFAULT_MAX_BLOBS_PER_SESSION)),
+            )
+            atexit.register(shutil.rmtree, root, ignore_errors=True)
+            get_session_manager().add_session_end_callback(_default_store.delete_session)
+        return _default_store
+
+
+def make_message(session_id: str, role: str, text_content: str, thumbnail_bytes: bytes = None,
+                 audio_bytes: bytes = None, audio_format: str = None, audio_played: bool = False) -> dict:
+    """
+    st.session_state.messages に入れる軽量なメッセージを作る関数。
+    テキストとサムネイル以外（音声）はBlobStoreに預け、IDだけを持たせる。
+    履歴の表示にはサムネイルしか使わないので、元画像は保存しない。
+    """
+    store = get_blob_store()
+    message = {"role": role, "text_content": text_content}
+    if thumbnail_bytes:
+        message["image_thumbnail"] = thumbnail_bytes
+    if audio_bytes:
+        message["audio_blob_id"] = store.put(session_id, audio_bytes)
+        message["audio_format"] = audio_format or "audio/wav"
+        message["audio_played"] = audio_played
+    return message
+
+
+def load_message_audio(session_id: str, message: dict):
+    """メッセージの音声データを返す。上限を超えて削除済みの場合は None を返す。"""
+    return get_blob_store().get(session_id, message.get("audio_blob_id"))
+
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from PIL import Image
+import tracing
+
+DEFAULT_CACHE_PATH = os.path.join("cache", "persona_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = 500
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60  # 30日
+DEFAULT_MAX_HASH_DISTANCE = 6  # 64bit中、何ビットまでの違いを「同じページ」とみなすか
+
+
+def compute_image_hash(image_data: Image.Image) -> int:
+    """
+    画像の知覚ハッシュ（dHash, 64bit）を計算する関数。
+    明るさや多少の撮影ブレが違っても、同じページならほぼ同じ値になる。
+    """
+    grayscale = image_data.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(grayscale.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hash_distance(hash_a: int, hash_b: int) -> int:
+    """2つの知覚ハッシュのハミング距離を返す。"""
+    return (hash_a ^ hash_b).bit_count()
+
+
+class PersonaCache:
+    """
+    画像の知覚ハッシュをキーに、ペルソナ辞書をSQLiteへ保存する永続キャッシュ。
+    TTLを過ぎたエントリは無効とし、件数上限を超えたら最終参照が古いものから削除する（LRU）。
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl_seconds: float = DEFAULT_TTL_SECONDS, max_distance: int = DEFAULT_MAX_HASH_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS personas (
+                   image_hash TEXT PRIMARY KEY,
+                   persona_json TEXT NOT NULL,
+                   created_at REAL NOT NULL,
+                   last_access REAL NOT NULL
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_personas_last_access ON personas(last_access)")
+        self._conn.commit()
+
+    def get(self, image_data: Image.Image):
+        """画像に近いページのペルソナがキャッシュにあれば辞書で返し、なければ None を返す。"""
+        image_hash = compute_image_hash(image_data)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM personas WHERE created_at < ?", (now - self.ttl_seconds,))
+
+            best_key, best_json, best_distance = None, None, None
+            for key, persona_json in self._conn.execute("SELECT image_hash, persona_json FROM personas"):
+                distance = hash_distance(image_hash, int(key, 16))
+                if distance <= self.max_distance and (best_distance is None or distance < best_distance):
+                    best_key, best_json, best_distance = key, persona_json, distance
+                    if distance == 0:
+                        break
+
+            if best_key is None:
+                self.misses += 1
+                self._conn.commit()
+                tracing.count("storybook_cache_misses_total", "persona")
+                return None
+
+            self._conn.execute("UPDATE personas SET last_access = ? WHERE image_hash = ?", (now, best_key))
+            self._conn.commit()
+            self.hits += 1
+        tracing.count("storybook_cache_hits_total", "persona")
+        print(f"ペルソナキャッシュにヒットしました（ハッシュ距離: {best_distance}）。")
+        return json.loads(best_json)
+
+    def put(self, image_data: Image.Image, persona_dict: dict):
+        """ペルソナ辞書を画像の知覚ハッシュで保存し、上限を超えた分を古い順に削除する。"""
+        key = format(compute_image_hash(image_data), "016x")
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO personas (image_hash, persona_json, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(persona_dict, ensure_ascii=False), now, now),
+            )
+            overflow = self._conn.execute(
+                "SELECT image_hash FROM personas ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_entries,)
+            ).fetchall()
+            if overflow:
+                self._conn.executemany("DELETE FROM personas WHERE image_hash = ?", overflow)
+                self.evictions += len(overflow)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """ヒット数・ミス数・削除数・現在の件数を返す。"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM personas").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": size}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_persona_cache() -> PersonaCache:
+    """環境変数の設定で作られた、プロセス内共有のペルソナキャッシュを返す。"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PersonaCache(
+                path=os.getenv("PERSONA_CACHE_PATH", DEFAULT_CACHE_PATH),
+                max_entries=int(os.getenv("PERSONA_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                ttl_seconds=float(os.getenv("PERSONA_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                max_distance=int(os.getenv("PERSONA_CACHE_MAX_DISTANCE", DEFAULT_MAX_HASH_DISTANCE)),
+            )
+        return _default_cache
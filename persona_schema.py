@@ -0,0 +1,152 @@
+CHARACTER_SET_SCHEMA_VERSION = 1
+MAX_CHARACTERS = 6  # 1ページから取り出すキャラクターの上限
+
+GENDERS = ("男性", "女性", "不明")
+
+# (JSONのキー, 表示・システム指示に使う見出し, 最大文字数)
+CHARACTER_FIELDS = (
+    ("name", "名前", 20),
+    ("gender", "性別", 2),
+    ("appearance", "見た目の特徴", 80),
+    ("personality", "性格", 60),
+    ("speech_style", "話しそうな口調や語尾", 40),
+    ("role", "子供たちに対する役割や目的", 40),
+)
+# ページ共通の場面（キャラクターセットでは全員で共有する）
+SCENE_FIELDS = (
+    ("place", "場所", 30),
+    ("others", "周囲にいる他の人物や動物、重要な物", 80),
+    ("mood", "絵全体の雰囲気", 30),
+)
+ACTION_FIELD = ("action", "キャラクターの主な行動や状態", 60)
+SITUATION_FIELDS = SCENE_FIELDS[:2] + (ACTION_FIELD,) + SCENE_FIELDS[2:]
+TEXT_FIELDS = CHARACTER_FIELDS + SITUATION_FIELDS
+
+FIELD_DESCRIPTIONS = {
+    "name": "名前。推測できなければ愛称を提案する",
+    "gender": "外見から判断した性別。男性・女性・不明のいずれか",
+    "appearance": "髪の色、服装、表情、年齢層など、人間としての見た目の特徴",
+    "personality": "表情やポーズ、絵の雰囲気から推測した性格",
+    "speech_style": "話しそうな口調や語尾（例：「～だよ！」「～かしら？」）",
+    "role": "子供たちに対する役割や目的（例：一緒に遊ぶ友達、物語の案内役）",
+    "place": "絵から分かる範囲の場所（例：森の中、部屋の中、公園）",
+    "others": "周囲にいる他の人物や動物、重要な物と、その様子",
+    "action": "キャラクターの主な行動や状態",
+    "mood": "絵全体の雰囲気（例：明るく楽しい、静かで穏やか）",
+}
+
+def _string_properties(fields) -> dict:
+    return {
+        key: {"type": "STRING", "description": f"{FIELD_DESCRIPTIONS[key]}（{limit}文字以内）"}
+        for key, _, limit in fields
+    }
+
+
+# Geminiの構造化出力（JSONモード）に渡すスキーマ。1ページの全キャラクターと、共通の場面を1回で受け取る
+CHARACTER_FIELDS_WITH_ACTION = CHARACTER_FIELDS + (ACTION_FIELD,)
+CHARACTER_SET_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "characters": {
+            "type": "ARRAY",
+            "description": "絵に描かれた人間のキャラクター全員。指を指されているキャラクター（いなければ最も目立つキャラクター）を先頭にする。"
+                           "人間がいなければ空の配列",
+            "items": {
+                "type": "OBJECT",
+                "properties": _string_properties(CHARACTER_FIELDS_WITH_ACTION),
+                "required": [key for key, _, _ in CHARACTER_FIELDS_WITH_ACTION],
+            },
+        },
+        **_string_properties(SCENE_FIELDS),
+    },
+    "required": ["characters"] + [key for key, _, _ in SCENE_FIELDS],
+}
+
+
+class Persona:
+    """
+    画像から生成したキャラクターと状況の情報。
+    各項目は文字数の上限で切り詰めて保持し、性別は「男性」「女性」「不明」のいずれかに揃える。
+    キャッシュやインデックスには、CharacterSet.to_dict() の一部として保存する。
+    """
+
+    def __init__(self, has_human: bool, **fields):
+        self.has_human = bool(has_human)
+        for key, _, limit in TEXT_FIELDS:
+            value = fields.get(key) or ""
+            setattr(self, key, " ".join(str(value).split())[:limit])
+        if self.gender not in GENDERS:
+            self.gender = "不明"
+        if self.has_human and not self.name:
+            self.name = "なまえのないおともだち"
+
+    def _format_fields(self, fields) -> str:
+        return "\n".join(f"- {label}：{getattr(self, key)}" for key, label, _ in fields if getattr(self, key))
+
+    def situation_text(self) -> str:
+        """「現在の状況」の部分だけを、見出しつきの箇条書きで返す。"""
+        return self._format_fields(SITUATION_FIELDS)
+
+    def to_prompt_text(self) -> str:
+        """チャットのシステム指示に埋め込む、キャラクター情報と現在の状況の文章を返す。"""
+        return (f"--- キャラクター情報 ---\n{self._format_fields(CHARACTER_FIELDS)}\n\n"
+                f"--- 現在の状況 ---\n{self.situation_text()}")
+
+
+class CharacterSet:
+    """
+    1ページに描かれた全ての人間のキャラクターと、ページ共通の場面（場所・周囲・雰囲気）。
+    画像の解析は1回で済ませ、話し相手のキャラクターを切り替えるときは persona() で Persona を作るだけにする。
+    キャッシュやインデックスには to_dict() の辞書（モデルのJSON出力と同じ形）で保存する。
+    """
+
+    def __init__(self, characters: list, **scene):
+        self.scene = Persona(False, **{key: scene.get(key) for key, _, _ in SCENE_FIELDS})
+        self.characters = [
+            Persona(True, **{key: character.get(key) for key, _, _ in CHARACTER_FIELDS_WITH_ACTION})
+            for character in characters[:MAX_CHARACTERS]
+        ]
+
+    @property
+    def has_human(self) -> bool:
+        return bool(self.characters)
+
+    def names(self) -> list:
+        return [character.name for character in self.characters]
+
+    def persona(self, index: int = 0) -> Persona:
+        """
+        index 番目のキャラクターの、場面の情報を合わせた Persona を返す。
+        周囲の人物には、同じページの他のキャラクターの名前を加える。人間がいなければ場面だけの Persona を返す。
+        """
+        if not self.characters:
+            return self.scene
+        character = self.characters[index]
+        other_names = [name for position, name in enumerate(self.names()) if position != index]
+        others = "、".join(other_names + ([self.scene.others] if self.scene.others else []))
+        fields = {key: getattr(character, key) for key, _, _ in CHARACTER_FIELDS_WITH_ACTION}
+        fields.update({key: getattr(self.scene, key) for key, _, _ in SCENE_FIELDS}, others=others)
+        return Persona(True, **fields)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CharacterSet":
+        """to_dict() やモデルのJSON出力から作る。形式が違う（古い形式のキャッシュなど）場合は ValueError を送出する。"""
+        if not isinstance(data, dict) or not isinstance(data.get("characters"), list):
+            raise ValueError(f"キャラクターセットの形式が正しくありません: {data!r}")
+        version = data.get("schema_version", CHARACTER_SET_SCHEMA_VERSION)
+        if version != CHARACTER_SET_SCHEMA_VERSION:
+            raise ValueError(f"キャラクターセットの形式のバージョンが違います: {version}")
+        if not all(isinstance(character, dict) for character in data["characters"]):
+            raise ValueError(f"キャラクターの形式が正しくありません: {data['characters']!r}")
+        return cls(data["characters"], **{key: data.get(key) for key, _, _ in SCENE_FIELDS})
+
+    def to_dict(self) -> dict:
+        data = {
+            "schema_version": CHARACTER_SET_SCHEMA_VERSION,
+            "characters": [
+                {key: getattr(character, key) for key, _, _ in CHARACTER_FIELDS_WITH_ACTION}
+                for character in self.characters
+            ],
+        }
+        data.update({key: getattr(self.scene, key) for key, _, _ in SCENE_FIELDS})
+        return data
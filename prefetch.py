@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from PIL import Image
+from ai_init import initialize_ai
+from book_index import get_book_index
+from call_policy import get_call_policy
+from chat_manager import get_ai_response, restore_greeting_conversation
+from session_manager import ConversationSession
+from tts_handler import synthesize_speech_with_gemini
+import tracing
+
+DEFAULT_PREFETCH_WORKERS = 4
+# 先読みの中で順番に行う呼び出し（ペルソナ生成・挨拶・音声化）の CallPolicy
+PREFETCH_CALL_POLICIES = ["vision", "chat", "tts"]
+TAKE_TIMEOUT_PERCENTILE = 95
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class PrefetchedGreeting:
+    """先読みの結果。ペルソナ設定済みの会話状態と、最初の挨拶のテキスト・音声を持つ。"""
+
+    def __init__(self, prepared_session: ConversationSession, greeting_text: str, greeting_pcm: bytes):
+        self.prepared_session = prepared_session
+        self.greeting_text = greeting_text
+        self.greeting_pcm = greeting_pcm
+
+
+class _PrefetchJob:
+    def __init__(self, image_key: str):
+        self.image_key = image_key
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("PREFETCH_WORKERS", DEFAULT_PREFETCH_WORKERS)),
+                thread_name_prefix="persona-prefetch",
+            )
+        return _executor
+
+
+def _load_from_book_index(prepared_session: ConversationSession, image: Image.Image):
+    """前処理CLI（book_preprocessor.py）で用意済みのページであれば、モデルを呼ばずに結果を組み立てる。"""
+    try:
+        entry = get_book_index().get(image)
+    except Exception as e:
+        print(f"絵本インデックスの参照中にエラーが発生しました: {e}")
+        return None
+    if entry is None:
+        return None
+    if not restore_greeting_conversation(image, entry["character_set"], entry["greeting_text"], session=prepared_session):
+        return None
+    greeting_pcm = entry["greeting_pcm"]
+    if greeting_pcm is None:
+        greeting_pcm = synthesize_speech_with_gemini(entry["greeting_text"], voice_name=prepared_session.voice_name)
+    return PrefetchedGreeting(prepared_session, entry["greeting_text"], greeting_pcm)
+
+
+def _run_prefetch(session_id: str, image: Image.Image, job: _PrefetchJob):
+    """
+    別の（仮の）会話状態の上で、ペルソナ生成・チャット開始・最初の挨拶・その音声化までを済ませておく。
+    利用者の会話状態には触らないので、途中で取り消されても影響はない。
+    """
+    if not initialize_ai():  # 起動直後であれば、ウォームアップでの初期化の完了を待つ
+        return None
+    prepared_session = ConversationSession(f"{session_id}:prefetch")
+    indexed = _load_from_book_index(prepared_session, image)
+    if indexed is not None:
+        return indexed
+
+    greeting_text = get_ai_response(user_prompt="", image_data=image, session=prepared_session)
+    if job.cancelled.is_set():
+        return None
+    if prepared_session.chat_session is None or not prepared_session.chat_session.history:
+        # ペルソナ生成や挨拶の生成に失敗した場合は、通常の流れ（最初のターンで画像を送る）に任せる
+        print(f"ペルソナの先読みに失敗したため、最初のターンで改めて処理します: {greeting_text}")
+        return None
+
+    greeting_pcm = synthesize_speech_with_gemini(greeting_text, voice_name=prepared_session.voice_name)
+    if job.cancelled.is_set():
+        return None
+    print("ペルソナと最初の挨拶（音声つき）の先読みが完了しました。")
+    return PrefetchedGreeting(prepared_session, greeting_text, greeting_pcm)
+
+
+def start_persona_prefetch(session: ConversationSession, image_key: str, image: Image.Image):
+    """
+    画像が選ばれた時点で、ペルソナ生成と最初の挨拶の生成をバックグラウンドで始める。
+    同じ画像の先読みがすでに動いていれば何もしない。別の画像の先読みは取り消す。
+    """
+    with session.lock:
+        current = session.prefetch
+        if current is not None and current.image_key == image_key and not current.cancelled.is_set():
+            return
+        if current is not None:
+            current.cancel()
+        job = _PrefetchJob(image_key)
+        job.future = _get_executor().submit(
+            tracing.run_in_current_turn(_run_prefetch), session.session_id, image.copy(), job
+        )
+        session.prefetch = job
+    print(f"画像が選ばれたので、ペルソナと挨拶の先読みを開始しました（{image_key[:12]}）。")
+
+
+def cancel_persona_prefetch(session: ConversationSession):
+    """画像がクリアされた場合などに、実行中の先読みを取り消す。"""
+    with session.lock:
+        if session.prefetch is not None:
+            session.prefetch.cancel()
+            session.prefetch = None
+            print("ペルソナと挨拶の先読みを取り消しました。")
+
+
+def _take_timeout_seconds(job: _PrefetchJob) -> float:
+    """
+    先読みの結果を、あと何秒まで待つかを返す。
+    先読みの中の呼び出しはそれぞれの CallPolicy の期限で打ち切られるので、期限の合計を過ぎて待っても結果は来ない。
+    直近の所要時間がわかっていれば、その p95 の合計を過ぎた先読みは遅れているとみなして待つのをやめ、
+    通常の流れ（最初のターンで画像を送る）に切り替える。生成済みのペルソナはキャッシュから使われる。
+    環境変数 'PREFETCH_TAKE_TIMEOUT_SECONDS' を指定した場合は、それを上限にする。
+    """
+    policies = [get_call_policy(name) for name in PREFETCH_CALL_POLICIES]
+    budget = sum(policy.deadline_seconds for policy in policies)
+    typical = [policy.latency_percentile(TAKE_TIMEOUT_PERCENTILE) for policy in policies]
+    if all(seconds is not None for seconds in typical):
+        budget = min(budget, sum(typical))
+    if os.getenv("PREFETCH_TAKE_TIMEOUT_SECONDS"):
+        budget = min(budget, float(os.getenv("PREFETCH_TAKE_TIMEOUT_SECONDS")))
+    return max(0.0, job.started + budget - time.monotonic())
+
+
+def take_prefetched_greeting(session: ConversationSession, image_key: str, timeout: float = None):
+    """
+    画像に対応する先読みの結果を受け取る（実行中であれば完了まで待つ）。
+    対応する先読みがない、失敗した、または時間内に終わらなかった場合は None を返す。
+    timeout を省略した場合は、呼び出しの期限と直近の所要時間から決める（_take_timeout_seconds）。
+    """
+    with session.lock:
+        job = session.prefetch
+        if job is None or job.image_key != image_key or job.cancelled.is_set():
+            return None
+        session.prefetch = None
+    timeout = timeout if timeout is not None else _take_timeout_seconds(job)
+    try:
+        return job.future.result(timeout=timeout)
+    except FutureTimeoutError:
+        job.cancel()
+        print("ペルソナの先読みが時間内に終わらなかったため、最初のターンで改めて処理します。")
+        return None
+    except Exception as e:
+        print(f"ペルソナの先読み中にエラーが発生しました: {e}")
+        return None
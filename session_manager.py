@@ -0,0 +1,268 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+except ImportError:  # Streamlit外（CLIやベンチマーク）から使う場合
+    get_script_run_ctx = None
+
+DEFAULT_SESSION_ID = "default"
+DEFAULT_MAX_SESSIONS = 50
+DEFAULT_IDLE_TIMEOUT_SECONDS = 30 * 60  # 30分
+# 接続が切れたセッションを残しておく時間。短い通信の途切れから再接続したときは、同じ会話を続けられる
+DEFAULT_DISCONNECT_GRACE_SECONDS = 60
+
+# 会話のキャラクター設定の状態
+PERSONA_STATUS_NONE = "none"            # まだ画像が送られていない
+PERSONA_STATUS_CHARACTER = "character"  # 画像の人間のキャラクターとして応答中
+PERSONA_STATUS_NO_HUMAN = "no_human"    # 画像に人間がいないため、状況の説明のみ
+PERSONA_STATUS_DEFAULT = "default"      # 画像なしで始めた、フレンドリーなAIアシスタント
+PERSONA_STATUS_ERROR = "error"          # 画像からキャラクター情報を取得できなかった
+DEFAULT_VOICE_NAME = "Fenrir"
+
+
+class SessionLimitError(RuntimeError):
+    """同時に扱えるセッション数の上限に達したときに送出される例外。"""
+
+
+class SessionLock:
+    """
+    会話状態を守る、再入可能なロック。同期APIからは with、非同期APIからは async with で取る。
+    持ち主はスレッド（イベントループ上では asyncio のタスク）なので、非同期のターンの中から同期の処理
+    （履歴の要約の開始など）を呼んでも同じロックを取り直せる。非同期での空き待ちはスレッドで行い、イベントループを止めない。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+
+    @staticmethod
+    def _current_owner():
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:  # イベントループの外
+            task = None
+        return task or threading.current_thread()
+
+    def _acquire(self, owner):
+        with self._condition:
+            while self._owner is not None and self._owner is not owner:
+                self._condition.wait()
+            self._owner = owner
+            self._count += 1
+
+    def _release(self, owner):
+        with self._condition:
+            if self._owner is not owner:
+                raise RuntimeError("持っていないセッションのロックを解放しようとしました")
+            self._count -= 1
+            if self._count == 0:
+                self._owner = None
+                self._condition.notify()
+
+    def __enter__(self):
+        self._acquire(self._current_owner())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release(self._current_owner())
+
+    async def __aenter__(self):
+        owner = self._current_owner()
+        with self._condition:
+            if self._owner is None or self._owner is owner:
+                self._owner = owner
+                self._count += 1
+                return self
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self._acquire, owner))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # 空き待ちの途中で取り消された場合は、取れた時点ですぐに手放す
+            acquiring.add_done_callback(
+                lambda future: future.cancelled() or future.exception() or self._release(owner))
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release(self._current_owner())
+
+
+class ConversationSession:
+    """
+    1人の利用者（Streamlitセッション）ごとの会話状態。
+    チャットセッション、ペルソナ（persona_schema.Persona）、TTSの声を保持し、更新は同期・非同期APIのどちらからも lock を取ってから行う。
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.chat_session = None
+        self.persona = None  # 話し相手のキャラクターのペルソナ。UIの表示やTTSの声種で参照
+        self.character_set = None  # ページの全キャラクターと共通の場面（persona_schema.CharacterSet）
+        self.active_character_index = 0  # character_set の中で、いま話しているキャラクター
+        self.character_chats = {}  # 切り替える前に話していたキャラクターの会話（キャラクターの番号 -> 会話の状態）
+        self.persona_status = PERSONA_STATUS_NONE
+        self.voice_name = DEFAULT_VOICE_NAME
+        self.system_instruction = None  # ペルソナの設定文（チャットのシステム指示）
+        self.history_summary = ""       # 要約済みの古い会話
+        self.last_prompt_tokens = 0
+        self.tokens_sent_per_turn = deque(maxlen=1000)
+        self.prefetch = None  # 画像選択時に始めたペルソナ・挨拶の先読み（prefetch.py）
+        self.history_compaction = None  # バックグラウンドで実行中の、古い会話の要約（history_manager.py）
+        self.lock = SessionLock()
+        self.last_access = time.monotonic()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+
+def is_streamlit_session_active(session_id: str) -> bool:
+    """Streamlitのセッション（ブラウザのタブ）がまだ接続中かどうかを返す。Streamlit外では常に True。"""
+    try:
+        from streamlit import runtime
+    except ImportError:
+        return True
+    if not runtime.exists():
+        return True
+    return runtime.get_instance().is_active_session(session_id)
+
+
+class SessionManager:
+    """
+    セッションIDごとに ConversationSession を管理するクラス。
+    一定時間使われていないセッションと、ブラウザの再読み込みやタブを閉じたことで接続が切れたセッションは破棄し、
+    同時セッション数に上限を設ける。
+    """
+
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS,
+                 idle_timeout_seconds: float = DEFAULT_IDLE_TIMEOUT_SECONDS,
+                 disconnect_grace_seconds: float = DEFAULT_DISCONNECT_GRACE_SECONDS,
+                 is_session_active=is_streamlit_session_active):
+        self.max_sessions = max_sessions
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self.is_session_active = is_session_active
+        self._sessions = {}
+        self._session_end_callbacks = []
+        self._lock = threading.Lock()
+
+    def add_session_end_callback(self, callback):
+        """セッションの破棄時に callback(session_id) を呼ぶよう登録する。"""
+        with self._lock:
+            self._session_end_callbacks.append(callback)
+
+    def _notify_session_end(self, session_ids):
+        for session_id in session_ids:
+            for callback in list(self._session_end_callbacks):
+                try:
+                    callback(session_id)
+                except Exception as e:
+                    print(f"セッション終了時の後片付け中にエラーが発生しました（{session_id}）: {e}")
+
+    def get(self, session_id: str) -> ConversationSession:
+        """セッションを返す。なければ作成する。上限に達している場合は SessionLimitError を送出する。"""
+        evicted_ids = []
+        try:
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    evicted_ids = self._evict_idle_locked() + self._evict_disconnected_locked()
+                    if len(self._sessions) >= self.max_sessions:
+                        # 上限に達していれば、再接続の猶予中のものも含めて、接続が切れたセッションを全て破棄する
+                        evicted_ids += self._evict_disconnected_locked(grace_seconds=0)
+                    if len(self._sessions) >= self.max_sessions:
+                        raise SessionLimitError(f"同時に利用できるセッション数（{self.max_sessions}）の上限に達しました。")
+                    session = ConversationSession(session_id)
+                    self._sessions[session_id] = session
+                    print(f"新しい会話セッションを作成しました: {session_id}（現在 {len(self._sessions)} 件）")
+                session.touch()
+                return session
+        finally:
+            self._notify_session_end(evicted_ids)
+
+    def remove(self, session_id: str):
+        """セッションを明示的に破棄する。"""
+        with self._lock:
+            removed = self._sessions.pop(session_id, None)
+        if removed is not None:
+            self._notify_session_end([session_id])
+
+    def evict_idle(self) -> int:
+        """アイドル時間を超えたセッションを破棄し、破棄した件数を返す。"""
+        with self._lock:
+            idle_ids = self._evict_idle_locked()
+        self._notify_session_end(idle_ids)
+        return len(idle_ids)
+
+    def _evict_idle_locked(self) -> list:
+        deadline = time.monotonic() - self.idle_timeout_seconds
+        idle_ids = [session_id for session_id, session in self._sessions.items() if session.last_access < deadline]
+        for session_id in idle_ids:
+            del self._sessions[session_id]
+        if idle_ids:
+            print(f"アイドル状態の会話セッションを {len(idle_ids)} 件破棄しました。")
+        return idle_ids
+
+    def _evict_disconnected_locked(self, grace_seconds: float = None) -> list:
+        """
+        Streamlitのセッションが既に存在しない（再読み込みで新しいセッションIDになった、タブを閉じたなど）セッションを破棄する。
+        最後の利用から grace_seconds 秒以内のものは、再接続に備えて残す。
+        """
+        if grace_seconds is None:
+            grace_seconds = self.disconnect_grace_seconds
+        deadline = time.monotonic() - grace_seconds
+        disconnected_ids = [
+            session_id for session_id, session in self._sessions.items()
+            if session.last_access <= deadline and not self.is_session_active(session_id)
+        ]
+        for session_id in disconnected_ids:
+            del self._sessions[session_id]
+        if disconnected_ids:
+            print(f"接続が切れた会話セッションを {len(disconnected_ids)} 件破棄しました。")
+        return disconnected_ids
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    """環境変数の設定で作られた、プロセス内共有のセッションマネージャーを返す。"""
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = SessionManager(
+                max_sessions=int(os.getenv("MAX_CONCURRENT_SESSIONS", DEFAULT_MAX_SESSIONS)),
+                idle_timeout_seconds=float(os.getenv("SESSION_IDLE_TIMEOUT_SECONDS", DEFAULT_IDLE_TIMEOUT_SECONDS)),
+                disconnect_grace_seconds=float(os.getenv("SESSION_DISCONNECT_GRACE_SECONDS",
+                                                         DEFAULT_DISCONNECT_GRACE_SECONDS)),
+            )
+        return _default_manager
+
+
+def get_current_session_id() -> str:
+    """実行中のStreamlitセッションIDを返す。Streamlit外では既定のIDを返す。"""
+    if get_script_run_ctx is not None:
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    return DEFAULT_SESSION_ID
+
+
+def get_session(session: ConversationSession = None) -> ConversationSession:
+    """
+    会話セッションを解決する関数。
+    明示的に渡された場合はそれを、そうでなければ現在のStreamlitセッションのものを返す。
+    ワーカースレッドからはStreamlitのセッションを判別できないため、呼び出し元で解決して渡すこと。
+    """
+    if session is not None:
+        return session
+    return get_session_manager().get(get_current_session_id())
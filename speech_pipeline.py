@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from chat_manager import get_ai_response_stream
+from session_manager import ConversationSession, get_session
+from tts_handler import synthesize_pcm_with_gemini
+import tracing
+
+SENTENCE_TERMINATORS = "。！？!?\n"
+# 文末記号の直後に続く閉じ括弧などは、同じ文に含める
+SENTENCE_TRAILERS = "」』）)〉》】…ー〜～"
+
+_DONE = object()
+
+
+def split_sentences_incrementally(text_chunks):
+    """
+    ストリーミングで届くテキスト断片を受け取り、日本語の文末（。！？）で区切れた文から順に yield する。
+    最後に残った文末記号のない部分も1文として返す。
+    """
+    buffer = ""
+    for chunk in text_chunks:
+        buffer += chunk
+        while True:
+            end = _find_sentence_end(buffer)
+            if end is None:
+                break
+            sentence, buffer = buffer[:end].strip(), buffer[end:]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def _find_sentence_end(text: str):
+    for index, char in enumerate(text):
+        if char in SENTENCE_TERMINATORS:
+            end = index + 1
+            while end < len(text) and (text[end] in SENTENCE_TERMINATORS or text[end] in SENTENCE_TRAILERS):
+                end += 1
+            if end == len(text) and text[-1] not in "\n":
+                # 続きの断片で閉じ括弧や「！？」が続く可能性があるので、次の断片を待つ
+                return None
+            return end
+    return None
+
+
+def stream_reply_with_speech(user_prompt: str, image_data: Image.Image = None, max_workers: int = None,
+                             session: ConversationSession = None):
+    """
+    応答をストリーミングで受け取りつつ、文ごとに並行して音声合成する関数。
+    (文, PCMバイト列) を文の順番どおりに yield する。音声合成に失敗した文のPCMは None になる。
+    後続の文の生成・音声合成は、先頭の文を再生している間もバックグラウンドで進む。
+    """
+    # ワーカースレッドからはStreamlitのセッションを判別できないので、ここで解決しておく
+    session = get_session(session)
+    max_workers = max_workers or int(os.getenv("STREAMING_TTS_WORKERS", "3"))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-sentence")
+    sentence_queue = queue.Queue()
+
+    def produce():
+        try:
+            voice_name = None
+            for sentence in split_sentences_incrementally(get_ai_response_stream(user_prompt, image_data, session)):
+                if voice_name is None:
+                    # ペルソナは応答生成の直前に確定するので、最初の文が届いた時点で声を決める
+                    voice_name = session.voice_name
+                synthesize = tracing.run_in_current_turn(synthesize_pcm_with_gemini)
+                sentence_queue.put((sentence, executor.submit(synthesize, sentence, voice_name)))
+        except Exception as e:
+            print(f"ストリーミング応答の生成中にエラーが発生しました: {e}")
+        finally:
+            sentence_queue.put(_DONE)
+
+    producer = threading.Thread(target=tracing.run_in_current_turn(produce), daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = sentence_queue.get()
+            if item is _DONE:
+                break
+            sentence, future = item
+            try:
+                pcm_bytes = future.result()
+            except Exception as e:
+                print(f"❌ 文単位の音声生成エラー: {e}")
+                pcm_bytes = None
+            yield sentence, pcm_bytes
+    finally:
+        producer.join()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+
+from audio_buffer import decode_to_mono_float32, resample
+
+
+def _tone(frequency, sample_rate, seconds=1.0):
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    return np.sin(2 * np.pi * frequency * t)
+
+
+def _level(audio, frequency, sample_rate):
+    """端の過渡部分を除いた、指定周波数の振幅。"""
+    audio = audio[2000:-2000]
+    t = np.arange(len(audio)) / sample_rate
+    return abs(np.dot(audio, np.exp(-2j * np.pi * frequency * t))) * 2 / len(audio)
+
+
+@pytest.mark.parametrize("source_rate", [44100, 48000, 22050])
+def test_resample_keeps_speech_band(source_rate):
+    output = resample(_tone(1000, source_rate), source_rate, 16000)
+    assert len(output) == 16000
+    assert _level(output, 1000, 16000) == pytest.approx(1.0, abs=0.01)
+
+
+@pytest.mark.parametrize("source_rate", [44100, 48000])
+def test_resample_does_not_alias_high_frequencies(source_rate):
+    # 12kHz は16kHzにすると 4kHz に折り返す。低域通過フィルタで十分に落ちていること
+    output = resample(_tone(12000, source_rate), source_rate, 16000)
+    assert _level(output, 4000, 16000) < 1e-3
+
+
+def test_decode_to_mono_float32_mixes_channels_and_resamples():
+    stereo = np.stack([_tone(440, 48000), _tone(440, 48000)], axis=1).astype(np.float32) * 0.5
+    buffer = io.BytesIO()
+    sf.write(buffer, stereo, 48000, format="WAV")
+    audio = decode_to_mono_float32(buffer.getvalue(), 16000)
+    assert audio.dtype == np.float32
+    assert len(audio) == 16000
+    assert _level(audio, 440, 16000) == pytest.approx(0.5, abs=0.01)
@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("soundfile")
+Image = pytest.importorskip("PIL.Image")
+
+import ai_init
+import book_preprocessor
+import call_policy
+from benchmarks.fake_backends import FakeBackendConfig, install_fake_backends
+
+
+class CountingRateLimiter(book_preprocessor.RateLimiter):
+    def __init__(self):
+        super().__init__(0)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+
+def test_rate_limiter_counts_every_api_request(monkeypatch):
+    monkeypatch.setattr(call_policy, "_policies", {})
+    config = FakeBackendConfig(chat_latency=0.0, vision_latency=0.0, tts_latency=0.0, tts_seconds_per_char=0.0,
+                               jitter=0.0, error_rate=1.0)
+    with install_fake_backends(config):
+        requests = []
+        generate_content = ai_init.model.generate_content
+        monkeypatch.setattr(ai_init.model, "generate_content",
+                            lambda *args, **kwargs: requests.append(args) or generate_content(*args, **kwargs))
+        book_preprocessor.use_single_request_policies()
+        limiter = CountingRateLimiter()
+        with pytest.raises(book_preprocessor.PagePreprocessError):
+            book_preprocessor.preprocess_page(Image.new("RGB", (32, 32)), limiter, max_attempts=3,
+                                              retry_base_seconds=0.0)
+    # 一時的なエラーが続いても、APIへの要求は with_retries の試行（＝レートリミッターを通った回数）だけ
+    assert len(requests) == limiter.acquired == 3
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+import pytest
+import call_policy
+import gemini_client
+from call_policy import CallPolicy, CallTimeoutError, CircuitBreaker, CircuitOpenError
+
+
+class ServiceUnavailable(Exception):
+    code = 503
+
+
+def failing_then_ok(failures: int, error=ServiceUnavailable):
+    calls = {"count": 0}
+
+    def request(timeout):
+        calls["count"] += 1
+        if calls["count"] <= failures:
+            raise error("一時的なエラー")
+        return "ok"
+
+    return request, calls
+
+
+def warmed_up_policy(**kwargs) -> CallPolicy:
+    """ヘッジの判定に使う所要時間を、約20msの成功で埋めておいたポリシー。"""
+    policy = CallPolicy("test", deadline_seconds=5.0, hedge_percentile=95, hedge_min_samples=5, **kwargs)
+    for _ in range(5):
+        policy.call(lambda timeout: time.sleep(0.02))
+    return policy
+
+
+def test_retries_transient_errors_until_success():
+    policy = CallPolicy("test", deadline_seconds=5.0, max_attempts=3, backoff_base_seconds=0.01)
+    request, calls = failing_then_ok(2)
+    assert policy.call(request) == "ok"
+    assert calls["count"] == 3
+    assert policy.stats()["retries"] == 2
+
+
+def test_gives_up_after_max_attempts():
+    policy = CallPolicy("test", deadline_seconds=5.0, max_attempts=2, backoff_base_seconds=0.01)
+    request, calls = failing_then_ok(5)
+    with pytest.raises(ServiceUnavailable):
+        policy.call(request)
+    assert calls["count"] == 2
+    assert policy.stats()["failures"] == 1
+
+
+def test_does_not_retry_non_transient_errors():
+    policy = CallPolicy("test", deadline_seconds=5.0, max_attempts=3, backoff_base_seconds=0.01)
+    request, calls = failing_then_ok(1, error=ValueError)
+    with pytest.raises(ValueError):
+        policy.call(request)
+    assert calls["count"] == 1
+
+
+def test_passes_remaining_time_to_each_attempt():
+    policy = CallPolicy("test", deadline_seconds=5.0, attempt_timeout_seconds=2.0, idempotent=False)
+    timeouts = []
+    policy.call(lambda timeout: timeouts.append(timeout))
+    assert 0 < timeouts[0] <= 2.0
+
+
+def test_idempotent_call_is_cut_off_at_the_deadline():
+    policy = CallPolicy("test", deadline_seconds=0.2, max_attempts=1)
+    started = time.monotonic()
+    with pytest.raises(CallTimeoutError):
+        policy.call(lambda timeout: time.sleep(1.0))
+    assert time.monotonic() - started < 0.5
+    assert policy.stats()["timeouts"] == 1
+
+
+def test_hedges_a_slow_request_and_uses_the_first_result():
+    policy = warmed_up_policy()
+    calls = {"count": 0}
+    lock = threading.Lock()
+
+    def request(timeout):
+        with lock:
+            calls["count"] += 1
+            attempt = calls["count"]
+        time.sleep(1.0 if attempt == 1 else 0.02)
+        return attempt
+
+    started = time.monotonic()
+    assert policy.call(request) == 2
+    assert time.monotonic() - started < 0.5
+    stats = policy.stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+
+
+def test_does_not_hedge_without_enough_samples():
+    policy = CallPolicy("test", deadline_seconds=5.0, hedge_percentile=95, hedge_min_samples=5)
+    assert policy.call(lambda timeout: time.sleep(0.05) or "ok") == "ok"
+    assert policy.stats()["hedges"] == 0
+
+
+def test_non_idempotent_calls_are_never_hedged():
+    policy = warmed_up_policy(idempotent=False)
+    assert policy.call(lambda timeout: time.sleep(0.1) or "ok") == "ok"
+    assert policy.stats()["hedges"] == 0
+
+
+def test_async_hedge_and_timeout():
+    async def scenario():
+        policy = warmed_up_policy()
+        calls = {"count": 0}
+
+        async def request(timeout):
+            calls["count"] += 1
+            attempt = calls["count"]
+            await asyncio.sleep(1.0 if attempt == 1 else 0.02)
+            return attempt
+
+        assert await policy.call_async(request) == 2
+
+        slow = CallPolicy("test", deadline_seconds=0.2, max_attempts=1)
+        with pytest.raises(CallTimeoutError):
+            await slow.call_async(lambda timeout: asyncio.sleep(1.0))
+
+    asyncio.run(scenario())
+
+
+def test_circuit_breaker_state_transitions():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=0.1)
+    policy = CallPolicy("test", deadline_seconds=1.0, max_attempts=1, circuit_breaker=breaker)
+    request, _ = failing_then_ok(100)
+
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            policy.call(request)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda timeout: "ok")
+    assert policy.stats()["rejected"] == 1
+
+    # 時間が経つと半開になり、1回だけ試す。失敗すればまた開く
+    time.sleep(0.15)
+    assert breaker.state == "half_open"
+    with pytest.raises(ServiceUnavailable):
+        policy.call(request)
+    assert breaker.state == "open"
+
+    # 半開での試行が成功すれば閉じる
+    time.sleep(0.15)
+    assert policy.call(lambda timeout: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_allows_only_one_trial():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.1)
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_call_slot_wait_respects_timeout(monkeypatch):
+    monkeypatch.setattr(gemini_client, "_sync_slots", threading.BoundedSemaphore(1))
+    with gemini_client.gemini_call_slot(0.1):
+        started = time.monotonic()
+        with pytest.raises(CallTimeoutError):
+            with gemini_client.gemini_call_slot(0.1):
+                pass
+        assert time.monotonic() - started < 0.5
+    # 枠は返されているので、次は取れる
+    with gemini_client.gemini_call_slot(0.1):
+        pass
+
+
+def test_get_call_policy_reads_environment(monkeypatch):
+    monkeypatch.setattr(call_policy, "_policies", {})
+    monkeypatch.setenv("CALL_POLICY_TTS_DEADLINE_SECONDS", "7.5")
+    monkeypatch.setenv("CALL_POLICY_TTS_MAX_ATTEMPTS", "4")
+    policy = call_policy.get_call_policy("tts")
+    assert policy.deadline_seconds == 7.5
+    assert policy.max_attempts == 4
+    assert policy.circuit_breaker is not None
+    assert call_policy.get_call_policy("tts") is policy
+    assert call_policy.get_call_policy("chat").idempotent is False
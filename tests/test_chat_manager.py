@@ -0,0 +1,88 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("soundfile")
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("google.generativeai")  # ペルソナ生成の構造化出力の設定に使う
+
+import chat_manager
+import persona_cache
+from benchmarks.fake_backends import FakeBackendConfig, install_fake_backends
+from persona_extractor import PersonaExtractionError
+from session_manager import PERSONA_STATUS_CHARACTER, PERSONA_STATUS_ERROR, ConversationSession
+
+
+@pytest.fixture
+def fake_backends():
+    config = FakeBackendConfig(chat_latency=0.0, vision_latency=0.0, tts_latency=0.0, tts_seconds_per_char=0.0,
+                               jitter=0.0)
+    with install_fake_backends(config):
+        yield config
+
+
+def test_persona_error_reply_does_not_read_out_the_exception(fake_backends, monkeypatch):
+    def fail(image):
+        raise PersonaExtractionError("画像からキャラクター情報や状況を生成できませんでした。\n詳細: 504 Deadline Exceeded")
+
+    monkeypatch.setattr(chat_manager, "generate_character_set_from_image", fail)
+    session = ConversationSession("persona-error")
+    reply = chat_manager.get_ai_response("", Image.new("RGB", (32, 32)), session=session)
+    assert reply == chat_manager.PERSONA_FALLBACK_REPLY
+    assert session.persona_status == PERSONA_STATUS_ERROR
+
+
+def _page():
+    return Image.new("RGB", (32, 32), "pink")
+
+
+def _start_page(session):
+    """代替のペルソナ生成（はなこ・たろうの2人）で、ページの最初の挨拶まで済ませる。"""
+    chat_manager.get_ai_response("", _page(), session=session)
+    return session
+
+
+def test_switch_character_keeps_each_characters_chat(fake_backends):
+    session = _start_page(ConversationSession("switch"))
+    assert chat_manager.get_character_choices(session) == (["はなこ", "たろう"], 0)
+    assert session.voice_name == "Sulafat"  # 女性
+    hanako_chat = session.chat_session
+    chat_manager.get_ai_response("なにしてるの？", session=session)
+
+    taro = chat_manager.switch_character(1, session)
+    assert taro.name == "たろう"
+    assert taro.others == "はなこ、白いうさぎ"
+    assert session.voice_name == "Charon"  # 男性
+    assert session.persona_status == PERSONA_STATUS_CHARACTER
+    assert session.chat_session is not hanako_chat
+    assert "たろう" in session.system_instruction
+    taro_chat = session.chat_session
+    chat_manager.get_ai_response("こんにちは", session=session)
+
+    # 戻ると、はなことの会話の続きから話せる（モデルは呼ばない）
+    hanako = chat_manager.switch_character(0, session)
+    assert hanako.name == "はなこ"
+    assert session.chat_session is hanako_chat
+    assert len(hanako_chat.history) == 4  # 挨拶 + 1往復
+    assert session.voice_name == "Sulafat"
+    assert "はなこ" in session.system_instruction
+
+    chat_manager.switch_character(1, session)
+    assert session.chat_session is taro_chat
+    assert len(taro_chat.history) == 2
+
+
+def test_switch_character_rejects_unknown_characters(fake_backends):
+    session = ConversationSession("switch-unknown")
+    with pytest.raises(ValueError):
+        chat_manager.switch_character(0, session)
+    _start_page(session)
+    with pytest.raises(ValueError):
+        chat_manager.switch_character(2, session)
+
+
+def test_old_persona_cache_entry_is_regenerated(fake_backends):
+    # 以前の形式（キャラクター1人分のペルソナ）で保存されたエントリ
+    persona_cache.get_persona_cache().put(_page(), {"has_human": True, "name": "むかしのはなこ"})
+    session = _start_page(ConversationSession("old-cache"))
+    assert session.character_set.names() == ["はなこ", "たろう"]
+    assert persona_cache.get_persona_cache().get(_page())["characters"][0]["name"] == "はなこ"
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("PIL")
+genai = pytest.importorskip("google.generativeai")
+
+from google.generativeai import protos
+from google.generativeai.types import generation_types
+
+import ai_init
+import chat_manager
+from session_manager import ConversationSession
+
+FINISH_STOP = 1
+FINISH_SAFETY = 3
+
+
+def _chunk(text, finish_reason=0):
+    return protos.GenerateContentResponse(candidates=[protos.Candidate(
+        content=protos.Content(role="model", parts=[protos.Part(text=text)]), finish_reason=finish_reason)])
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """本物の ChatSession に、ストリームの終わり方を切り替えられる generate_content を差し込む。"""
+    endings = []
+
+    def chunks():
+        yield _chunk("こんにちは。")
+        ending = endings.pop(0) if endings else "stop"
+        if ending == "break":
+            raise ConnectionError("ストリームが切れました")
+        yield _chunk("" if ending == "safety" else "またね。", FINISH_SAFETY if ending == "safety" else FINISH_STOP)
+
+    def generate_content(contents, stream=False, **kwargs):
+        if stream:
+            return generation_types.GenerateContentResponse.from_iterator(chunks())
+        return generation_types.GenerateContentResponse.from_response(_chunk("うん！", FINISH_STOP))
+
+    model = genai.GenerativeModel("fake")
+    monkeypatch.setattr(model, "generate_content", generate_content)
+    monkeypatch.setattr(ai_init, "model", model)
+    session = ConversationSession("stream-test")
+    session.chat_session = model.start_chat()
+    return session, endings
+
+
+def _reply(session):
+    return "".join(chat_manager.get_ai_response_stream("やあ", session=session))
+
+
+@pytest.mark.parametrize("ending", ["break", "safety"])
+def test_broken_stream_does_not_break_later_turns(chat, ending):
+    session, endings = chat
+    assert _reply(session) == "こんにちは。またね。"
+    endings.append(ending)
+    _reply(session)
+    # 壊れた応答は履歴から取り除かれ、次のターンはストリーミングでも通常の呼び出しでも答えられる
+    assert len(session.chat_session.history) == 2
+    assert _reply(session) == "こんにちは。またね。"
+    assert chat_manager.get_ai_response("やあ", session=session) == "うん！"
+    assert len(session.chat_session.history) == 6
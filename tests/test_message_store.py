@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+from message_store import remove_stale_process_dirs
+
+
+def test_removes_only_directories_of_finished_processes(tmp_path):
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    for name in [str(os.getpid()), str(os.getppid()), str(finished.pid), "shared"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "blob").write_bytes(b"audio")
+
+    remove_stale_process_dirs(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == sorted([str(os.getpid()), str(os.getppid()), "shared"])
+
+
+def test_missing_root_is_ignored(tmp_path):
+    remove_stale_process_dirs(str(tmp_path / "missing"))
@@ -0,0 +1,54 @@
+import pytest
+
+from persona_schema import CHARACTER_SET_SCHEMA_VERSION, MAX_CHARACTERS, CharacterSet
+
+PAGE = {
+    "characters": [
+        {"name": "はなこ", "gender": "女性", "action": "お花を摘んでいる"},
+        {"name": "たろう", "gender": "男の子", "action": "うさぎをなでている"},
+    ],
+    "place": "お花畑",
+    "others": "白いうさぎ",
+    "mood": "明るく楽しい",
+}
+
+
+def test_persona_merges_the_scene_and_the_other_characters():
+    character_set = CharacterSet.from_dict(PAGE)
+    persona = character_set.persona(1)
+    assert persona.name == "たろう"
+    assert persona.gender == "不明"  # 男性・女性・不明 以外は 不明 に揃える
+    assert persona.action == "うさぎをなでている"
+    assert persona.place == "お花畑"
+    assert persona.others == "はなこ、白いうさぎ"
+
+
+def test_round_trip_keeps_every_character():
+    character_set = CharacterSet.from_dict(PAGE)
+    restored = CharacterSet.from_dict(character_set.to_dict())
+    assert restored.names() == ["はなこ", "たろう"]
+    assert restored.to_dict() == character_set.to_dict()
+    assert restored.to_dict()["schema_version"] == CHARACTER_SET_SCHEMA_VERSION
+
+
+def test_page_without_people_uses_the_scene_only():
+    character_set = CharacterSet.from_dict({"characters": [], "place": "森の中"})
+    assert not character_set.has_human
+    assert not character_set.persona().has_human
+    assert character_set.persona().place == "森の中"
+
+
+def test_characters_are_capped():
+    many = {"characters": [{"name": f"子{index}"} for index in range(MAX_CHARACTERS + 3)]}
+    assert len(CharacterSet.from_dict(many).characters) == MAX_CHARACTERS
+
+
+@pytest.mark.parametrize("data", [
+    {"has_human": True, "name": "はなこ"},  # 以前の形式（キャラクター1人分のペルソナ）
+    {**PAGE, "schema_version": CHARACTER_SET_SCHEMA_VERSION + 1},
+    {"characters": ["はなこ"]},
+    "はなこ",
+])
+def test_rejects_other_formats(data):
+    with pytest.raises(ValueError):
+        CharacterSet.from_dict(data)
@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+pytest.importorskip("PIL")
+
+import call_policy
+import prefetch
+
+
+@pytest.fixture
+def fresh_policies(monkeypatch):
+    monkeypatch.setattr(call_policy, "_policies", {})
+    monkeypatch.delenv("PREFETCH_TAKE_TIMEOUT_SECONDS", raising=False)
+
+
+def _deadline_total():
+    return sum(call_policy.get_call_policy(name).deadline_seconds for name in prefetch.PREFETCH_CALL_POLICIES)
+
+
+def test_take_timeout_covers_the_call_deadlines_without_latency_samples(fresh_policies):
+    job = prefetch._PrefetchJob("page")
+    assert prefetch._take_timeout_seconds(job) == pytest.approx(_deadline_total(), abs=0.5)
+
+
+def test_take_timeout_stops_at_the_typical_latency_once_known(fresh_policies):
+    for name, seconds in [("vision", 2.0), ("chat", 1.0), ("tts", 1.5)]:
+        policy = call_policy.get_call_policy(name)
+        for _ in range(policy.hedge_min_samples):
+            policy._record_latency(seconds)
+    job = prefetch._PrefetchJob("page")
+    job.started -= 1.0  # 画像が選ばれてから1秒たってから話しかけた
+    assert prefetch._take_timeout_seconds(job) == pytest.approx(4.5 - 1.0, abs=0.1)
+
+
+def test_take_timeout_is_capped_by_the_environment(fresh_policies, monkeypatch):
+    monkeypatch.setenv("PREFETCH_TAKE_TIMEOUT_SECONDS", "10")
+    job = prefetch._PrefetchJob("page")
+    job.started = time.monotonic() - 30.0
+    assert prefetch._take_timeout_seconds(job) == 0.0
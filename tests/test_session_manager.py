@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from session_manager import SessionLimitError, SessionLock, SessionManager
+
+
+def make_manager(active: set, **kwargs):
+    ended = []
+    manager = SessionManager(max_sessions=2, is_session_active=lambda session_id: session_id in active, **kwargs)
+    manager.add_session_end_callback(ended.append)
+    return manager, ended
+
+
+def test_refuses_new_session_when_all_are_connected():
+    active = {"a", "b", "c"}
+    manager, ended = make_manager(active)
+    manager.get("a")
+    manager.get("b")
+    with pytest.raises(SessionLimitError):
+        manager.get("c")
+    assert ended == []
+
+
+def test_reloaded_session_frees_its_slot_at_the_limit():
+    active = {"a", "b"}
+    manager, ended = make_manager(active)
+    manager.get("a")
+    manager.get("b")
+    # 再読み込みで "a" のタブは新しいセッション "c" になる
+    active.discard("a")
+    active.add("c")
+    manager.get("c")
+    assert len(manager) == 2
+    assert ended == ["a"]
+
+
+def test_disconnected_session_is_kept_during_grace_period_below_the_limit():
+    active = {"a"}
+    manager, ended = make_manager(active, disconnect_grace_seconds=60)
+    manager.get("a")
+    active.discard("a")
+    manager.get("b")
+    assert len(manager) == 2
+    assert ended == []
+
+
+def test_disconnected_session_is_dropped_after_grace_period():
+    active = {"a"}
+    manager, ended = make_manager(active, disconnect_grace_seconds=0)
+    manager.get("a")
+    active.discard("a")
+    manager.get("b")
+    assert ended == ["a"]
+
+
+def test_session_lock_is_reentrant_from_sync_code_inside_an_async_turn():
+    lock = SessionLock()
+
+    async def turn():
+        async with lock:
+            with lock:  # 非同期のターンの中から呼ぶ同期の処理（履歴の要約の開始など）
+                return "ok"
+
+    assert asyncio.run(turn()) == "ok"
+
+
+def test_session_lock_excludes_threads_and_tasks():
+    lock = SessionLock()
+    events = []
+    held = threading.Event()
+
+    def hold_in_thread():
+        with lock:
+            held.set()
+            time.sleep(0.1)
+            events.append("thread")
+
+    async def turn():
+        async with lock:
+            events.append("task")
+
+    async def scenario():
+        thread = threading.Thread(target=hold_in_thread)
+        thread.start()
+        held.wait()
+        # スレッドがロックを持っている間も、イベントループは止まらない
+        ticks = asyncio.create_task(asyncio.sleep(0.01))
+        await turn()
+        assert ticks.done()
+        thread.join()
+
+    asyncio.run(scenario())
+    assert events == ["thread", "task"]
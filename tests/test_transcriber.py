@@ -0,0 +1,57 @@
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("soundfile")
+
+import transcriber
+from benchmarks.fake_backends import FakeBackendConfig, FakeWhisperModel, make_speech_wav_bytes
+
+
+@pytest.fixture
+def slow_whisper(monkeypatch):
+    """ロードに時間のかかる whisper モジュールに差し替え、モデルの共有状態を空にする。"""
+    loading = threading.Event()
+    model = FakeWhisperModel(FakeBackendConfig(whisper_realtime_factor=0.0, jitter=0.0))
+
+    def load_model(model_size, device=None):
+        loading.set()
+        time.sleep(1.5)
+        return model
+
+    monkeypatch.setitem(__import__("sys").modules, "whisper", types.SimpleNamespace(load_model=load_model))
+    monkeypatch.setenv("WHISPER_INT8", "0")
+    monkeypatch.setattr(transcriber, "_models", {})
+    monkeypatch.setattr(transcriber, "_model_locks", {})
+    monkeypatch.setattr(transcriber, "_executor", None)
+    return loading
+
+
+def test_timeout_holds_while_model_is_loading(slow_whisper):
+    preload = threading.Thread(target=transcriber.get_whisper_model, daemon=True)
+    preload.start()
+    assert slow_whisper.wait(1.0)
+
+    started = time.perf_counter()
+    with pytest.raises(transcriber.TranscriptionTimeoutError):
+        transcriber.transcribe_wav_bytes_with_timeout(make_speech_wav_bytes(0.5), timeout=0.2)
+    # モデルのロード（1.5秒）を待たずに時間切れになる
+    assert time.perf_counter() - started < 1.0
+    preload.join()
+
+
+
+def test_model_lock_is_registered_before_the_model(slow_whisper, monkeypatch):
+    class CheckedModels(dict):
+        def __setitem__(self, key, value):
+            # モデルが見えた時点で、推論用ロックも使えること
+            assert key in transcriber._model_locks
+            super().__setitem__(key, value)
+
+    monkeypatch.setattr(transcriber, "_models", CheckedModels())
+    model = transcriber.get_whisper_model()
+    key = transcriber._model_key(transcriber.get_whisper_model_size(), False)
+    assert transcriber._models[key] is model
@@ -0,0 +1,207 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DEFAULT_LOG_PATH = os.path.join("logs", "trace.jsonl")
+DEFAULT_PROMETHEUS_PATH = os.path.join("logs", "metrics.prom")
+
+_enabled = os.getenv("STORYBOOK_TRACING", "0") == "1"
+_current_turn_id = contextvars.ContextVar("storybook_turn_id", default=None)
+_NULL_CONTEXT = contextlib.nullcontext()
+
+_lock = threading.Lock()
+# ステージ名 -> {"buckets": [...], "sum": 秒, "count": 件数}
+_histograms = {}
+# (カウンター名, ステージ名) -> 値
+_counters = {}
+_log_file = None
+_metrics_server = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled: bool):
+    """計測の有効・無効を切り替える（既定は環境変数 'STORYBOOK_TRACING' が 1 のとき有効）。"""
+    global _enabled
+    _enabled = enabled
+
+
+def current_turn_id():
+    """実行中のターンID。ターンの外では None。"""
+    return _current_turn_id.get()
+
+
+def _observe(stage: str, seconds: float):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            _histograms[stage] = histogram
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+def count(name: str, stage: str = "", amount: int = 1):
+    """キャッシュのヒット数やエラー数などのカウンターを増やす。計測が無効なら何もしない。"""
+    if not _enabled:
+        return
+    with _lock:
+        key = (name, stage)
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def _write_log(record: dict):
+    global _log_file
+    line = json.dumps(record, ensure_ascii=False)
+    with _lock:
+        if _log_file is None:
+            path = os.getenv("TRACING_LOG_PATH", DEFAULT_LOG_PATH)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            _log_file = open(path, "a", encoding="utf-8", buffering=1)
+        _log_file.write(line + "\n")
+
+
+@contextlib.contextmanager
+def _timed_span(stage: str, attributes: dict):
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _observe(stage, elapsed)
+        if error is not None:
+            count("storybook_stage_errors_total", stage)
+        record = {
+            "ts": time.time(),
+            "turn_id": _current_turn_id.get(),
+            "stage": stage,
+            "duration_ms": round(elapsed * 1000.0, 3),
+            "ok": error is None,
+        }
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        if attributes:
+            record.update(attributes)
+        _write_log(record)
+
+
+def span(stage: str, **attributes):
+    """
+    処理の1ステージ（vision, chat, tts, whisper_load, whisper_transcribe など）を計測するコンテキストマネージャー。
+    所要時間をヒストグラムに記録し、ターンIDつきでJSONログに1行書き出す。
+    計測が無効な場合は何もしない空のコンテキストを返すので、オーバーヘッドはほぼない。
+    """
+    if not _enabled:
+        return _NULL_CONTEXT
+    return _timed_span(stage, attributes)
+
+
+@contextlib.contextmanager
+def turn(turn_id: str = None):
+    """
+    1ターン分の処理をまとめるコンテキストマネージャー。中で計測したステージに同じターンIDがつく。
+    すでにターンの中であれば、外側のターンIDをそのまま使う。終了時にメトリクスを書き出す。
+    """
+    if not _enabled or _current_turn_id.get() is not None:
+        yield _current_turn_id.get()
+        return
+    token = _current_turn_id.set(turn_id or uuid.uuid4().hex[:12])
+    try:
+        with _timed_span("turn", {}):
+            yield _current_turn_id.get()
+    finally:
+        _current_turn_id.reset(token)
+        export_prometheus()
+
+
+def run_in_current_turn(function):
+    """
+    ワーカースレッドに渡す関数を、呼び出し元のターンIDを引き継いで実行するようにする。
+    （ThreadPoolExecutor などはコンテキスト変数を引き継がないため）
+    """
+    if not _enabled:
+        return function
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def render_prometheus() -> str:
+    """現在のメトリクスをPrometheusのテキスト形式で返す。"""
+    lines = [
+        "# HELP storybook_stage_seconds Latency of each turn stage.",
+        "# TYPE storybook_stage_seconds histogram",
+    ]
+    with _lock:
+        for stage, histogram in sorted(_histograms.items()):
+            for bound, value in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                lines.append(f'storybook_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {value}')
+            lines.append(f'storybook_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'storybook_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+            lines.append(f'storybook_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        counter_names = sorted({name for name, _ in _counters})
+        for name in counter_names:
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, stage), value in sorted(_counters.items()):
+                if counter_name == name:
+                    label = f'{{stage="{stage}"}}' if stage else ""
+                    lines.append(f"{name}{label} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path: str = None):
+    """メトリクスをPrometheusのテキスト形式でファイルに書き出す（node_exporterのtextfile収集向け）。"""
+    if not _enabled:
+        return
+    path = path or os.getenv("TRACING_PROMETHEUS_PATH", DEFAULT_PROMETHEUS_PATH)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = None):
+    """
+    /metrics をPrometheusのテキスト形式で返すHTTPサーバーをバックグラウンドで一度だけ起動する。
+    ポートは環境変数 'TRACING_METRICS_PORT' で指定し、未指定なら起動しない。
+    """
+    global _metrics_server
+    port = port or int(os.getenv("TRACING_METRICS_PORT", "0"))
+    if not _enabled or not port:
+        return None
+    with _lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+            print(f"メトリクスを http://0.0.0.0:{port}/metrics で公開しています。")
+    return _metrics_server
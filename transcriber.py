@@ -0,0 +1,231 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+from audio_buffer import decode_to_mono_float32
+import tracing
+
+WHISPER_SAMPLE_RATE = 16000  # Whisperが前提とする入力サンプリングレート
+DEFAULT_WHISPER_MODEL_SIZE = "small"
+DEFAULT_WHISPER_LANGUAGE = "ja"
+DEFAULT_TRANSCRIBE_TIMEOUT_SECONDS = 30.0
+DEFAULT_TRANSCRIBE_WORKERS = 2
+
+# 無音区間の判定（フレームごとのRMSを、録音中の最大RMSからの相対dBで比べる）
+SILENCE_FRAME_MS = 30
+SILENCE_THRESHOLD_DB = -35.0
+SILENCE_FLOOR_DB = -60.0  # これより小さい音は、録音全体が小さくても無音とみなす
+SILENCE_PADDING_MS = 200  # 語頭・語尾を削りすぎないよう、前後に残す余白
+
+# whisper と torch は読み込みに時間がかかるため、モデルを使うときに初めてimportする
+
+# モデルのキー（サイズ、int8版は "small:int8"）-> ロード済みWhisperモデル（プロセス内で共有）
+_models = {}
+# モデルのキー -> 推論用ロック（同じモデルへの同時推論を直列化する）
+_model_locks = {}
+_registry_lock = threading.Lock()  # モデルのロード中は持ち続けるので、ロードを待たない処理では使わない
+_preload_thread = None
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class TranscriptionTimeoutError(TimeoutError):
+    """文字起こしが制限時間内に終わらなかったときに送出される例外。"""
+
+
+def get_whisper_model_size() -> str:
+    """環境変数 'WHISPER_MODEL_SIZE' から使用するモデルサイズを返す（既定は small）。"""
+    return os.getenv("WHISPER_MODEL_SIZE", DEFAULT_WHISPER_MODEL_SIZE)
+
+
+def use_int8_quantization() -> bool:
+    """環境変数 'WHISPER_INT8' が 1 で、GPUがない場合にint8の動的量子化モデルを使う。"""
+    if os.getenv("WHISPER_INT8", "0") != "1":
+        return False
+    import torch
+    return not torch.cuda.is_available()
+
+
+def _model_key(model_size: str, quantize: bool) -> str:
+    return f"{model_size}:int8" if quantize else model_size
+
+
+def quantize_model_for_cpu(model):
+    """
+    WhisperモデルのLinear層を、CPU向けにint8の動的量子化へ置き換える関数。
+    Whisperの Linear は nn.Linear のサブクラス（推論時に重みの型を入力に合わせるだけ）なので、
+    量子化の対象になるよう nn.Linear に戻してから quantize_dynamic を通す。
+    """
+    import torch
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear) and type(module) is not torch.nn.Linear:
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def get_whisper_model(model_size: str = None, quantize: bool = None):
+    """
+    プロセス内で共有されるWhisperモデルを返す関数。
+    初回呼び出し時のみロードし、以降は同じインスタンスを使い回す。
+    quantize を省略した場合は環境変数 'WHISPER_INT8' の設定に従う。
+    """
+    model_size = model_size or get_whisper_model_size()
+    quantize = use_int8_quantization() if quantize is None else quantize
+    key = _model_key(model_size, quantize)
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        model = _models.get(key)
+        if model is None:
+            print(f"Whisperモデル '{key}' をロードします...")
+            import whisper
+            with tracing.span("whisper_load", model_size=key):
+                if quantize:
+                    model = quantize_model_for_cpu(whisper.load_model(model_size, device="cpu"))
+                else:
+                    model = whisper.load_model(model_size)
+            # ロックのない高速経路でモデルを見つけた呼び出し元が推論用ロックを使えるよう、ロックを先に登録する
+            _model_locks[key] = threading.Lock()
+            _models[key] = model
+            print(f"Whisperモデル '{key}' のロードが完了しました。")
+    return model
+
+
+def preload_whisper_model(model_size: str = None) -> threading.Thread:
+    """
+    バックグラウンドスレッドでWhisperモデルを先読みする関数。
+    すでに先読み中・ロード済みの場合は何もしない。
+    """
+    global _preload_thread
+    with _registry_lock:
+        if _preload_thread is not None:
+            return _preload_thread
+        _preload_thread = threading.Thread(target=_preload_worker, args=(model_size,), daemon=True)
+        _preload_thread.start()
+        return _preload_thread
+
+
+def _preload_worker(model_size: str = None):
+    try:
+        get_whisper_model(model_size)
+    except Exception as e:
+        print(f"Whisperモデルの先読み中にエラーが発生しました: {e}")
+
+
+def wav_bytes_to_whisper_array(wav_bytes: bytes) -> np.ndarray:
+    """
+    WAVのバイト列を、Whisperが直接受け取れる16kHzモノラルのfloat32配列に変換する関数。
+    一時ファイルやffmpegを経由しない。
+    """
+    return decode_to_mono_float32(wav_bytes, WHISPER_SAMPLE_RATE)
+
+
+def trim_silence(audio: np.ndarray, sample_rate: int = WHISPER_SAMPLE_RATE,
+                 threshold_db: float = SILENCE_THRESHOLD_DB, padding_ms: int = SILENCE_PADDING_MS) -> np.ndarray:
+    """
+    録音の前後の無音区間を、フレームごとの音量（RMS）で判定して取り除く関数。
+    声のあるフレームが1つもなければ空の配列を返す。
+    """
+    frame_length = int(sample_rate * SILENCE_FRAME_MS / 1000)
+    frame_count = len(audio) // frame_length
+    if frame_count == 0:
+        return audio
+
+    frames = audio[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms_db = 20.0 * np.log10(np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1)) + 1e-10)
+    threshold = max(rms_db.max() + threshold_db, SILENCE_FLOOR_DB)
+    voiced = np.flatnonzero(rms_db > threshold)
+    if len(voiced) == 0:
+        return audio[:0]
+
+    padding = int(sample_rate * padding_ms / 1000)
+    start = max(0, voiced[0] * frame_length - padding)
+    end = min(len(audio), (voiced[-1] + 1) * frame_length + padding)
+    return audio[start:end]
+
+
+def fast_decoding_options() -> dict:
+    """
+    日本語固定・貪欲デコードの高速設定を返す関数（環境変数 'WHISPER_FAST_DECODING' が 0 なら空）。
+    言語判定を省き、温度を上げての再デコードやビームサーチを行わない。
+    言語は環境変数 'WHISPER_LANGUAGE' で変更できる（既定は ja）。
+    """
+    if os.getenv("WHISPER_FAST_DECODING", "1") != "1":
+        return {}
+    return {
+        "language": os.getenv("WHISPER_LANGUAGE", DEFAULT_WHISPER_LANGUAGE),
+        "temperature": 0.0,
+        "beam_size": None,
+        "best_of": None,
+        "condition_on_previous_text": False,
+        "without_timestamps": True,
+    }
+
+
+def transcribe_audio_array(audio: np.ndarray, model_size: str = None, quantize: bool = None,
+                           trim: bool = None, **options) -> str:
+    """
+    16kHzモノラルのfloat32配列を文字起こしして、テキストを返す関数。
+    既定では前後の無音を取り除き（環境変数 'WHISPER_TRIM_SILENCE' が 0 なら無効）、高速なデコード設定を使う。
+    options に指定した値は高速設定より優先される。
+    """
+    model_size = model_size or get_whisper_model_size()
+    quantize = use_int8_quantization() if quantize is None else quantize
+    trim = os.getenv("WHISPER_TRIM_SILENCE", "1") == "1" if trim is None else trim
+    model = get_whisper_model(model_size, quantize)
+    options = {**fast_decoding_options(), **options}
+    options.setdefault("fp16", model.device.type == "cuda")
+
+    original_seconds = len(audio) / WHISPER_SAMPLE_RATE
+    if trim:
+        audio = trim_silence(audio)
+        if len(audio) == 0:
+            print(f"録音（{original_seconds:.1f}秒）に声が含まれていなかったため、文字起こしを省略しました。")
+            return ""
+
+    key = _model_key(model_size, quantize)
+    with _model_locks[key], tracing.span("whisper_transcribe", audio_seconds=round(original_seconds, 2),
+                                         trimmed_seconds=round(len(audio) / WHISPER_SAMPLE_RATE, 2)):
+        result = model.transcribe(audio, **options)
+    return result["text"]
+
+
+def transcribe_wav_bytes(wav_bytes: bytes, model_size: str = None, **options) -> str:
+    """
+    audio_recorder() が返すWAVバイト列をそのまま文字起こしする関数。
+    :param wav_bytes: WAV形式の音声データ
+    :param model_size: Whisperのモデルサイズ（省略時は環境変数の設定）
+    :return: 文字起こし結果のテキスト
+    """
+    audio = wav_bytes_to_whisper_array(wav_bytes)
+    return transcribe_audio_array(audio, model_size=model_size, **options)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    # モデルのロード（_registry_lock）を待たずに投入できるよう、別のロックで作る
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("WHISPER_WORKERS", DEFAULT_TRANSCRIBE_WORKERS)),
+                thread_name_prefix="whisper",
+            )
+        return _executor
+
+
+def transcribe_wav_bytes_with_timeout(wav_bytes: bytes, timeout: float = None, **options) -> str:
+    """
+    transcribe_wav_bytes をワーカースレッドで実行し、制限時間内に終わらなければ TranscriptionTimeoutError を送出する関数。
+    制限時間は環境変数 'WHISPER_TIMEOUT_SECONDS' で変更できる（既定は30秒）。
+    時間切れになった文字起こしはワーカー上で最後まで実行されるが、結果は捨てられる。
+    """
+    timeout = timeout if timeout is not None else float(os.getenv("WHISPER_TIMEOUT_SECONDS", DEFAULT_TRANSCRIBE_TIMEOUT_SECONDS))
+    future = _get_executor().submit(tracing.run_in_current_turn(transcribe_wav_bytes), wav_bytes, **options)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        tracing.count("storybook_stage_timeouts_total", "whisper_transcribe")
+        raise TranscriptionTimeoutError(f"音声の文字起こしが{timeout:.0f}秒以内に終わりませんでした。")
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+import tracing
+
+DEFAULT_CACHE_DIR = os.path.join("cache", "tts")
+DEFAULT_MEMORY_MAX_BYTES = 64 * 1024 * 1024   # メモリ層: 64MB（24kHz/16bitで約20分ぶん）
+DEFAULT_DISK_MAX_BYTES = 512 * 1024 * 1024    # ディスク層: 512MB
+
+# 起動時に先に音声化しておく定型フレーズ
+DEFAULT_PHRASE_BANK = [
+    "何かお話ししたいことを入力してね！",
+    "AIモデルが初期化されていません。まずAIを初期化してください。",
+    "この絵について何かお話ししようか？",
+    "ごめんね、いまちょっとお返事できないみたい。もう一度お話ししてね！",
+    "ごめんね、この絵のことがよくわからなかったみたい。このままお話ししようね！",
+]
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角や余分な空白の違いでキャッシュが外れないよう、テキストを正規化する。"""
+    normalized = unicodedata.normalize("NFKC", text)
+    return " ".join(normalized.split())
+
+
+def make_cache_key(text: str, voice_name: str, model_name: str) -> str:
+    """(正規化テキスト, 声, TTSモデル) からキャッシュキーを作る。"""
+    material = "\x1f".join([normalize_text(text), voice_name, model_name])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """
+    合成済みPCMを保持する2層キャッシュ。
+    メモリ上のLRUを先に引き、外れたらディスクを引く。どちらの層もバイト数の上限で古いものから削除する。
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, memory_max_bytes: int = DEFAULT_MEMORY_MAX_BYTES,
+                 disk_max_bytes: int = DEFAULT_DISK_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".pcm")
+        )
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pcm")
+
+    def get(self, text: str, voice_name: str, model_name: str):
+        """キャッシュ済みのPCMバイト列を返す。どちらの層にもなければ None を返す。"""
+        key = make_cache_key(text, voice_name, model_name)
+        with self._lock:
+            pcm_bytes = self._memory.get(key)
+            if pcm_bytes is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                tracing.count("storybook_cache_hits_total", "tts_memory")
+                return pcm_bytes
+
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                pcm_bytes = f.read()
+            os.utime(path)  # ディスク層のLRU順を更新
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            tracing.count("storybook_cache_misses_total", "tts")
+            return None
+
+        tracing.count("storybook_cache_hits_total", "tts_disk")
+        with self._lock:
+            self.disk_hits += 1
+            self._put_memory(key, pcm_bytes)
+        return pcm_bytes
+
+    def put(self, text: str, voice_name: str, model_name: str, pcm_bytes: bytes):
+        """PCMバイト列を両方の層に保存する。"""
+        key = make_cache_key(text, voice_name, model_name)
+        path = self._disk_path(key)
+        if len(pcm_bytes) <= self.disk_max_bytes:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(pcm_bytes)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += len(pcm_bytes) - previous_size
+                self._evict_disk()
+
+        with self._lock:
+            self._put_memory(key, pcm_bytes)
+
+    def _put_memory(self, key: str, pcm_bytes: bytes):
+        if len(pcm_bytes) > self.memory_max_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = pcm_bytes
+        self._memory_bytes += len(pcm_bytes)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".pcm")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
+
+    def stats(self) -> dict:
+        """層ごとのヒット数・ミス数・使用バイト数を返す。"""
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+def load_phrase_bank() -> list:
+    """
+    事前に音声化するフレーズ一覧を返す。
+    環境変数 'TTS_PHRASE_BANK_PATH' があれば、そのファイル（1行1フレーズ）を使う。
+    """
+    path = os.getenv("TTS_PHRASE_BANK_PATH")
+    if not path:
+        return list(DEFAULT_PHRASE_BANK)
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_tts_cache() -> TTSCache:
+    """環境変数の設定で作られた、プロセス内共有のTTSキャッシュを返す。"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TTSCache(
+                cache_dir=os.getenv("TTS_CACHE_DIR", DEFAULT_CACHE_DIR),
+                memory_max_bytes=int(os.getenv("TTS_CACHE_MEMORY_MAX_BYTES", DEFAULT_MEMORY_MAX_BYTES)),
+                disk_max_bytes=int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", DEFAULT_DISK_MAX_BYTES)),
+            )
+        return _default_cache
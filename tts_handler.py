@@ -1,61 +1,147 @@
-import os
+import asyncio
 import base64
-import wave
-from google import genai
-from google.genai import types
-import ai_init
+import threading
+from call_policy import CircuitOpenError, get_call_policy
+from gemini_client import async_gemini_call_slot, gemini_call_slot, get_genai_client
+from session_manager import get_session
+from tts_cache import get_tts_cache, load_phrase_bank
+import tracing
 
-def synthesize_speech_with_gemini_to_wav(text: str, filename: str = "out.wav", voice_name: str = "Charon") -> str:
-    """
-    Gemini TTSモデルで音声を生成し、WAV形式で保存。
-    :param text: 音声に変換するテキスト
-    :param filename: 保存先ファイル名（.wav）
-    :return: 保存されたファイルパス
-    """
-    try:
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("APIキーが見つかりません。.envファイルに 'GEMINI_API_KEY' を設定してください。")
-
-        client = genai.Client(api_key=api_key)
-
-        gender = ai_init.current_persona_metadata.get("性別", "不明")
-
-        if gender == "男性":
-            voice_name = "Charon"
-        elif gender == "女性":
-            voice_name = "Sulafat"
-        else:
-            voice_name = "Fenrir"  # 不明の場合や中性的な声を使う
-
-        response = client.models.generate_content(
-            model="models/gemini-2.5-flash-preview-tts",
-            contents=text,
-            config=types.GenerateContentConfig(
-                response_modalities=["AUDIO"],
-                speech_config=types.SpeechConfig(
-                    voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                            voice_name=voice_name  # 他に 'Breeze', 'Wave' など
-                        )
-                    )
+TTS_MODEL_NAME = "models/gemini-2.5-flash-preview-tts"
+TTS_VOICE_NAMES = ["Charon", "Sulafat", "Fenrir"]
+
+_phrase_bank_thread = None
+_phrase_bank_lock = threading.Lock()
+
+
+def select_voice_name_for_persona(persona) -> str:
+    """ペルソナ（persona_schema.Persona）の性別からTTSの声を選ぶ関数。"""
+    gender = persona.gender
+
+    if gender == "男性":
+        return "Charon"
+    elif gender == "女性":
+        return "Sulafat"
+    else:
+        return "Fenrir"  # 不明の場合や中性的な声を使う
+
+
+def _build_speech_config(voice_name: str, timeout: float = None):
+    from google.genai import types
+    return types.GenerateContentConfig(
+        # 期限を過ぎたリクエストはHTTPのタイムアウトで打ち切り、ワーカースレッドと同時実行の枠を手放す
+        http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            voice_config=types.VoiceConfig(
+                prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                    voice_name=voice_name  # 他に 'Breeze', 'Wave' など
                 )
             )
         )
+    )
+
+
+def _decode_pcm(response) -> bytes:
+    # 音声データをbase64からデコード
+    raw_data = response.candidates[0].content.parts[0].inline_data.data
+    return base64.b64decode(raw_data)
+
+
+def synthesize_pcm_with_gemini(text: str, voice_name: str) -> bytes:
+    """
+    Gemini TTSモデルで音声を生成し、PCM（24000Hz, 16bit, モノラル）のバイト列を返す。
+    同じ (テキスト, 声, モデル) の組み合わせはキャッシュから返し、APIを呼ばない。
+    キャッシュになく、TTSの失敗が続いている間は CircuitOpenError を送出する。
+    """
+    cache = get_tts_cache()
+    pcm_bytes = cache.get(text, voice_name, TTS_MODEL_NAME)
+    if pcm_bytes is not None:
+        return pcm_bytes
+
+    client = get_genai_client()
+
+    def request(timeout):
+        with gemini_call_slot(timeout):
+            return client.models.generate_content(
+                model=TTS_MODEL_NAME,
+                contents=text,
+                config=_build_speech_config(voice_name, timeout),
+            )
+
+    # TTSが不調な間はサーキットブレーカーが CircuitOpenError ですぐに打ち切るので、返事は文字だけで先に進む
+    with tracing.span("tts", chars=len(text)):
+        response = get_call_policy("tts").call(request)
+    pcm_bytes = _decode_pcm(response)
+
+    cache.put(text, voice_name, TTS_MODEL_NAME, pcm_bytes)
+    return pcm_bytes
+
+
+async def synthesize_pcm_with_gemini_async(text: str, voice_name: str) -> bytes:
+    """synthesize_pcm_with_gemini の非同期版。共有Clientの非同期APIを使う。キャッシュのファイルの読み書きはスレッドで行う。"""
+    cache = await asyncio.to_thread(get_tts_cache)
+    pcm_bytes = await asyncio.to_thread(cache.get, text, voice_name, TTS_MODEL_NAME)
+    if pcm_bytes is not None:
+        return pcm_bytes
+
+    client = get_genai_client()
+
+    async def request(timeout):
+        async with async_gemini_call_slot(timeout):
+            return await client.aio.models.generate_content(
+                model=TTS_MODEL_NAME,
+                contents=text,
+                config=_build_speech_config(voice_name, timeout),
+            )
+
+    with tracing.span("tts", chars=len(text)):
+        response = await get_call_policy("tts").call_async(request)
+    pcm_bytes = _decode_pcm(response)
 
-        # 音声データをbase64からデコード
-        raw_data = response.candidates[0].content.parts[0].inline_data.data
-        pcm_bytes = base64.b64decode(raw_data)
+    await asyncio.to_thread(cache.put, text, voice_name, TTS_MODEL_NAME, pcm_bytes)
+    return pcm_bytes
 
-        # WAVファイルに書き出す（24000Hz, 16bit, モノラル）
-        with wave.open(filename, "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)  # 16bit = 2bytes
-            wf.setframerate(24000)
-            wf.writeframes(pcm_bytes)
 
-        return filename
+def synthesize_speech_with_gemini(text: str, voice_name: str = None) -> bytes:
+    """
+    Gemini TTSモデルで音声を生成し、PCMのバイト列をメモリ上で返す（ファイルには書き出さない）。
+    :param text: 音声に変換するテキスト
+    :param voice_name: 使用する声（省略時は現在の会話セッションのペルソナに合わせた声）
+    :return: PCM（24000Hz, 16bit, モノラル）のバイト列。失敗した場合は None
+    """
+    try:
+        voice_name = voice_name or get_session().voice_name
+        return synthesize_pcm_with_gemini(text, voice_name)
 
+    except CircuitOpenError as e:
+        print(f"音声生成を省略しました（文字のみで返事します）: {e}")
+        return None
     except Exception as e:
         print(f"❌ 音声生成エラー: {e}")
         return None
+
+
+def prerender_phrase_bank(phrases: list = None, voice_names: list = None):
+    """定型フレーズを全ての声で事前に音声化し、TTSキャッシュに載せておく関数。"""
+    phrases = phrases if phrases is not None else load_phrase_bank()
+    voice_names = voice_names or TTS_VOICE_NAMES
+    rendered = 0
+    for phrase in phrases:
+        for voice_name in voice_names:
+            try:
+                synthesize_pcm_with_gemini(phrase, voice_name)
+                rendered += 1
+            except Exception as e:
+                print(f"❌ 定型フレーズの事前音声化エラー（{voice_name}）: {e}")
+    print(f"定型フレーズの事前音声化が完了しました（{rendered}件）。キャッシュ状況: {get_tts_cache().stats()}")
+
+
+def start_phrase_bank_prerender() -> threading.Thread:
+    """定型フレーズの事前音声化をバックグラウンドで一度だけ開始する関数。"""
+    global _phrase_bank_thread
+    with _phrase_bank_lock:
+        if _phrase_bank_thread is None:
+            _phrase_bank_thread = threading.Thread(target=prerender_phrase_bank, daemon=True)
+            _phrase_bank_thread.start()
+        return _phrase_bank_thread
@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+from ai_init import initialize_ai
+
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+
+
+def start_warm_up() -> threading.Thread:
+    """
+    重い準備（Gemini SDKの読み込みと初期化・定型フレーズの音声化・Whisperモデルの読み込み）を、
+    バックグラウンドスレッドでプロセス内に一度だけ始める関数。
+    最初の画面はこれを待たずに表示し、AIが必要になった時点で initialize_ai() が完了を待つ。
+    """
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_warm_up_worker, name="warm-up", daemon=True)
+            _warm_up_thread.start()
+        return _warm_up_thread
+
+
+def _warm_up_worker():
+    started = time.perf_counter()
+    if not initialize_ai():
+        print("ウォームアップ中のAIの初期化に失敗しました。AIを使う時点で再度初期化を試みます。")
+        return
+    print(f"ウォームアップ: AIの初期化が完了しました（{time.perf_counter() - started:.2f}秒）。")
+
+    try:
+        # 定型フレーズの事前音声化（2回目以降の起動ではディスクキャッシュから読むだけ）
+        if os.getenv("TTS_PHRASE_BANK_PRERENDER", "1") == "1":
+            from tts_handler import start_phrase_bank_prerender
+            start_phrase_bank_prerender()
+        # Whisperモデル（と torch）の先読み。マイクを使わない利用者の最初の表示を遅らせないよう、ここで読み込む
+        if os.getenv("WHISPER_PRELOAD", "1") == "1":
+            from transcriber import preload_whisper_model
+            preload_whisper_model()
+    except Exception as e:
+        print(f"ウォームアップ中にエラーが発生しました: {e}")